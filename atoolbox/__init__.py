@@ -2,7 +2,7 @@
 from .class_views import ExecView, View
 from .create_app import create_default_app
 from .exceptions import JsonErrors, RequestError
-from .patch_methods import patch
+from .patch_methods import Batch, patch
 from .settings import BaseSettings
 from .utils import *
 from .version import VERSION
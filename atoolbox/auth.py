@@ -3,6 +3,7 @@ import logging
 from pydantic import BaseModel
 
 from .exceptions import JsonErrors, RequestError
+from .middleware import http_client_timeout
 from .settings import GREPAPTCHA_TEST_SECRET, BaseSettings
 from .utils import get_ip, remove_port
 
@@ -17,7 +18,8 @@ async def check_grecaptcha(m: BaseModel, request, *, error_headers=None):
         raise JsonErrors.HTTPBadRequest(message='No recaptcha value', headers=error_headers)
 
     post_data = {'secret': settings.grecaptcha_secret, 'response': m.grecaptcha_token, 'remoteip': client_ip}
-    async with request.app['http_client'].post(settings.grecaptcha_url, data=post_data) as r:
+    http_client = request.app['http_client']
+    async with http_client.post(settings.grecaptcha_url, data=post_data, timeout=http_client_timeout(request)) as r:
         if r.status != 200:
             raise RequestError(r.status, settings.grecaptcha_url, text=await r.text())
         data = await r.json()
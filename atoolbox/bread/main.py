@@ -1,7 +1,7 @@
 import logging
 import re
 from enum import Enum
-from functools import update_wrapper, wraps
+from functools import partial, update_wrapper, wraps
 from typing import Generator, List, Optional, Tuple, Type
 
 from aiohttp import web
@@ -11,7 +11,11 @@ from buildpg.asyncpg import BuildPgConnection
 from buildpg.clauses import Clause, Clauses, From, Join, Limit, OrderBy, Select, Where
 from pydantic import BaseModel
 
+from ..db.replicas import read_only
 from ..exceptions import JsonErrors
+from ..idempotency import idempotent
+from ..invalidation import invalidate
+from ..middleware import after_commit
 from ..utils import get_offset, json_response, parse_request_json, parse_request_json_ignore_missing, raw_json_response
 
 logger = logging.getLogger('atoolbox.bread')
@@ -211,6 +215,7 @@ class ReadBread(BaseBread):
         yield self.join()
         yield self.where()
 
+    @read_only
     async def browse(self) -> web.Response:
         json_str = await self.conn.fetchval_b(
             self.browse_sql,
@@ -229,6 +234,7 @@ class ReadBread(BaseBread):
         yield self.where_pk(pk)
         yield Limit(Var('1'))
 
+    @read_only
     async def retrieve(self, pk) -> web.Response:
         return await self._fetchval_response(
             self.retrieve_sql, query=await self.retrieve_query(pk), print_=self.print_queries
@@ -286,6 +292,9 @@ class Bread(ReadBread):
         )
 
     async def add(self) -> web.Response:
+        return await idempotent(self.request, self._add)
+
+    async def _add(self) -> web.Response:
         m = await parse_request_json(self.request, self.Model)
         data = await self.prepare_add_data(m.dict())
         try:
@@ -293,6 +302,7 @@ class Bread(ReadBread):
         except UniqueViolationError as e:
             raise self.conflict_exc(e)
         else:
+            await self.invalidate(pk)
             return json_response(status='ok', pk=pk, status_=201)
 
     async def add_options(self) -> web.Response:
@@ -338,6 +348,7 @@ class Bread(ReadBread):
         except UniqueViolationError as e:
             raise self.conflict_exc(e)
         else:
+            await self.invalidate(pk)
             return json_response(status='ok')
 
     async def edit_options(self) -> web.Response:
@@ -351,8 +362,16 @@ class Bread(ReadBread):
     async def delete(self, pk) -> web.Response:
         await self.check_item_permissions(pk)
         await self.delete_execute(pk)
+        await self.invalidate(pk)
         return json_response(message=f'{self.single_title} {pk} deleted', pk=pk)
 
+    async def invalidate(self, pk):
+        """
+        Called after an item is added, edited or deleted to tell in-process caches in all processes, topic is the table
+        name. Messages are only sent once the request's transaction (if any) commits.
+        """
+        await after_commit(self.request, partial(invalidate, self.app, self.table, pk, conn=self.conn))
+
     @classmethod
     def _routes(cls, root, name) -> List[web.RouteDef]:
         yield from super()._routes(root, name)
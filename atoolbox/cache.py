@@ -0,0 +1,285 @@
+import asyncio
+import json
+import logging
+import math
+import pickle
+import random
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from time import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+from aiohttp import web
+from pydantic.json import pydantic_encoder
+
+from .metrics import MetricFamily, gauge
+from .settings import BaseSettings
+
+logger = logging.getLogger('atoolbox.cache')
+# invalidation topic used to remove entries from the local tier in all processes
+CACHE_TOPIC = 'atoolbox_cache'
+
+
+class JsonSerializer:
+    def dumps(self, value: Any) -> bytes:
+        return json.dumps(value, default=pydantic_encoder, separators=(',', ':')).encode()
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data)
+
+
+class PickleSerializer:
+    def dumps(self, value: Any) -> bytes:
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data: bytes) -> Any:
+        return pickle.loads(data)
+
+
+class BytesSerializer:
+    """
+    For values which are already bytes, eg. from response_to_bytes.
+    """
+
+    def dumps(self, value: bytes) -> bytes:
+        return value
+
+    def loads(self, data: bytes) -> bytes:
+        return data
+
+
+SERIALIZERS = {'json': JsonSerializer, 'pickle': PickleSerializer, 'bytes': BytesSerializer}
+
+
+class _Entry:
+    __slots__ = 'value', 'size', 'expires', 'delta'
+
+    def __init__(self, value: Any, size: int, expires: float, delta: float):
+        self.value = value
+        self.size = size
+        self.expires = expires
+        # seconds taken to compute the value, used for early refresh
+        self.delta = delta
+
+
+class LRU:
+    """
+    In-process least recently used cache limited by the total size of the serialised values.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.data: Dict[str, _Entry] = OrderedDict()
+        self.size = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[_Entry]:
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= time():
+            self.pop(key)
+            return None
+        self.data.move_to_end(key)
+        return entry
+
+    def set(self, key: str, entry: _Entry) -> None:
+        self.pop(key)
+        if entry.size > self.max_bytes:
+            return
+        self.data[key] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes:
+            _, old = self.data.popitem(last=False)
+            self.size -= old.size
+            self.evictions += 1
+
+    def pop(self, key: str) -> None:
+        entry = self.data.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def clear(self) -> None:
+        self.data.clear()
+        self.size = 0
+
+
+class Cache:
+    """
+    Two tier cache, values are kept in an in-process LRU and in redis (if available) so other processes can use them.
+
+    Values are serialised for redis and to measure their size, the local tier holds the deserialised values so
+    both tiers return the same thing (eg. datetimes come back as strings with the json serializer) and these
+    shouldn't be modified. None values are cached with negative_ttl. get_or_set() only computes a value once
+    per process at a time and may refresh values shortly before they expire (probabilistic early expiration) so
+    popular keys don't all expire at once.
+
+    With an InvalidationHub set() and delete() remove the key from the local tier of all other processes.
+    """
+
+    def __init__(
+        self,
+        redis=None,
+        *,
+        max_bytes: int = 32 * 1024 ** 2,
+        ttl: float = 300,
+        negative_ttl: float = 30,
+        serializer=None,
+        early_refresh_beta: float = 1.0,
+        prefix: str = 'cache:',
+        invalidation=None,
+    ):
+        self.redis = redis
+        self.local = LRU(max_bytes)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.serializer = serializer or JsonSerializer()
+        self.early_refresh_beta = early_refresh_beta
+        self.prefix = prefix
+        self.invalidation = invalidation
+        if invalidation:
+            # this process has already updated its local tier
+            invalidation.subscribe(CACHE_TOPIC, self._on_invalidate, ignore_own=True)
+        self.hits = {'local': 0, 'redis': 0}
+        self.misses = 0
+        self.early_refreshes = 0
+        self._locks: Dict[str, List] = {}
+
+    async def get(self, key: str, default: Any = None, *, serializer=None) -> Any:
+        """
+        serializer overrides the cache's serializer for this key, it must be the same as when the value was set.
+        """
+        entry = await self._lookup(key, serializer)
+        return default if entry is None else entry.value
+
+    async def set(self, key: str, value: Any, ttl: float = None, *, serializer=None, publish: bool = True) -> None:
+        """
+        publish=False skips removing the key from other processes' local tier, eg. when the key wasn't in the cache
+        so other processes can't have a value for it which needs replacing.
+        """
+        await self._store(key, value, self.ttl if ttl is None else ttl, 0, serializer)
+        if publish:
+            await self._publish(key)
+
+    async def delete(self, key: str) -> None:
+        self.local.pop(key)
+        if self.redis is not None:
+            await self.redis.delete(self.prefix + key)
+        await self._publish(key)
+
+    async def get_or_set(
+        self,
+        key: str,
+        func: Callable[[], Awaitable[Any]],
+        *,
+        ttl: float = None,
+        negative_ttl: float = None,
+        serializer=None,
+    ) -> Any:
+        """
+        Get key from the cache or call func to compute it, None results are cached for negative_ttl.
+        """
+        entry = await self._lookup(key, serializer)
+        if entry is not None and not self._refresh_early(entry):
+            return entry.value
+
+        async with self._key_lock(key):
+            # the value may have been computed while waiting for the lock
+            latest = await self._lookup(key, serializer)
+            if latest is not None and (entry is None or latest.expires != entry.expires):
+                return latest.value
+            if entry is not None:
+                self.early_refreshes += 1
+
+            start = time()
+            value = await func()
+            if value is None:
+                ttl = self.negative_ttl if negative_ttl is None else negative_ttl
+            elif ttl is None:
+                ttl = self.ttl
+            return await self._store(key, value, ttl, time() - start, serializer)
+
+    def _refresh_early(self, entry: _Entry) -> bool:
+        # "XFetch" from Optimal Probabilistic Cache Stampede Prevention (Vattani et al.)
+        return time() - entry.delta * self.early_refresh_beta * math.log(1 - random.random()) >= entry.expires
+
+    async def _lookup(self, key: str, serializer=None) -> Optional[_Entry]:
+        entry = self.local.get(key)
+        if entry is not None:
+            self.hits['local'] += 1
+            return entry
+
+        data = self.redis is not None and await self.redis.get(self.prefix + key)
+        if data:
+            header, payload = data.split(b'\n', 1)
+            expires, delta = map(float, header.split(b' '))
+            entry = _Entry((serializer or self.serializer).loads(payload), len(payload), expires, delta)
+            self.local.set(key, entry)
+            self.hits['redis'] += 1
+            return entry
+
+        self.misses += 1
+        return None
+
+    async def _store(self, key: str, value: Any, ttl: float, delta: float, serializer=None) -> Any:
+        serializer = serializer or self.serializer
+        payload = serializer.dumps(value)
+        expires = time() + ttl
+        # store what a redis hit would return so the value doesn't depend on which tier answered
+        value = serializer.loads(payload)
+        self.local.set(key, _Entry(value, len(payload), expires, delta))
+        if self.redis is not None:
+            data = f'{expires:0.3f} {delta:0.4f}\n'.encode() + payload
+            await self.redis.set(self.prefix + key, data, pexpire=max(int(ttl * 1000), 1))
+        return value
+
+    async def _publish(self, key: str):
+        if self.invalidation:
+            await self.invalidation.publish(CACHE_TOPIC, key)
+
+    def _on_invalidate(self, topic: str, key: Optional[str]):
+        if key is None:
+            self.local.clear()
+        else:
+            self.local.pop(key)
+
+    @asynccontextmanager
+    async def _key_lock(self, key: str):
+        lock_users = self._locks.get(key)
+        if lock_users is None:
+            lock_users = self._locks[key] = [asyncio.Lock(), 0]
+        lock_users[1] += 1
+        try:
+            async with lock_users[0]:
+                yield
+        finally:
+            lock_users[1] -= 1
+            if not lock_users[1]:
+                del self._locks[key]
+
+    def metrics(self, app: web.Application) -> Iterable[MetricFamily]:
+        name = 'atoolbox_cache_hits_total'
+        samples = [(name, {'tier': tier}, count) for tier, count in self.hits.items()]
+        yield MetricFamily(name, 'counter', 'Cache hits by tier.', samples)
+        for name, help, value in (
+            ('atoolbox_cache_misses_total', 'Cache misses.', self.misses),
+            ('atoolbox_cache_evictions_total', 'Values evicted from the in-process cache.', self.local.evictions),
+            ('atoolbox_cache_early_refreshes_total', 'Values recomputed before they expired.', self.early_refreshes),
+        ):
+            yield MetricFamily(name, 'counter', help, [(name, {}, value)])
+        yield gauge('atoolbox_cache_local_bytes', 'Size of values in the in-process cache.', self.local.size)
+
+    @classmethod
+    def from_settings(cls, settings: BaseSettings, *, redis=None, invalidation=None) -> 'Cache':
+        return cls(
+            redis,
+            max_bytes=settings.cache_max_bytes,
+            ttl=settings.cache_ttl,
+            negative_ttl=settings.cache_negative_ttl,
+            serializer=SERIALIZERS[settings.cache_serializer](),
+            early_refresh_beta=settings.cache_early_refresh_beta,
+            invalidation=invalidation,
+        )
+
+    def __repr__(self) -> str:
+        return f'<Cache local_items={len(self.local.data)} local_bytes={self.local.size}>'
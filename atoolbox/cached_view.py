@@ -0,0 +1,129 @@
+import inspect
+import logging
+from dataclasses import dataclass
+from time import time
+from typing import List, Optional, Set, Union
+from urllib.parse import urlencode
+
+from aiohttp import web
+from aiohttp.hdrs import METH_GET, METH_HEAD
+from aiohttp.web_middlewares import middleware
+
+from .cache import BytesSerializer, Cache
+from .rate_limit import KeyFunc, user_key
+from .utils import response_from_bytes, response_to_bytes
+
+logger = logging.getLogger('atoolbox.cached_view')
+bytes_serializer = BytesSerializer()
+
+
+@dataclass
+class CachedView:
+    # seconds responses are fresh for
+    ttl: float
+    # header names or functions taking the request and returning a key, "user" varies by the session's user
+    vary: List[Union[str, KeyFunc]]
+    # seconds after ttl during which the stale response is returned while it's refreshed in the background
+    stale_ttl: float = 0
+
+
+def cached_view(ttl: float, *, vary: List[Union[str, KeyFunc]] = (), stale_ttl: float = 0):
+    """
+    Decorator to cache successful GET responses from a handler, View.call or View/ExecView subclass in app['cache'].
+    Requires cached_view_middleware.
+
+    The cache key is made from the route name, match_info, the query string (in any order) and vary.
+
+    :param ttl: seconds responses are cached for
+    :param vary: header names (eg. "Accept-Language") or functions taking the request and returning a key,
+      use "user" if the response depends on the session's user
+    :param stale_ttl: seconds after ttl during which the cached response is still returned to other requests while
+      one request refreshes it (stale-while-revalidate)
+    """
+
+    def wrapper(func):
+        func.cached_view = CachedView(ttl=ttl, vary=list(vary), stale_ttl=stale_ttl)
+        return func
+
+    return wrapper
+
+
+def get_cached_view(handler) -> Optional[CachedView]:
+    # class views are decorated on the class (or call())
+    return getattr(handler, 'cached_view', None) or getattr(getattr(handler, 'view_class', None), 'cached_view', None)
+
+
+async def cache_key(request, cv: CachedView) -> str:
+    route_name = request.match_info.route.name or request.match_info.route.resource.canonical
+    match_info = urlencode(sorted(request.match_info.items()))
+    query = urlencode(sorted(request.query.items()))
+    vary = []
+    for v in cv.vary:
+        if v == 'user':
+            v = user_key
+        if callable(v):
+            v = v(request)
+            if inspect.isawaitable(v):
+                v = await v
+        else:
+            v = request.headers.get(v, '')
+        vary.append(v)
+    return f'view:{route_name}:{match_info}:{query}:{urlencode([("", v) for v in vary])}'
+
+
+def cacheable(response) -> bool:
+    return (
+        isinstance(response, web.Response)
+        and isinstance(response.body, bytes)
+        and 200 <= response.status < 300
+        and 'Set-Cookie' not in response.headers
+        and 'no-store' not in response.headers.get('Cache-Control', '')
+    )
+
+
+async def _render(request, handler, cache: Cache, key: str, cv: CachedView, *, new: bool) -> web.StreamResponse:
+    response = await handler(request)
+    if cacheable(response):
+        fresh_until = f'{time() + cv.ttl:0.3f}\n'.encode()
+        data = fresh_until + response_to_bytes(response)
+        # new keys don't need publishing, with the pg invalidation backend that would take a connection every miss
+        await cache.set(key, data, cv.ttl + cv.stale_ttl, serializer=bytes_serializer, publish=not new)
+    return response
+
+
+@middleware
+async def cached_view_middleware(request, handler):
+    """
+    Return cached responses for handlers decorated with cached_view, this should come before pg_middleware so
+    cached responses don't need a database connection. The "X-Cache" header is set to "hit", "stale" or "miss".
+
+    The first request to find a stale response renders a new one, concurrent requests get the stale response
+    until it's done.
+    """
+    cv = get_cached_view(request.match_info.handler)
+    cache: Optional[Cache] = request.app.get('cache')
+    if cv is None or cache is None or request.method not in {METH_GET, METH_HEAD}:
+        return await handler(request)
+
+    key = await cache_key(request, cv)
+    data = await cache.get(key, serializer=bytes_serializer)
+    if data:
+        fresh_until, data = data.split(b'\n', 1)
+        fresh = float(fresh_until) >= time()
+        refreshing: Set[str] = request.app['cached_view_refreshing']
+        if fresh or key in refreshing or request.method == METH_HEAD:
+            response = response_from_bytes(data)
+            response.headers['X-Cache'] = 'hit' if fresh else 'stale'
+            return response
+
+        refreshing.add(key)
+        try:
+            response = await _render(request, handler, cache, key, cv, new=False)
+        finally:
+            refreshing.discard(key)
+    elif request.method == METH_HEAD:
+        response = await handler(request)
+    else:
+        response = await _render(request, handler, cache, key, cv, new=True)
+    response.headers['X-Cache'] = 'miss'
+    return response
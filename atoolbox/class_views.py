@@ -7,6 +7,7 @@ from aiohttp.hdrs import METH_GET, METH_OPTIONS, METH_POST
 from aiohttp.web_exceptions import HTTPException
 from pydantic import BaseModel
 
+from .idempotency import idempotent
 from .utils import JsonErrors, json_response, parse_request_json
 
 if TYPE_CHECKING:  # pragma: no cover
@@ -63,10 +64,13 @@ class ExecView(View):
         return await parse_request_json(self.request, self.Model)
 
     async def post(self):
-        m = await self.parse_request()
-        response_data = await shield(self.execute(m))
-        response_data = response_data or {'status': 'ok'}
-        return json_response(**response_data)
+        async def run():
+            m = await self.parse_request()
+            response_data = await shield(self.execute(m))
+            response_data = response_data or {'status': 'ok'}
+            return json_response(**response_data)
+
+        return await idempotent(self.request, run)
 
     def build_headers(self):
         return self.headers
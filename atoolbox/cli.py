@@ -69,6 +69,15 @@ def patch(args, settings: BaseSettings):
     return run_patch(settings, patch_name, args.live, extra_args)
 
 
+@command
+def migrate(args, settings: BaseSettings):
+    logger.info('running migrate...')
+    from .db.migrations import migrate
+
+    wait_for_services(settings)
+    return migrate(settings, args.live)
+
+
 @command
 def reset_database(args, settings: BaseSettings):
     logger.info('running reset_database...')
@@ -200,7 +209,10 @@ def main(*args) -> int:
     parser.add_argument(
         '--live',
         action='store_true',
-        help='whether to run patches as live, default false, only applies to the "patch" command.',
+        help=(
+            'whether to run patches as live or apply migrations, default false, only applies to the "patch" '
+            'and "migrate" commands.'
+        ),
     )
     parser.add_argument(
         '--access-log',
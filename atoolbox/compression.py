@@ -0,0 +1,173 @@
+import asyncio
+import gzip
+import logging
+import re
+from hashlib import blake2b
+from pathlib import Path
+from time import time
+from typing import Collection, Optional
+
+from aiohttp.hdrs import METH_OPTIONS
+from aiohttp.web_middlewares import middleware
+from aiohttp.web_response import Response
+
+from .cache import LRU, _Entry
+from .settings import BaseSettings
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+logger = logging.getLogger('atoolbox.compression')
+COMPRESSIBLE_TYPES = re.compile(r'text/.+|application/(json|javascript|xml|.+\+json|.+\+xml)|image/svg\+xml')
+COMPRESSIBLE_SUFFIXES = {'.css', '.html', '.js', '.json', '.map', '.svg', '.txt', '.xml'}
+# compressed values are kept until they're evicted by newer values
+NEVER_EXPIRES = float('inf')
+
+
+def accepted_encoding(accept_encoding: str, available: Collection[str] = None) -> Optional[str]:
+    """
+    Best encoding accepted according to an Accept-Encoding header, "br" is preferred to "gzip". available defaults
+    to the encodings which can be compressed here.
+    """
+    if available is None:
+        available = ('br', 'gzip') if brotli else ('gzip',)
+    accepted = set()
+    for part in accept_encoding.lower().split(','):
+        encoding, _, params = part.strip().partition(';')
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(encoding.strip())
+    for encoding in ('br', 'gzip'):
+        if encoding in available and (encoding in accepted or '*' in accepted):
+            return encoding
+    return None
+
+
+class Compressor:
+    """
+    Compress response bodies, bodies larger than executor_size are compressed in a thread so they don't
+    block the event loop. Compressed bodies of cacheable responses are kept in an LRU of cache_bytes.
+    """
+
+    def __init__(
+        self,
+        *,
+        min_size: int = 1024,
+        executor_size: int = 64 * 1024,
+        cache_bytes: int = 8 * 1024 ** 2,
+        gzip_level: int = 6,
+        brotli_quality: int = 5,
+    ):
+        self.min_size = min_size
+        self.executor_size = executor_size
+        self.cache = LRU(cache_bytes)
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def compress_sync(self, body: bytes, encoding: str) -> bytes:
+        if encoding == 'br':
+            return brotli.compress(body, quality=self.brotli_quality)
+        else:
+            return gzip.compress(body, compresslevel=self.gzip_level)
+
+    async def compress(self, body: bytes, encoding: str, *, cache: bool = False) -> bytes:
+        key = None
+        if cache:
+            key = f'{encoding}:{blake2b(body, digest_size=16).hexdigest()}'
+            entry = self.cache.get(key)
+            if entry is not None:
+                return entry.value
+
+        if len(body) > self.executor_size:
+            compressed = await asyncio.get_event_loop().run_in_executor(None, self.compress_sync, body, encoding)
+        else:
+            compressed = self.compress_sync(body, encoding)
+
+        if key:
+            self.cache.set(key, _Entry(compressed, len(compressed), NEVER_EXPIRES, 0))
+        return compressed
+
+    @classmethod
+    def from_settings(cls, settings: BaseSettings) -> 'Compressor':
+        return cls(
+            min_size=settings.compression_min_size,
+            executor_size=settings.compression_executor_size,
+            cache_bytes=settings.compression_cache_bytes,
+            gzip_level=settings.compression_gzip_level,
+            brotli_quality=settings.compression_brotli_quality,
+        )
+
+
+def compressible(response, min_size: int) -> bool:
+    return (
+        isinstance(response, Response)
+        and isinstance(response.body, bytes)
+        and len(response.body) >= min_size
+        and 'Content-Encoding' not in response.headers
+        and bool(COMPRESSIBLE_TYPES.fullmatch(response.content_type))
+    )
+
+
+def cacheable(request, response) -> bool:
+    """
+    Whether the body is likely to be sent again so its compressed form should be kept, eg. schemas from OPTIONS
+    requests or responses from cached_view.
+    """
+    if request.method == METH_OPTIONS or 'X-Cache' in response.headers:
+        return True
+    cache_control = response.headers.get('Cache-Control', '')
+    return ('max-age' in cache_control or 'public' in cache_control) and 'private' not in cache_control
+
+
+@middleware
+async def compression_middleware(request, handler):
+    """
+    Compress response bodies with brotli (if installed) or gzip depending on the Accept-Encoding header,
+    this should be outside etag_middleware so ETags are calculated from the uncompressed body.
+    """
+    response = await handler(request)
+    compressor: Compressor = request.app['compressor']
+    if not compressible(response, compressor.min_size):
+        return response
+
+    response.headers.add('Vary', 'Accept-Encoding')
+    encoding = accepted_encoding(request.headers.get('Accept-Encoding', ''))
+    if encoding:
+        response.body = await compressor.compress(response.body, encoding, cache=cacheable(request, response))
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def precompress_directory(directory: Path, *, min_size: int = 1024, gzip_level: int = 9, brotli_quality: int = 11):
+    """
+    Write ".gz" and (if brotli is installed) ".br" versions of compressible files in directory, eg. as a build step
+    for static files. FileResponse serves ".gz" files to clients which accept gzip, the static index
+    uses both. Existing compressed files are only replaced if the original is newer.
+    """
+    start = time()
+    compressor = Compressor(gzip_level=gzip_level, brotli_quality=brotli_quality)
+    encodings = {'gzip': '.gz', 'br': '.br'} if brotli else {'gzip': '.gz'}
+    count = 0
+    for path in Path(directory).glob('**/*'):
+        if path.suffix not in COMPRESSIBLE_SUFFIXES or not path.is_file():
+            continue
+        stat = path.stat()
+        if stat.st_size < min_size:
+            continue
+        body = None
+        for encoding, suffix in encodings.items():
+            compressed_path = path.with_name(path.name + suffix)
+            if compressed_path.exists() and compressed_path.stat().st_mtime >= stat.st_mtime:
+                continue
+            body = body or path.read_bytes()
+            compressed_path.write_bytes(compressor.compress_sync(body, encoding))
+            count += 1
+    logger.info('%d compressed files written in %0.2fs', count, time() - start)
+    return count
@@ -1,77 +1,264 @@
 import asyncio
 import logging
 import warnings
-from typing import Optional
+from time import time
+from typing import Any, Awaitable, Dict, Mapping, Optional
 
-from aiohttp import ClientSession, ClientTimeout, web
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
 
-from .middleware import csrf_middleware, error_middleware, pg_middleware
+from .cache import Cache
+from .cached_view import cached_view_middleware
+from .compression import Compressor, compression_middleware
+from .invalidation import InvalidationHub
+from .load_shedding import AdaptiveLimiter, load_shedding_middleware
+from .metrics import DEFAULT_BUCKETS, Metrics, metrics_middleware
+from .middleware import csrf_middleware, error_middleware, etag_middleware, pg_middleware
+from .rate_limit import RateLimiter, rate_limit_middleware
 from .settings import BaseSettings
+from .single_flight import SingleFlightGroup, single_flight_middleware
+from .static_index import StaticIndex
 
 logger = logging.getLogger('atoolbox.web')
 
 
+async def _setup_pg(app: web.Application, settings: BaseSettings):
+    try:
+        from .db import prepare_pool
+        from .db.replicas import create_replica_pools
+    except ImportError:
+        warnings.warn('buildpg and asyncpg need to be installed to use postgres', RuntimeWarning)
+        return
+
+    # asyncpg opens pg_pool_min_size connections when creating each pool so there's no separate warmup
+    app['pg'], replicas = await asyncio.gather(prepare_pool(settings), create_replica_pools(settings))
+    if replicas:
+        app['pg_replicas'] = replicas
+        app['pg_replicas_health'] = asyncio.ensure_future(replicas.health_loop(settings.pg_replica_health_interval))
+        if 'metrics' in app:
+            app['metrics'].add_collector(replicas.metrics)
+
+
+async def _setup_redis(app: web.Application, settings: BaseSettings):
+    try:
+        from arq import create_pool
+    except ImportError:
+        warnings.warn('arq and aioredis need to be installed to use redis', RuntimeWarning)
+    else:
+        app['redis'] = redis = await create_pool(settings.redis_settings)
+        if getattr(settings, 'startup_warmup', False):
+            await redis.ping()
+
+
+async def _setup_http_client(app: web.Application, settings: BaseSettings):
+    timeout = getattr(settings, 'http_client_timeout', 30)
+    app['http_client'] = http_client = ClientSession(timeout=ClientTimeout(total=timeout))
+    if getattr(settings, 'startup_warmup', False):
+        await asyncio.gather(*(_warmup_url(http_client, url) for url in settings.http_client_warmup_urls))
+
+
+async def _warmup_url(http_client: ClientSession, url: str):
+    """
+    Resolve DNS and open a connection (including the TLS handshake) which is kept alive for the first real request.
+    """
+    try:
+        async with http_client.head(url) as r:
+            await r.read()
+    except (ClientError, OSError, asyncio.TimeoutError) as e:
+        logger.warning('error warming up connection to %s, %s: %s', url, e.__class__.__name__, e)
+
+
+async def _migrate(app: web.Application, settings: BaseSettings):
+    from .db.migrations import apply_migrations
+
+    async with app['pg'].acquire() as conn:
+        await apply_migrations(conn, settings)
+
+
+async def _run_services(app: web.Application, services: Dict[str, Awaitable], settings: BaseSettings):
+    """
+    Initialise services concurrently, each with its own timeout, timings are logged and saved
+    as app['startup_report']. If any service fails, those already created are closed.
+    """
+    default_timeout = getattr(settings, 'startup_timeout', 30)
+    timeouts = getattr(settings, 'startup_timeouts', {})
+    report: Dict[str, float] = {}
+
+    async def run(name: str, coro: Awaitable):
+        timeout = timeouts.get(name, default_timeout)
+        start = time()
+        try:
+            await asyncio.wait_for(coro, timeout)
+        except asyncio.TimeoutError as e:
+            raise asyncio.TimeoutError(f'{name} startup timed out after {timeout}s') from e
+        report[name] = time() - start
+
+    start = time()
+    existing = set(app)
+    tasks = [asyncio.ensure_future(run(name, coro)) for name, coro in services.items()]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        try:
+            await _close_services({k: v for k, v in app.items() if k not in existing})
+        except Exception:
+            logger.exception('error closing services after startup failed')
+        raise
+    app['startup_report'] = report
+    if report:
+        services_summary = ', '.join(f'{name} {t * 1000:0.0f}ms' for name, t in report.items())
+        logger.info('startup complete in %0.0fms: %s', (time() - start) * 1000, services_summary)
+
+
+async def _setup_static_index(app: web.Application, settings: BaseSettings):
+    app['static_index'] = static_index = StaticIndex.from_settings(app['static_dir'], settings)
+    await asyncio.get_event_loop().run_in_executor(None, static_index.build)
+    if settings.static_index_watch_interval:
+        await static_index.start(settings.static_index_watch_interval)
+
+
 async def startup(app: web.Application):
     settings: Optional[BaseSettings] = app['settings']
     if not settings:
         return
+    services = {}
     # if pg is already set the database doesn't need to be created
     if 'pg' not in app and getattr(settings, 'pg_dsn', None):
-        try:
-            from .db import prepare_database
-            from buildpg import asyncpg
-        except ImportError:
-            warnings.warn('buildpg and asyncpg need to be installed to use postgres', RuntimeWarning)
-        else:
-            await prepare_database(settings, False)
-            app['pg'] = await asyncpg.create_pool_b(dsn=settings.pg_dsn, min_size=2)
+        services['pg'] = _setup_pg(app, settings)
 
     if 'redis' not in app and getattr(settings, 'redis_settings', None):
-        try:
-            from arq import create_pool
-        except ImportError:
-            warnings.warn('arq and aioredis need to be installed to use redis', RuntimeWarning)
-        else:
-            app['redis'] = await create_pool(settings.redis_settings)
+        services['redis'] = _setup_redis(app, settings)
 
     if getattr(settings, 'create_http_client', False):
-        timeout = getattr(settings, 'http_client_timeout', 30)
-        app['http_client'] = ClientSession(timeout=ClientTimeout(total=timeout))
+        services['http_client'] = _setup_http_client(app, settings)
+
+    await _run_services(app, services, settings)
+
+    if 'pg' in services and getattr(settings, 'pg_migrate_on_startup', False):
+        # not limited by startup_timeout, migrations like "create index concurrently" can take a long time
+        await _migrate(app, settings)
+
+    if 'invalidation' in app:
+        # after pg and redis are ready
+        await app['invalidation'].start(app)
+
+    if getattr(settings, 'cache', False):
+        app['cache'] = Cache.from_settings(settings, redis=app.get('redis'), invalidation=app.get('invalidation'))
+        if 'metrics' in app:
+            app['metrics'].add_collector(app['cache'].metrics)
+
+    if getattr(settings, 'static_index', False) and 'static_dir' in app:
+        await _setup_static_index(app, settings)
 
 
 async def cleanup(app: web.Application):
+    invalidation = app.get('invalidation')
+    if invalidation:
+        await invalidation.close()
+    static_index = app.get('static_index')
+    if static_index:
+        await static_index.close()
+    await _close_services(app)
+
+
+async def _close_services(services: Mapping[str, Any]):
     close_coros = []
-    http_client = app.get('http_client')
+    http_client = services.get('http_client')
     if http_client:
         close_coros.append(http_client.close())
 
-    redis = app.get('redis')
+    redis = services.get('redis')
     if redis and not redis.closed:
         redis.close()
         close_coros.append(redis.wait_closed())
 
-    pg = app.get('pg')
+    pg = services.get('pg')
     if pg:
         close_coros.append(pg.close())
 
+    health_task = services.get('pg_replicas_health')
+    if health_task:
+        health_task.cancel()
+
+    replicas = services.get('pg_replicas')
+    if replicas:
+        close_coros.append(replicas.close())
+
     await asyncio.gather(*close_coros)
 
 
-async def create_default_app(*, settings: BaseSettings = None, middleware=None, routes=None):
+def _session_middleware(settings: Optional[BaseSettings]):
     auth_key = getattr(settings, 'auth_key', None)
+    if auth_key:
+        try:
+            from aiohttp_session import session_middleware
+            from aiohttp_session.cookie_storage import EncryptedCookieStorage
+        except ImportError:
+            warnings.warn('aiohttp_session and cryptography needs to be installed to use sessions', RuntimeWarning)
+        else:
+            cookie_name = getattr(settings, 'cookie_name', None) or 'AIOHTTP_SESSION'
+            return session_middleware(EncryptedCookieStorage(auth_key, cookie_name=cookie_name))
+
+
+def _rate_limit(settings: Optional[BaseSettings]) -> bool:
+    return getattr(settings, 'rate_limit', False) and bool(getattr(settings, 'redis_settings', None))
+
+
+def default_middleware(settings: Optional[BaseSettings]) -> tuple:
+    """
+    Middleware used by create_default_app, outermost first.
+    """
+    middleware = []
+    if getattr(settings, 'metrics_path', None):
+        middleware.append(metrics_middleware)
+    if getattr(settings, 'load_shedding', False):
+        middleware.append(load_shedding_middleware)
+    if getattr(settings, 'compression', False):
+        middleware.append(compression_middleware)
+    session_middleware = _session_middleware(settings)
+    if session_middleware:
+        middleware.append(session_middleware)
+    if getattr(settings, 'etag', False):
+        middleware.append(etag_middleware)
+    middleware.append(error_middleware)
+    if _rate_limit(settings):
+        middleware.append(rate_limit_middleware)
+    if getattr(settings, 'cache', False):
+        middleware.append(cached_view_middleware)
+    if getattr(settings, 'single_flight', False):
+        middleware.append(single_flight_middleware)
+    middleware += [pg_middleware, csrf_middleware]
+    return tuple(middleware)
+
+
+def _setup_extensions(app: web.Application, settings: Optional[BaseSettings]):
+    if getattr(settings, 'metrics_path', None):
+        app['metrics'] = Metrics(getattr(settings, 'metrics_buckets', DEFAULT_BUCKETS))
+    if getattr(settings, 'load_shedding', False):
+        app['limiter'] = AdaptiveLimiter.from_settings(settings)
+        if 'metrics' in app:
+            app['metrics'].add_collector(app['limiter'].metrics)
+    if _rate_limit(settings):
+        app['rate_limiter'] = RateLimiter()
+    if getattr(settings, 'single_flight', False):
+        app['single_flight'] = SingleFlightGroup()
+        if 'metrics' in app:
+            app['metrics'].add_collector(app['single_flight'].metrics)
+    if getattr(settings, 'compression', False):
+        app['compressor'] = Compressor.from_settings(settings)
+    if getattr(settings, 'cache', False):
+        # keys of stale cached views being refreshed
+        app['cached_view_refreshing'] = set()
+    backend = getattr(settings, 'invalidation_backend', None)
+    if backend:
+        app['invalidation'] = InvalidationHub(backend, channel=settings.invalidation_channel)
+
+
+async def create_default_app(*, settings: BaseSettings = None, middleware=None, routes=None):
     if middleware is None:
-        middleware = (error_middleware, pg_middleware, csrf_middleware)
-        if auth_key:
-            try:
-                from aiohttp_session import session_middleware
-                from aiohttp_session.cookie_storage import EncryptedCookieStorage
-            except ImportError:
-                warnings.warn('aiohttp_session and cryptography needs to be installed to use sessions', RuntimeWarning)
-            else:
-                cookie_name = getattr(settings, 'cookie_name', None) or 'AIOHTTP_SESSION'
-                middleware = (
-                    session_middleware(EncryptedCookieStorage(auth_key, cookie_name=cookie_name)),
-                ) + middleware
+        middleware = default_middleware(settings)
 
     kwargs = {}
     if hasattr(settings, 'max_request_size'):
@@ -80,6 +267,7 @@ async def create_default_app(*, settings: BaseSettings = None, middleware=None,
     app = web.Application(middlewares=middleware, **kwargs)
 
     app['settings'] = settings
+    auth_key = getattr(settings, 'auth_key', None)
     if auth_key:
         try:
             from cryptography import fernet
@@ -87,6 +275,7 @@ async def create_default_app(*, settings: BaseSettings = None, middleware=None,
             warnings.warn('cryptography needs to be installed to use auth_key', RuntimeWarning)
         else:
             app['auth_fernet'] = fernet.Fernet(auth_key)
+    _setup_extensions(app, settings)
 
     app.on_startup.append(startup)
     app.on_cleanup.append(cleanup)
@@ -1,11 +1,14 @@
 import asyncio
+import hashlib
 import logging
 import os
+from urllib.parse import urlparse
 
 from buildpg import asyncpg
 
 from ..settings import BaseSettings
 from .connection import lenient_conn
+from .migrations import mark_migrations_applied
 
 logger = logging.getLogger('atoolbox.db')
 DROP_CONNECTIONS = """
@@ -13,6 +16,11 @@ select pg_terminate_backend(pg_stat_activity.pid)
 from pg_stat_activity
 where pg_stat_activity.datname = $1 AND pid <> pg_backend_pid();
 """
+META_TABLE = 'atoolbox_meta'
+CREATE_META_TABLE = f'create table if not exists {META_TABLE} (key varchar(63) primary key, value text not null)'
+SET_META = f"""
+insert into {META_TABLE} (key, value) values ($1, $2) on conflict (key) do update set value=excluded.value
+"""
 
 
 async def prepare_database(settings: BaseSettings, overwrite_existing: bool) -> bool:  # noqa: C901 (ignore complexity)
@@ -22,6 +30,9 @@ async def prepare_database(settings: BaseSettings, overwrite_existing: bool) ->
     :param overwrite_existing: whether or not to drop an existing database if it exists
     :return: whether or not a database has been (re)created
     """
+    if settings.pg_template_db and not settings.pg_db_exists:
+        return await prepare_database_from_template(settings, overwrite_existing)
+
     if settings.pg_db_exists:
         conn = await lenient_conn(settings, with_db=True)
         try:
@@ -75,12 +86,129 @@ async def prepare_database(settings: BaseSettings, overwrite_existing: bool) ->
     try:
         async with conn.transaction():
             await conn.execute(settings.sql)
+            if getattr(settings, 'migrations_dir', None):
+                await mark_migrations_applied(conn, settings)
     finally:
         await conn.close()
     logger.info('database successfully setup ✓')
     return True
 
 
+async def prepare_database_from_template(settings: BaseSettings, overwrite_existing: bool) -> bool:
+    """
+    (Re)create the database as a copy of a template database containing settings.sql, the template is created
+    if it doesn't exist. Copying a template is much faster than running settings.sql for large schemas.
+    """
+    conn = await lenient_conn(settings, with_db=False)
+    try:
+        if not overwrite_existing:
+            exists = await conn.fetchval('select 1 from pg_database where datname=$1', settings.pg_name)
+            if exists:
+                return False
+
+        template = await get_template_db(conn, settings)
+        await conn.execute(DROP_CONNECTIONS, settings.pg_name)
+        await conn.execute(f'drop database if exists {settings.pg_name}')
+        logger.debug('creating database "%s" from template "%s"...', settings.pg_name, template)
+        await conn.execute(f'create database {settings.pg_name} template {template}')
+        # database level settings aren't copied from the template
+        await conn.execute(f"alter database {settings.pg_name} set timezone to 'UTC';")
+    finally:
+        await conn.close()
+    if getattr(settings, 'migrations_dir', None):
+        # the template only depends on settings.sql so migrations are marked on the new database
+        conn = await asyncpg.connect(dsn=settings.pg_dsn)
+        try:
+            await mark_migrations_applied(conn, settings)
+        finally:
+            await conn.close()
+    logger.info('database successfully created from template ✓')
+    return True
+
+
+async def get_template_db(conn, settings: BaseSettings) -> str:
+    """
+    Name of the template database for the current settings.sql, creating it if required. An advisory lock
+    prevents concurrent processes (eg. pytest-xdist workers) creating it at the same time.
+    """
+    sql_hash = hashlib.md5(settings.sql.encode()).hexdigest()
+    template = f'{settings.pg_template_db}_{sql_hash[:12]}'
+    lock_key = int(sql_hash[:15], 16)
+    await conn.execute('select pg_advisory_lock($1)', lock_key)
+    try:
+        if await conn.fetchval('select 1 from pg_database where datname=$1', template):
+            return template
+
+        logger.info('creating template database "%s"...', template)
+        await conn.execute(f'create database {template}')
+        try:
+            template_dsn = urlparse(settings.pg_dsn)._replace(path='/' + template).geturl()
+            template_conn = await asyncpg.connect(dsn=template_dsn)
+            try:
+                async with template_conn.transaction():
+                    await template_conn.execute(settings.sql)
+            finally:
+                await template_conn.close()
+        except BaseException:
+            await conn.execute(f'drop database if exists {template}')
+            raise
+        await _drop_old_templates(conn, settings.pg_template_db, template)
+        return template
+    finally:
+        await conn.execute('select pg_advisory_unlock($1)', lock_key)
+
+
+async def _drop_old_templates(conn, prefix: str, current: str):
+    pattern = prefix.replace('_', r'\_') + r'\_%'
+    old = await conn.fetch('select datname from pg_database where datname like $1 and datname != $2', pattern, current)
+    for (name,) in old:
+        try:
+            await conn.execute(f'drop database {name}')
+        except asyncpg.ObjectInUseError:
+            # being cloned by another process, it'll be dropped next time
+            pass
+        else:
+            logger.info('old template database "%s" dropped', name)
+
+
+def schema_fingerprint(settings: BaseSettings) -> str:
+    return hashlib.md5(getattr(settings, 'sql', '').encode()).hexdigest()
+
+
+async def prepare_pool(settings: BaseSettings):
+    """
+    Create the connection pool, creating the database first if it doesn't exist.
+
+    A fingerprint of settings.sql is stored in the database so when the schema is up to date, as is the case for
+    most boots, this only requires one query on a pool connection, otherwise prepare_database is called.
+    """
+    from .pool import create_pg_pool
+
+    try:
+        pool = await create_pg_pool(settings)
+    except asyncpg.InvalidCatalogNameError:
+        # database doesn't exist
+        await prepare_database(settings, False)
+        pool = await create_pg_pool(settings)
+
+    fingerprint = schema_fingerprint(settings)
+    async with pool.acquire() as conn:
+        try:
+            stored = await conn.fetchval(f"select value from {META_TABLE} where key='schema_fingerprint'")
+        except asyncpg.UndefinedTableError:
+            stored = None
+    if stored == fingerprint:
+        logger.debug('schema fingerprint matches ✓')
+        return pool
+
+    await prepare_database(settings, False)
+    async with pool.acquire() as conn:
+        await conn.execute(CREATE_META_TABLE)
+        await conn.execute(SET_META, 'schema_fingerprint', fingerprint)
+    logger.info('schema fingerprint saved')
+    return pool
+
+
 def reset_database(settings: BaseSettings):
     if not (os.getenv('CONFIRM_DATABASE_RESET') == 'confirm' or input('Confirm database reset? [yN] ') == 'y'):
         print('cancelling')
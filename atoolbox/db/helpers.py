@@ -1,9 +1,18 @@
 import asyncio
 import re
-from typing import Optional
+from collections import defaultdict
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence
 
 from asyncpg import Connection
 
+from . import META_TABLE
+from .migrations import MIGRATIONS_TABLE
+
+# tables TruncatingPgPool doesn't truncate by default, truncating them would make the next run think the
+# database doesn't match settings.sql and migrations haven't been applied
+KEEP_TABLES = META_TABLE, MIGRATIONS_TABLE
+
 
 class TimedLock(asyncio.Lock):
     def __init__(self, *, loop=None, timeout=0.5):
@@ -59,9 +68,13 @@ class _LockedExecute:
 class DummyPgTransaction(_LockedExecute):
     _tr = None
 
+    def __init__(self, conn: Connection, lock: Optional[TimedLock] = None, **kwargs):
+        super().__init__(conn, lock)
+        self._kwargs = kwargs
+
     async def __aenter__(self):
         async with self._lock:
-            self._tr = self._conn.transaction()
+            self._tr = self._conn.transaction(**self._kwargs)
             await self._tr.start()
         return self
 
@@ -75,8 +88,8 @@ class DummyPgTransaction(_LockedExecute):
 
 
 class DummyPgConn(_LockedExecute):
-    def transaction(self):
-        return DummyPgTransaction(self._conn, self._lock)
+    def transaction(self, **kwargs):
+        return DummyPgTransaction(self._conn, self._lock, **kwargs)
 
     def __repr__(self) -> str:
         return f'<DummyPgConn {self._conn._addr} {self._conn._params}>'
@@ -98,9 +111,15 @@ class DummyPgPool(_LockedExecute):
     """
     dummy connection pool useful for testing, only one connection is used, but this will behave like
     Connection or BuildPgConnection, including locking before using the underlying connection.
+
+    Concurrent queries wait for the lock, lock_timeout may need increasing for tests with lots of concurrent
+    queries, or use TruncatingPgPool to run them in parallel.
     """
 
-    def acquire(self):
+    def __init__(self, conn: Connection, *, lock_timeout: float = 0.5):
+        super().__init__(conn, TimedLock(loop=conn._loop, timeout=lock_timeout))
+
+    def acquire(self, *, timeout=None):
         return _ConnAcquire(self._conn, self._lock)
 
     async def close(self):
@@ -118,13 +137,100 @@ class DummyPgPool(_LockedExecute):
         return f'<DummyPgPool {self._conn._addr} {self._conn._params}>'
 
 
-async def update_enums(enums, conn):
+class TruncatingPgPool:
+    """
+    Connection pool for tests which need real concurrent connections, eg. to test locking or for handlers
+    which run queries in parallel.
+
+    A transaction can't span several connections so there's no outer transaction or savepoint per task to roll
+    back like with DummyPgPool: queries are committed and visible to everything else using the database until
+    all tables in the public schema (except keep_tables) are truncated when the pool is closed, eg. by app cleanup.
+    Tests running concurrently against the same database (eg. with pytest-xdist, see xdist_pg_dsn) therefore
+    see each other's rows, only tests which run one after the other are isolated.
+
+    Don't use it alongside an open transaction on the same tables (like the db_conn fixture) or truncating will
+    wait for that transaction.
+    """
+
+    def __init__(self, pool, *, keep_tables: Sequence[str] = KEEP_TABLES):
+        self._pool = pool
+        self.keep_tables = set(keep_tables)
+
+    @classmethod
+    async def create(cls, dsn: str, *, keep_tables: Sequence[str] = KEEP_TABLES, **kwargs) -> 'TruncatingPgPool':
+        from buildpg import asyncpg
+
+        return cls(await asyncpg.create_pool_b(dsn=dsn, **kwargs), keep_tables=keep_tables)
+
+    async def truncate(self):
+        async with self._pool.acquire() as conn:
+            tables = await conn.fetch("SELECT tablename FROM pg_tables WHERE schemaname='public'")
+            tables = [t for t, in tables if t not in self.keep_tables]
+            if tables:
+                names = ', '.join(f'"{t}"' for t in tables)
+                await conn.execute(f'TRUNCATE {names} RESTART IDENTITY CASCADE')
+
+    async def close(self):
+        try:
+            await self.truncate()
+        finally:
+            await self._pool.close()
+
+    def __getattr__(self, item):
+        if item == '_pool':
+            raise AttributeError(item)
+        return getattr(self._pool, item)
+
+    def __repr__(self) -> str:
+        return f'<TruncatingPgPool {self._pool!r}>'
+
+
+async def update_enums(enums, conn) -> Dict[str, List[str]]:
     """
-    update sql enums from python enums, this requires @patch(direct=True) on the patch
+    update sql enums from python enums, this requires @patch(direct=True) on the patch.
+
+    Existing values are fetched from pg_enum in one query and only missing values are added,
+    returns the values added for each enum.
     """
+    existing = defaultdict(set)
+    rows = await conn.fetch(
+        'SELECT n, e.enumlabel FROM unnest($1::text[]) n JOIN pg_enum e ON e.enumtypid = to_regtype(n)', list(enums)
+    )
+    for name, label in rows:
+        existing[name].add(label)
+
+    added = {}
     for name, enum in enums.items():
-        for t in enum:
-            await conn.execute(f"ALTER TYPE {name} ADD VALUE IF NOT EXISTS '{t.value}'")
+        missing = [t.value for t in enum if t.value not in existing[name]]
+        for value in missing:
+            value = value.replace("'", "''")
+            await conn.execute(f"ALTER TYPE {name} ADD VALUE IF NOT EXISTS '{value}'")
+        if missing:
+            added[name] = missing
+    return added
+
+
+_section_start = re.compile(r'^-- *{+ *(\S+)', flags=re.MULTILINE)
+_section_end = re.compile(r'^-- *}+ *(\S+)', flags=re.MULTILINE)
+
+
+@lru_cache(maxsize=16)
+def sql_sections(sql: str) -> Dict[str, str]:
+    """
+    Index of the sections in a sql string, see run_sql_section, the result is cached so each string is only parsed
+    once. If a name is used for more than one section the first start tag and last end tag are used.
+    """
+    starts, ends = {}, {}
+    for m in _section_start.finditer(sql):
+        starts.setdefault(m.group(1), m.end())
+    for m in _section_end.finditer(sql):
+        ends[m.group(1)] = m.start()
+    sections = {}
+    for name, start in starts.items():
+        end = ends.get(name, -1)
+        if end >= start:
+            sections[name] = sql[start:end].strip(' \n')
+    return sections
 
 
 async def run_sql_section(chunk_name, sql, conn):
@@ -134,8 +240,8 @@ async def run_sql_section(chunk_name, sql, conn):
         <sql to run>
         -- } <chunk name>
     """
-    m = re.search(f'^-- *{{+ *{chunk_name}(.*)^-- *}}+ *{chunk_name}', sql, flags=re.DOTALL | re.MULTILINE)
-    if not m:
+    try:
+        section = sql_sections(sql)[chunk_name]
+    except KeyError:
         raise RuntimeError(f'chunk with name "{chunk_name}" not found')
-    sql = m.group(1).strip(' \n')
-    await conn.execute(sql)
+    await conn.execute(section)
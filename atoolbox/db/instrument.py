@@ -0,0 +1,136 @@
+import logging
+import re
+from collections import Counter
+from time import time
+from typing import Optional
+
+from buildpg import render
+
+from ..timing import record
+
+logger = logging.getLogger('atoolbox.db')
+MAX_PARAMS_LENGTH = 500
+
+
+class InstrumentedConnection:
+    """
+    Wrapper for a connection (or DummyPgConn) used by pg_middleware which times every query, recording the
+    total as the "db" phase of the request, logs slow queries and counts queries by statement.
+
+    The "_b" methods render the query with buildpg then call the instrumented methods, anything
+    else (eg. transaction()) is passed straight to the underlying connection. Slow queries are logged without
+    their parameters, which may contain personal data, unless log_params is set.
+    """
+
+    def __init__(self, conn, *, slow_threshold: Optional[float] = None, log_params: bool = False):
+        self._conn = conn
+        self.slow_threshold = slow_threshold
+        self.log_params = log_params
+        self.queries = Counter()
+
+    async def _run(self, method: str, query: str, args, **kwargs):
+        start = time()
+        try:
+            return await getattr(self._conn, method)(query, *args, **kwargs)
+        finally:
+            duration = time() - start
+            record('db', duration)
+            self.queries[query] += 1
+            if self.slow_threshold is not None and duration > self.slow_threshold:
+                self._log_slow(duration, query, args)
+
+    def _log_slow(self, duration: float, query: str, args):
+        if self.log_params:
+            params = repr(args)
+            if len(params) > MAX_PARAMS_LENGTH:
+                params = params[:MAX_PARAMS_LENGTH] + '...'
+            logger.warning('slow query %0.0fms params: %s query:\n%s', duration * 1000, params, query.strip())
+        else:
+            logger.warning('slow query %0.0fms query:\n%s', duration * 1000, query.strip())
+
+    async def execute(self, query: str, *args, timeout: float = None):
+        return await self._run('execute', query, args, timeout=timeout)
+
+    async def executemany(self, query: str, args, *, timeout: float = None):
+        return await self._run('executemany', query, (args,), timeout=timeout)
+
+    async def fetch(self, query: str, *args, timeout: float = None):
+        return await self._run('fetch', query, args, timeout=timeout)
+
+    async def fetchval(self, query: str, *args, column=0, timeout: float = None):
+        return await self._run('fetchval', query, args, column=column, timeout=timeout)
+
+    async def fetchrow(self, query: str, *args, timeout: float = None):
+        return await self._run('fetchrow', query, args, timeout=timeout)
+
+    async def execute_b(self, query_template, *, _timeout: float = None, print_=False, **kwargs):
+        query, args = _render(query_template, print_, kwargs)
+        return await self.execute(query, *args, timeout=_timeout)
+
+    async def executemany_b(self, query_template, args, *, timeout: float = None, print_=False):
+        query, _ = _render(query_template, print_, {'values': args[0]})
+        return await self.executemany(query, [render.get_params(a) for a in args], timeout=timeout)
+
+    async def fetch_b(self, query_template, *, _timeout: float = None, print_=False, **kwargs):
+        query, args = _render(query_template, print_, kwargs)
+        return await self.fetch(query, *args, timeout=_timeout)
+
+    async def fetchval_b(self, query_template, *, _timeout: float = None, _column=0, print_=False, **kwargs):
+        query, args = _render(query_template, print_, kwargs)
+        return await self.fetchval(query, *args, column=_column, timeout=_timeout)
+
+    async def fetchrow_b(self, query_template, *, _timeout: float = None, print_=False, **kwargs):
+        query, args = _render(query_template, print_, kwargs)
+        return await self.fetchrow(query, *args, timeout=_timeout)
+
+    def repeated_queries(self, threshold: int) -> Counter:
+        """
+        Statements run more than threshold times, queries are grouped after replacing literals and parameters
+        so "WHERE id=1" and "WHERE id=2" count as the same statement.
+        """
+        shapes = Counter()
+        for query, count in self.queries.items():
+            shapes[query_shape(query)] += count
+        return Counter({q: c for q, c in shapes.items() if c > threshold})
+
+    def __getattr__(self, item):
+        if item == '_conn':
+            raise AttributeError(item)
+        return getattr(self._conn, item)
+
+    def __repr__(self) -> str:
+        return f'<InstrumentedConnection {self._conn!r} queries={sum(self.queries.values())}>'
+
+
+def _render(query_template: str, print_, kwargs):
+    """
+    Render a buildpg query template, print_ is True to print the query or a function to call with it,
+    like the "_b" methods of buildpg connections.
+    """
+    query, args = render(query_template, **kwargs)
+    if print_:
+        (print_ if callable(print_) else print)(f'params: {args} query:\n{query.strip()}')
+    return query, args
+
+
+_shape_subs = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\$\d+|\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\?(?:\s*,\s*\?)+'), '?'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def query_shape(query: str) -> str:
+    for regex, repl in _shape_subs:
+        query = regex.sub(repl, query)
+    return query.strip()
+
+
+def log_repeated_queries(request, conn: InstrumentedConnection, threshold: Optional[int]):
+    if threshold is None:
+        return
+    for query, count in conn.repeated_queries(threshold).items():
+        logger.warning(
+            '%s %s ran the same query %d times, possible N+1 query:\n%s', request.method, request.path, count, query
+        )
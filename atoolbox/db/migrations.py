@@ -0,0 +1,162 @@
+"""
+Tracked incremental migrations.
+
+Migrations are sql files in settings.migrations_dir named "<number>_<description>.sql", eg. "0003_add_user_email.sql",
+they're applied in order of number and recorded in the atoolbox_migrations table so each is only applied once.
+settings.sql should always contain the full current schema, when a database is created from it all migrations
+are marked as applied.
+
+Migrations run in a transaction unless the file starts with "-- no-transaction", eg. for
+"CREATE INDEX CONCURRENTLY", statements in these files are run one at a time and should be safe to rerun
+(eg. use "IF NOT EXISTS") since a failed migration may have been partially applied.
+"""
+import asyncio
+import logging
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from time import time
+from typing import List, Optional
+
+from ..settings import BaseSettings
+
+logger = logging.getLogger('atoolbox.db')
+MIGRATIONS_TABLE = 'atoolbox_migrations'
+CREATE_MIGRATIONS_TABLE = f"""
+create table if not exists {MIGRATIONS_TABLE} (
+  id int primary key,
+  name varchar(255) not null,
+  applied timestamptz not null default current_timestamp,
+  duration float
+)
+"""
+NO_TRANSACTION = '-- no-transaction'
+# arbitrary key for the advisory lock preventing more than one process migrating at the same time
+LOCK_KEY = 8_136_720_451
+_file_regex = re.compile(r'^(\d+)_(.+)\.sql$')
+_dollar_quote_regex = re.compile(r'\$(?:[a-zA-Z_][a-zA-Z0-9_]*)?\$')
+
+
+@dataclass
+class Migration:
+    id: int
+    name: str
+    sql: str
+
+    @property
+    def transaction(self) -> bool:
+        return not self.sql.lstrip().startswith(NO_TRANSACTION)
+
+    def statements(self) -> List[str]:
+        """
+        Split sql into statements, statements must end with ";" at the end of a line, dollar quoted strings
+        (eg. function bodies quoted with "$$" or "$tag$") are respected.
+        """
+        statements, current, quote = [], [], None
+        for line in self.sql.splitlines():
+            current.append(line)
+            for m in _dollar_quote_regex.finditer(line):
+                if quote is None:
+                    quote = m.group()
+                elif m.group() == quote:
+                    quote = None
+            if quote is None and line.rstrip().endswith(';'):
+                statements.append('\n'.join(current).strip())
+                current = []
+        sql = '\n'.join(current).strip()
+        if sql:
+            statements.append(sql)
+        return [s for s in statements if not all(line.lstrip().startswith('--') for line in s.splitlines())]
+
+
+def load_migrations(directory: Optional[Path]) -> List[Migration]:
+    if not directory:
+        return []
+    migrations = {}
+    for path in Path(directory).iterdir():
+        m = _file_regex.match(path.name)
+        if not m:
+            continue
+        id_ = int(m.group(1))
+        if id_ in migrations:
+            raise RuntimeError(f'duplicate migration number {id_}: "{migrations[id_].name}" and "{path.name}"')
+        migrations[id_] = Migration(id=id_, name=path.name, sql=path.read_text())
+    return sorted(migrations.values(), key=lambda m: m.id)
+
+
+async def pending_migrations(conn, migrations: List[Migration]) -> List[Migration]:
+    await conn.execute(CREATE_MIGRATIONS_TABLE)
+    applied = {r[0] for r in await conn.fetch(f'select id from {MIGRATIONS_TABLE}')}
+    return [m for m in migrations if m.id not in applied]
+
+
+async def mark_migrations_applied(conn, settings: BaseSettings):
+    """
+    Record all migrations as applied without running them, used when a database is created from settings.sql.
+    """
+    migrations = load_migrations(getattr(settings, 'migrations_dir', None))
+    await conn.execute(CREATE_MIGRATIONS_TABLE)
+    await conn.executemany(
+        f'insert into {MIGRATIONS_TABLE} (id, name) values ($1, $2) on conflict (id) do nothing',
+        [(m.id, m.name) for m in migrations],
+    )
+
+
+async def apply_migrations(conn, settings: BaseSettings, *, live: bool = True) -> List[Migration]:
+    """
+    Apply pending migrations, or if not live just log them. An advisory lock is held while migrating so if several
+    processes (eg. dynos on deploy) migrate at once the others wait then find nothing to do.
+
+    Returns the pending migrations.
+    """
+    migrations = load_migrations(getattr(settings, 'migrations_dir', None))
+    if not migrations:
+        return []
+
+    await conn.execute('select pg_advisory_lock($1)', LOCK_KEY)
+    try:
+        pending = await pending_migrations(conn, migrations)
+        if not pending:
+            logger.debug('no pending migrations ✓')
+        elif not live:
+            logger.info('%d pending migrations, not live: %s', len(pending), ', '.join(m.name for m in pending))
+        else:
+            for migration in pending:
+                await _apply(conn, migration)
+        return pending
+    finally:
+        await conn.execute('select pg_advisory_unlock($1)', LOCK_KEY)
+
+
+async def _apply(conn, migration: Migration):
+    logger.info('applying migration %s...', migration.name)
+    start = time()
+    record = f'insert into {MIGRATIONS_TABLE} (id, name, duration) values ($1, $2, $3)'
+    if migration.transaction:
+        async with conn.transaction():
+            await conn.execute(migration.sql)
+            await conn.execute(record, migration.id, migration.name, time() - start)
+    else:
+        for statement in migration.statements():
+            await conn.execute(statement)
+        await conn.execute(record, migration.id, migration.name, time() - start)
+    logger.info('migration %s applied in %0.2fs', migration.name, time() - start)
+
+
+def migrate(settings: BaseSettings, live: bool) -> int:
+    """
+    Entry point for the "migrate" command.
+    """
+    from .connection import lenient_conn
+
+    async def run():
+        conn = await lenient_conn(settings)
+        try:
+            await apply_migrations(conn, settings, live=live)
+        except Exception:
+            logger.exception('error applying migrations')
+            return 1
+        finally:
+            await conn.close()
+
+    return asyncio.get_event_loop().run_until_complete(run()) or 0
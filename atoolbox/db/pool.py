@@ -0,0 +1,169 @@
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from time import time
+from typing import Deque, Optional
+
+from buildpg import asyncpg
+from buildpg.asyncpg import BuildPgPool
+
+logger = logging.getLogger('atoolbox.db')
+
+
+async def create_pg_pool(settings, *, dsn: str = None):
+    """
+    Create a connection pool using the "pg_pool_*" settings, wrapped in AdaptivePool if settings.pg_pool_adaptive.
+    dsn defaults to settings.pg_dsn.
+
+    settings may be any pydantic settings class with pg_dsn, missing pool settings use the defaults from BaseSettings.
+    """
+    min_size = getattr(settings, 'pg_pool_min_size', 2)
+    max_size = getattr(settings, 'pg_pool_max_size', 10)
+    pool = await asyncpg.create_pool_b(
+        dsn=dsn or settings.pg_dsn,
+        min_size=min_size,
+        max_size=max_size,
+        max_inactive_connection_lifetime=getattr(settings, 'pg_pool_max_inactive_connection_lifetime', 300.0),
+        command_timeout=getattr(settings, 'pg_command_timeout', None),
+        statement_cache_size=getattr(settings, 'pg_statement_cache_size', 100),
+    )
+    if not getattr(settings, 'pg_pool_adaptive', False):
+        return pool
+
+    share = getattr(settings, 'pg_pool_connection_share', None)
+    if share:
+        max_size = min(max_size, await connection_share(pool, share))
+    adaptive_pool = AdaptivePool(
+        pool,
+        min_size=min(min_size, max_size),
+        max_size=max_size,
+        acquire_target=getattr(settings, 'pg_pool_acquire_target', 0.05),
+    )
+    logger.info('adaptive pg pool, size %d to %d', adaptive_pool.min_size, adaptive_pool.max_size)
+    return adaptive_pool
+
+
+async def connection_share(pool: BuildPgPool, share: float) -> int:
+    """
+    Number of connections corresponding to "share" of the connections postgres makes available to normal users.
+    """
+    max_connections = int(await pool.fetchval('SHOW max_connections'))
+    reserved = int(await pool.fetchval('SHOW superuser_reserved_connections'))
+    return max(1, int((max_connections - reserved) * share))
+
+
+class AdaptivePool:
+    """
+    Wrapper for an asyncpg pool which limits the number of connections in use, the limit grows by one whenever
+    acquiring a connection takes longer than acquire_target and shrinks by one every shrink_interval seconds
+    in which fewer connections than the limit were used.
+
+    Connections are only opened by the underlying pool when needed and idle connections are closed after
+    its max_inactive_connection_lifetime, so the number of open connections follows the limit.
+    """
+
+    def __init__(
+        self,
+        pool: BuildPgPool,
+        *,
+        min_size: int = 2,
+        max_size: int = 10,
+        acquire_target: float = 0.05,
+        shrink_interval: float = 10,
+    ):
+        self.pool = pool
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_target = acquire_target
+        self.shrink_interval = shrink_interval
+        self.limit = min_size
+        self.in_use = 0
+        self._peak = 0
+        self._last_shrink = time()
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @asynccontextmanager
+    async def acquire(self, *, timeout: Optional[float] = None):
+        start = time()
+        await self._take_slot(timeout)
+        try:
+            if timeout is not None:
+                timeout = max(timeout - (time() - start), 0.001)
+            async with self.pool.acquire(timeout=timeout) as conn:
+                yield conn
+        finally:
+            self._release_slot()
+
+    async def _take_slot(self, timeout: Optional[float]):
+        if self.in_use < self.limit and not self._waiters:
+            self._use_slot()
+            return
+
+        fut = asyncio.get_event_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            if timeout is None or timeout > self.acquire_target:
+                try:
+                    await asyncio.wait_for(asyncio.shield(fut), self.acquire_target)
+                    return
+                except asyncio.TimeoutError:
+                    self._grow()
+                    if timeout is not None:
+                        timeout -= self.acquire_target
+            await asyncio.wait_for(fut, timeout)
+        except BaseException:
+            self._abandon(fut)
+            raise
+
+    def _abandon(self, fut: asyncio.Future):
+        if fut.done() and not fut.cancelled():
+            # we were given a slot but won't use it
+            self._release_slot()
+        else:
+            fut.cancel()
+            try:
+                self._waiters.remove(fut)
+            except ValueError:
+                pass
+
+    def _use_slot(self):
+        self.in_use += 1
+        self._peak = max(self._peak, self.in_use)
+
+    def _grow(self):
+        if self.limit < self.max_size:
+            self.limit += 1
+            logger.debug('pg pool limit increased to %d', self.limit)
+            self._wake()
+
+    def _release_slot(self):
+        self.in_use -= 1
+        now = time()
+        if now - self._last_shrink > self.shrink_interval:
+            if self._peak < self.limit and self.limit > self.min_size:
+                self.limit -= 1
+                logger.debug('pg pool limit decreased to %d', self.limit)
+            self._peak = self.in_use
+            self._last_shrink = now
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.in_use < self.limit:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self._use_slot()
+                fut.set_result(None)
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def __getattr__(self, item):
+        # everything else, eg. close(), fetchval(), get_size() uses the underlying pool
+        if item == 'pool':
+            raise AttributeError(item)
+        return getattr(self.pool, item)
+
+    def __repr__(self) -> str:
+        return f'<AdaptivePool limit={self.limit} in_use={self.in_use} waiting={self.waiting}>'
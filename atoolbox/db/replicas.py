@@ -0,0 +1,84 @@
+import asyncio
+import logging
+from typing import Iterable, List, Optional
+
+from aiohttp import web
+
+from ..metrics import MetricFamily, pg_pool_stats
+from .pool import create_pg_pool
+
+logger = logging.getLogger('atoolbox.db')
+
+
+def read_only(func):
+    """
+    Decorator to mark a handler, View.call or Bread method as read only, GET and HEAD requests to it may use
+    a connection to a read replica (see settings.pg_replica_dsns).
+    """
+    func.read_only = True
+    return func
+
+
+class ReplicaPools:
+    """
+    Connection pools for read replicas, choose() returns the healthy pool with the fewest connections in use,
+    starting from a different pool each time so pools with the same usage are used in turn.
+    """
+
+    def __init__(self, pools: List, *, health_timeout: float = 2):
+        self.pools = pools
+        self.health_timeout = health_timeout
+        self.healthy = [True] * len(pools)
+        self._next = 0
+
+    def choose(self):
+        """
+        Returns the pool to use or None if no replica is healthy.
+        """
+        best, best_in_use = None, None
+        count = len(self.pools)
+        for i in range(self._next, self._next + count):
+            i %= count
+            if not self.healthy[i]:
+                continue
+            stats = pg_pool_stats(self.pools[i])
+            in_use = stats['size'] - stats['idle'] + stats['waiters'] if stats else 0
+            if best is None or in_use < best_in_use:
+                best, best_in_use = i, in_use
+        self._next = (self._next + 1) % count
+        return None if best is None else self.pools[best]
+
+    async def check_health(self):
+        for i, pool in enumerate(self.pools):
+            try:
+                await pool.fetchval('SELECT 1', timeout=self.health_timeout)
+            except Exception as e:
+                if self.healthy[i]:
+                    logger.warning('replica %d unhealthy, %s: %s', i, e.__class__.__name__, e)
+                self.healthy[i] = False
+            else:
+                if not self.healthy[i]:
+                    logger.info('replica %d healthy again', i)
+                self.healthy[i] = True
+
+    async def health_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.check_health()
+
+    def metrics(self, app: web.Application) -> Iterable[MetricFamily]:
+        name = 'atoolbox_pg_replica_healthy'
+        samples = [(name, {'replica': str(i)}, int(h)) for i, h in enumerate(self.healthy)]
+        yield MetricFamily(name, 'gauge', 'Whether each postgres read replica is healthy.', samples)
+
+    async def close(self):
+        await asyncio.gather(*(pool.close() for pool in self.pools))
+
+
+async def create_replica_pools(settings) -> Optional[ReplicaPools]:
+    dsns = getattr(settings, 'pg_replica_dsns', None)
+    if not dsns:
+        return None
+    pools = await asyncio.gather(*(create_pg_pool(settings, dsn=dsn) for dsn in dsns))
+    logger.info('%d read replica pools created', len(pools))
+    return ReplicaPools(list(pools))
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import random
+from typing import Optional, Union
+
+from asyncpg import DeadlockDetectedError, SerializationError
+
+from ..middleware import READ_METHODS, deadline_remaining, run_commit_hooks
+from ..timing import record
+
+logger = logging.getLogger('atoolbox.db')
+RETRYABLE_ERRORS = SerializationError, DeadlockDetectedError
+
+
+def atomic(isolation: str = None):
+    """
+    Decorator to run a handler, View.call or Bread method in a transaction, it's retried if the transaction fails
+    with a serialization error or deadlock. See also settings.pg_atomic_requests.
+
+    :param isolation: transaction isolation level, eg. "serializable", defaults to settings.pg_atomic_isolation
+    """
+
+    def wrapper(func):
+        func.atomic = isolation or True
+        return func
+
+    return wrapper
+
+
+def request_isolation(request, settings) -> Optional[str]:
+    """
+    Isolation level to use for the request's transaction or None if it shouldn't be wrapped in a transaction.
+    """
+    atomic_: Union[bool, str] = getattr(request.match_info.handler, 'atomic', False)
+    if not atomic_:
+        if not getattr(settings, 'pg_atomic_requests', False) or request.method in READ_METHODS:
+            return None
+    if isinstance(atomic_, str):
+        return atomic_
+    return getattr(settings, 'pg_atomic_isolation', 'read_committed')
+
+
+async def run_handler(request, handler, conn, settings):
+    """
+    Run handler, in a transaction if required by request_isolation, retrying with jittered exponential backoff
+    on serialization errors and deadlocks as long as there's time left before the request's deadline.
+
+    Callbacks registered with after_commit during an attempt only run if that attempt commits.
+    """
+    isolation = request_isolation(request, settings)
+    if isolation is None:
+        return await handler(request)
+
+    retries = getattr(settings, 'pg_atomic_retries', 3)
+    retry_delay = getattr(settings, 'pg_atomic_retry_delay', 0.02)
+    attempt = 0
+    while True:
+        try:
+            return await _attempt(request, handler, conn, isolation)
+        except RETRYABLE_ERRORS as e:
+            attempt += 1
+            delay = retry_delay * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            remaining = deadline_remaining(request)
+            if attempt > retries or (remaining is not None and remaining < delay):
+                raise
+            logger.info(
+                '%s %s transaction failed with %s, retry %d in %0.0fms',
+                request.method,
+                request.path,
+                e.__class__.__name__,
+                attempt,
+                delay * 1000,
+            )
+            record('pg-retry', delay)
+            await asyncio.sleep(delay)
+
+
+async def _attempt(request, handler, conn, isolation: str):
+    hooks = request['pg_commit_hooks'] = []
+    try:
+        async with conn.transaction(isolation=isolation):
+            response = await handler(request)
+    except BaseException:
+        request['pg_commit_hooks'] = None
+        await run_commit_hooks(hooks, committed=False)
+        raise
+    request['pg_commit_hooks'] = None
+    await run_commit_hooks(hooks, committed=True)
+    return response
@@ -57,6 +57,15 @@ class JsonErrors:
     class HTTPConflict(_HTTPExceptionJson):
         status_code = 409
 
+    class HTTPUnprocessableEntity(_HTTPExceptionJson):
+        status_code = 422
+
+    class HTTPTooManyRequests(_HTTPExceptionJson):
+        status_code = 429
+
+    class HTTPServiceUnavailable(_HTTPExceptionJson):
+        status_code = 503
+
     class HTTP470(_HTTPExceptionJson):
         status_code = 470
         custom_reason = 'Invalid user input'
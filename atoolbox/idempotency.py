@@ -0,0 +1,127 @@
+import asyncio
+import hashlib
+import logging
+from functools import partial
+from typing import Awaitable, Callable, Optional, Tuple
+
+from aiohttp.web_response import Response
+
+from .exceptions import JsonErrors
+from .middleware import after_commit
+from .rate_limit import ip_key, user_key
+from .settings import BaseSettings
+from .utils import response_from_bytes, response_to_bytes
+
+logger = logging.getLogger('atoolbox.idempotency')
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IN_FLIGHT = b'in-flight'
+DONE = b'done'
+POLL_INTERVAL = 0.05
+
+
+async def idempotent(request, func: Callable[[], Awaitable[Response]]) -> Response:
+    """
+    Run func to generate the response to request, unless the request has an "Idempotency-Key" header and a request
+    with the same key has already been processed, in which case the stored response is returned.
+
+    Keys are scoped to the caller: the session's user or the client's IP address without a session.
+    While the first request is in progress, duplicates wait for it to finish and then return its response.
+    If the first request fails or returns a 5xx response nothing is stored so retries run func again, if it's
+    cancelled (eg. the client disconnected) func still finishes and its response is stored.
+
+    Requires redis, if it's not available func is always called.
+    """
+    idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+    redis = request.app.get('redis')
+    if not idempotency_key or redis is None:
+        return await func()
+
+    settings: BaseSettings = request.app['settings']
+    fingerprint = hashlib.blake2b(await request.read(), digest_size=16).hexdigest().encode()
+    caller = await caller_key(request)
+    redis_key = f'idempotency:{caller}:{request.method}:{request.path}:{idempotency_key}'
+    loop = asyncio.get_event_loop()
+    wait_until = loop.time() + settings.idempotency_wait
+    while True:
+        locked = await redis.set(
+            redis_key,
+            IN_FLIGHT + b':' + fingerprint,
+            expire=settings.idempotency_lock_timeout,
+            exist=redis.SET_IF_NOT_EXIST,
+        )
+        if locked:
+            return await _run(request, redis, redis_key, fingerprint, func, settings)
+
+        stored = await redis.get(redis_key)
+        if stored is None:
+            # the first request failed and released the key, try again
+            continue
+
+        stored_fingerprint, stored_response = _parse(stored)
+        if stored_fingerprint != fingerprint:
+            raise JsonErrors.HTTPUnprocessableEntity(
+                f'{IDEMPOTENCY_HEADER} has already been used with a different request body'
+            )
+
+        if stored_response is not None:
+            logger.info('replaying response for %s %s key=%s', request.method, request.path, idempotency_key)
+            response = response_from_bytes(stored_response)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        if loop.time() > wait_until:
+            raise JsonErrors.HTTPConflict(f'A request with this {IDEMPOTENCY_HEADER} is still being processed')
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+async def caller_key(request) -> str:
+    try:
+        return await user_key(request)
+    except (ImportError, RuntimeError):
+        # aiohttp_session isn't installed or session middleware isn't used
+        return await ip_key(request)
+
+
+def _parse(stored: bytes) -> Tuple[bytes, Optional[bytes]]:
+    """
+    Returns the request fingerprint and the stored response or None if the request is still in flight.
+    """
+    state, stored = stored.split(b':', 1)
+    if state == IN_FLIGHT:
+        return stored, None
+    fingerprint, response = stored.split(b'\n', 1)
+    return fingerprint, response
+
+
+async def _run(request, redis, redis_key: str, fingerprint: bytes, func, settings: BaseSettings) -> Response:
+    task = asyncio.ensure_future(func())
+    try:
+        response = await asyncio.shield(task)
+    except asyncio.CancelledError:
+        # keep the key in flight until func finishes, otherwise a retry could repeat the work
+        try:
+            response = await task
+        except Exception:
+            await redis.delete(redis_key)
+        else:
+            await _store(request, redis, redis_key, fingerprint, response, settings)
+        raise
+    except Exception:
+        await redis.delete(redis_key)
+        raise
+
+    await _store(request, redis, redis_key, fingerprint, response, settings)
+    return response
+
+
+async def _store(request, redis, redis_key: str, fingerprint: bytes, response: Response, settings: BaseSettings):
+    if response.status >= 500 or not isinstance(response.body, bytes):
+        await redis.delete(redis_key)
+    else:
+        stored = DONE + b':' + fingerprint + b'\n' + response_to_bytes(response)
+        # in a transaction which is rolled back (and maybe retried) the response must not be replayed
+        await after_commit(
+            request,
+            partial(redis.set, redis_key, stored, expire=settings.idempotency_ttl),
+            partial(redis.delete, redis_key),
+        )
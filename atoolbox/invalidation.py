@@ -0,0 +1,182 @@
+import asyncio
+import inspect
+import json
+import logging
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from uuid import uuid4
+
+from aiohttp import web
+
+logger = logging.getLogger('atoolbox.invalidation')
+CHANNEL = 'atoolbox_invalidate'
+# subscribers to this topic are called for every message
+ALL_TOPICS = '*'
+InvalidateCallback = Callable[[str, Optional[str]], Any]
+
+
+def _payload(topic: str, key: Any, origin: Optional[str]) -> str:
+    data = {'topic': topic, 'key': None if key is None else str(key)}
+    if origin:
+        data['origin'] = origin
+    return json.dumps(data)
+
+
+async def publish_invalidation(
+    topic: str, key: Any = None, *, conn=None, redis=None, channel: str = CHANNEL, origin: str = None
+):
+    """
+    Tell all processes to invalidate cached data for topic (eg. a table name) and optionally key (eg. a primary key),
+    key None means everything for the topic.
+
+    With conn the message is sent with postgres NOTIFY, if conn is in a transaction the message is only delivered
+    when it commits, otherwise redis must be given and the message is published immediately. This can be used
+    without an app, eg. in patches. origin identifies the InvalidationHub which published the message.
+    """
+    payload = _payload(topic, key, origin)
+    if conn is not None:
+        await conn.execute('SELECT pg_notify($1, $2)', channel, payload)
+    else:
+        await redis.publish(channel, payload)
+
+
+class InvalidationHub:
+    """
+    Receives invalidation messages from other processes (and this one) with postgres LISTEN or a redis
+    subscription and calls the callbacks subscribed to the message's topic.
+
+    Messages may be lost while the listening connection is down, so after reconnecting all callbacks are called
+    with key None to invalidate everything.
+    """
+
+    def __init__(self, backend: str, *, channel: str = CHANNEL, reconnect_interval: float = 5):
+        assert backend in {'pg', 'redis'}, f'invalid invalidation backend {backend!r}'
+        self.backend = backend
+        self.channel = channel
+        self.reconnect_interval = reconnect_interval
+        # callbacks and whether they ignore messages published by this hub
+        self.subscribers: Dict[str, List[Tuple[InvalidateCallback, bool]]] = defaultdict(list)
+        self.origin = uuid4().hex
+        self.received = 0
+        self._app: Optional[web.Application] = None
+        self._conn = None
+        self._task: Optional[asyncio.Task] = None
+        self._dispatching: Set[asyncio.Future] = set()
+
+    def subscribe(self, topic: str, callback: InvalidateCallback, *, ignore_own: bool = False):
+        """
+        Call callback(topic, key) for messages about topic, use ALL_TOPICS to receive every message,
+        callback may be a coroutine function. With ignore_own callback isn't called for messages published by this
+        hub, eg. when the subscriber has already updated its own state.
+        """
+        self.subscribers[topic].append((callback, ignore_own))
+
+    async def publish(self, topic: str, key: Any = None, *, conn=None):
+        """
+        Publish a message, with the pg backend conn may be given to send the message as part of its transaction.
+        """
+        if self.backend == 'pg':
+            if conn is None:
+                async with self._app['pg'].acquire() as conn:
+                    await publish_invalidation(topic, key, conn=conn, channel=self.channel, origin=self.origin)
+            else:
+                await publish_invalidation(topic, key, conn=conn, channel=self.channel, origin=self.origin)
+        else:
+            redis = self._app['redis']
+            await publish_invalidation(topic, key, redis=redis, channel=self.channel, origin=self.origin)
+
+    async def dispatch(self, topic: str, key: Optional[str], origin: str = None):
+        self.received += 1
+        own = origin == self.origin
+        for callback, ignore_own in self.subscribers.get(topic, []) + self.subscribers.get(ALL_TOPICS, []):
+            if own and ignore_own:
+                continue
+            try:
+                r = callback(topic, key)
+                if inspect.isawaitable(r):
+                    await r
+            except Exception:
+                logger.exception('error invalidating topic=%r key=%r with %r', topic, key, callback)
+
+    async def invalidate_all(self):
+        topics = [t for t in self.subscribers if t != ALL_TOPICS]
+        for topic in topics or [ALL_TOPICS]:
+            await self.dispatch(topic, None)
+
+    def _on_message(self, payload: str):
+        try:
+            data = json.loads(payload)
+            topic, key, origin = data['topic'], data['key'], data.get('origin')
+        except (ValueError, KeyError, TypeError, AttributeError):
+            logger.warning('invalid invalidation message %r', payload)
+        else:
+            task = asyncio.ensure_future(self.dispatch(topic, key, origin))
+            self._dispatching.add(task)
+            task.add_done_callback(self._dispatching.discard)
+
+    async def start(self, app: web.Application):
+        self._app = app
+        await self._listen()
+        self._task = asyncio.ensure_future(self._watch())
+
+    async def _listen(self):
+        if self.backend == 'pg':
+            from buildpg import asyncpg
+
+            self._conn = await asyncpg.connect_b(dsn=self._app['settings'].pg_dsn)
+            await self._conn.add_listener(self.channel, lambda conn, pid, channel, payload: self._on_message(payload))
+        else:
+            self._conn, = await self._app['redis'].subscribe(self.channel)
+
+    async def _watch(self):
+        """
+        Read redis messages or check the postgres connection is still open, reconnecting when the connection
+        is lost or fails until the hub is closed.
+        """
+        while True:
+            try:
+                await self._wait_closed()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('error in invalidation %s listener, reconnecting', self.backend)
+            else:
+                logger.warning('invalidation %s connection lost, reconnecting', self.backend)
+
+            await asyncio.sleep(self.reconnect_interval)
+            try:
+                await self._listen()
+            except Exception as e:
+                logger.warning('error reconnecting invalidation listener, %s: %s', e.__class__.__name__, e)
+            else:
+                await self.invalidate_all()
+
+    async def _wait_closed(self):
+        if self.backend == 'redis':
+            while await self._conn.wait_message():
+                self._on_message(await self._conn.get(encoding='utf8'))
+        else:
+            while not self._conn.is_closed():
+                await asyncio.sleep(self.reconnect_interval)
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        for task in self._dispatching:
+            task.cancel()
+        if self.backend == 'pg':
+            if self._conn and not self._conn.is_closed():
+                await self._conn.close()
+        elif self._conn:
+            redis = self._app['redis']
+            if not redis.closed:
+                await redis.unsubscribe(self.channel)
+
+
+async def invalidate(app: web.Application, topic: str, key: Any = None, *, conn=None):
+    """
+    Publish an invalidation message if the app has an invalidation hub (see settings.invalidation_backend).
+    """
+    hub: Optional[InvalidationHub] = app.get('invalidation')
+    if hub:
+        await hub.publish(topic, key, conn=conn)
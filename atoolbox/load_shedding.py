@@ -0,0 +1,160 @@
+import asyncio
+import logging
+from collections import deque
+from time import time
+from typing import Deque, Iterable
+
+from aiohttp import web
+from aiohttp.web_exceptions import HTTPException
+from aiohttp.web_middlewares import middleware
+
+from .exceptions import JsonErrors
+from .metrics import MetricFamily, gauge
+from .middleware import _path_match
+from .settings import BaseSettings
+
+logger = logging.getLogger('atoolbox.load_shedding')
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit which adapts to observed latency using AIMD (additive increase, multiplicative decrease):
+    while requests complete within target_latency the limit grows by roughly one per "limit" requests,
+    when they don't it's multiplied by backoff, at most once per target_latency.
+
+    Requests beyond the limit wait in a bounded queue for up to queue_timeout seconds.
+    """
+
+    def __init__(
+        self,
+        *,
+        initial_limit: int = 20,
+        min_limit: int = 2,
+        max_limit: int = 200,
+        target_latency: float = 0.5,
+        queue_size: int = 50,
+        queue_timeout: float = 1.0,
+        backoff: float = 0.9,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.backoff = backoff
+        self.in_flight = 0
+        self.shed = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._last_decrease = 0
+
+    async def acquire(self) -> bool:
+        """
+        Wait for a slot, returns False if the request should be shed.
+        """
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return True
+
+        if len(self._waiters) >= self.queue_size:
+            self.shed += 1
+            return False
+
+        fut = asyncio.get_event_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await asyncio.wait_for(fut, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.shed += 1
+            return False
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # we were given a slot but won't use it
+                self._release_slot()
+            raise
+        finally:
+            if not fut.done():
+                fut.cancel()
+            if fut.cancelled():
+                try:
+                    self._waiters.remove(fut)
+                except ValueError:
+                    pass
+        # in_flight was incremented when the slot was handed over
+        return True
+
+    def release(self, latency: float, *, failed: bool = False) -> None:
+        if failed or latency > self.target_latency:
+            now = time()
+            if now - self._last_decrease > self.target_latency:
+                self._last_decrease = now
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._release_slot()
+
+    def _release_slot(self):
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < self.limit:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self.in_flight += 1
+                fut.set_result(None)
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def metrics(self, app: web.Application) -> Iterable[MetricFamily]:
+        yield gauge('atoolbox_concurrency_limit', 'Adaptive concurrency limit.', self.limit)
+        yield gauge('atoolbox_concurrency_queued', 'Requests waiting for a concurrency slot.', self.queued)
+        name = 'atoolbox_load_shed_total'
+        yield MetricFamily(name, 'counter', 'Requests rejected by load shedding.', [(name, {}, self.shed)])
+
+    @classmethod
+    def from_settings(cls, settings: BaseSettings) -> 'AdaptiveLimiter':
+        return cls(
+            initial_limit=settings.load_shedding_initial_limit,
+            min_limit=settings.load_shedding_min_limit,
+            max_limit=settings.load_shedding_max_limit,
+            target_latency=settings.load_shedding_target_latency,
+            queue_size=settings.load_shedding_queue_size,
+            queue_timeout=settings.load_shedding_queue_timeout,
+        )
+
+    def __repr__(self) -> str:
+        return f'<AdaptiveLimiter limit={self.limit:0.1f} in_flight={self.in_flight} queued={self.queued}>'
+
+
+@middleware
+async def load_shedding_middleware(request, handler):
+    """
+    Limit concurrent requests using app['limiter'], requests which can't get a slot in time get a fast 503.
+
+    This should come before error_middleware so shed requests aren't reported as errors and before pg_middleware
+    so they never wait for a database connection.
+    """
+    settings: BaseSettings = request.app['settings']
+    if _path_match(request, settings.load_shedding_exempt_paths):
+        return await handler(request)
+
+    limiter: AdaptiveLimiter = request.app['limiter']
+    if not await limiter.acquire():
+        logger.info('load shedding %s %s, %r', request.method, request.path, limiter)
+        raise JsonErrors.HTTPServiceUnavailable(
+            'Server overloaded, please try again later',
+            headers={'Retry-After': str(settings.load_shedding_retry_after)},
+        )
+
+    start = time()
+    failed = False
+    try:
+        return await handler(request)
+    except HTTPException as e:
+        failed = e.status >= 500
+        raise
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        limiter.release(time() - start, failed=failed)
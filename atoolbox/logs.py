@@ -44,6 +44,9 @@ class ColouredAccessLogger(AbstractAccessLogger):
             size=self.format_size(response.body_length),
             ms=time * 1000,
         )
+        timings = request.get('timings')
+        if timings and getattr(request.app.get('settings'), 'access_log_timings', False):
+            msg += ' ' + timings.summary()
         time_str = (datetime.now() - timedelta(seconds=time)).strftime('[%H:%M:%S]')
         if sformat:
             time_str = sformat(time_str, sformat.magenta)
@@ -0,0 +1,211 @@
+import asyncio
+import logging
+from bisect import bisect_left
+from dataclasses import dataclass
+from time import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+from aiohttp.web_exceptions import HTTPException
+from aiohttp.web_middlewares import middleware
+from aiohttp.web_urldispatcher import MatchInfoError
+
+logger = logging.getLogger('atoolbox.metrics')
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+@dataclass
+class MetricFamily:
+    name: str
+    type: str
+    help: str
+    # list of (sample name, labels, value)
+    samples: List[Tuple[str, Dict[str, str], float]]
+
+
+def gauge(name: str, help: str, value: float, labels: Dict[str, str] = None) -> MetricFamily:
+    return MetricFamily(name, 'gauge', help, [(name, labels or {}, value)])
+
+
+Collector = Callable[[web.Application], Iterable[MetricFamily]]
+
+
+class RouteMetrics:
+    """
+    Request counts by status, latency histogram and in-flight gauge for one route, memory use is fixed
+    by the number of buckets and the number of distinct status codes.
+    """
+
+    __slots__ = 'buckets', 'bucket_counts', 'duration_sum', 'statuses', 'in_flight'
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        # last item counts observations above the largest bucket
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.duration_sum = 0.0
+        self.statuses: Dict[int, int] = {}
+        self.in_flight = 0
+
+    def observe(self, status: int, duration: float) -> None:
+        self.bucket_counts[bisect_left(self.buckets, duration)] += 1
+        self.duration_sum += duration
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+
+class Metrics:
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.routes: Dict[str, RouteMetrics] = {}
+        self.collectors: List[Collector] = [pg_metrics, redis_metrics, http_client_metrics]
+
+    def route(self, name: str) -> RouteMetrics:
+        r = self.routes.get(name)
+        if r is None:
+            r = self.routes[name] = RouteMetrics(self.buckets)
+        return r
+
+    def add_collector(self, collector: Collector) -> None:
+        """
+        Register a function returning extra metric families to include in the output.
+        """
+        self.collectors.append(collector)
+
+    def families(self, app: web.Application) -> Iterable[MetricFamily]:
+        requests = MetricFamily('atoolbox_requests_total', 'counter', 'Requests by route and status.', [])
+        in_flight = MetricFamily('atoolbox_requests_in_flight', 'gauge', 'Requests currently in progress.', [])
+        duration = MetricFamily('atoolbox_request_duration_seconds', 'histogram', 'Request latency.', [])
+        for name, r in self.routes.items():
+            for status, count in r.statuses.items():
+                requests.samples.append((requests.name, {'route': name, 'status': str(status)}, count))
+            in_flight.samples.append((in_flight.name, {'route': name}, r.in_flight))
+            cumulative = 0
+            for le, count in zip(self.buckets, r.bucket_counts):
+                cumulative += count
+                duration.samples.append((duration.name + '_bucket', {'route': name, 'le': _number(le)}, cumulative))
+            total = cumulative + r.bucket_counts[-1]
+            duration.samples += [
+                (duration.name + '_bucket', {'route': name, 'le': '+Inf'}, total),
+                (duration.name + '_sum', {'route': name}, r.duration_sum),
+                (duration.name + '_count', {'route': name}, total),
+            ]
+        yield from (requests, in_flight, duration)
+
+        for collector in self.collectors:
+            try:
+                yield from collector(app)
+            except Exception:
+                logger.exception('error running metrics collector %r', collector)
+
+    def render(self, app: web.Application) -> str:
+        """
+        Render metrics in the prometheus text exposition format.
+        """
+        lines = []
+        for family in self.families(app):
+            lines += [f'# HELP {family.name} {family.help}', f'# TYPE {family.name} {family.type}']
+            lines += [f'{name}{_labels(labels)} {_number(value)}' for name, labels, value in family.samples]
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+
+def _escape(v: str) -> str:
+    return v.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _number(v: float) -> str:
+    return repr(v) if isinstance(v, float) else str(v)
+
+
+def pg_pool_stats(pool) -> Optional[Dict[str, int]]:
+    """
+    Size, idle connections and tasks waiting for a connection for an asyncpg pool or AdaptivePool.
+    """
+    if not hasattr(pool, 'get_size'):
+        # DummyPgPool or asyncpg too old to support introspection
+        return None
+    stats = {'size': pool.get_size(), 'idle': pool.get_idle_size()}
+    if hasattr(pool, 'waiting'):
+        # AdaptivePool
+        stats.update(limit=pool.limit, in_use=pool.in_use, waiters=pool.waiting)
+    else:
+        queue = getattr(pool, '_queue', None)
+        # asyncio.Queue keeps waiting getters in _getters
+        stats['waiters'] = len(getattr(queue, '_getters', ()))
+    return stats
+
+
+def pg_metrics(app: web.Application) -> Iterable[MetricFamily]:
+    pool = app.get('pg')
+    stats = pool and pg_pool_stats(pool)
+    if stats:
+        for k, v in stats.items():
+            yield gauge(f'atoolbox_pg_pool_{k}', f'Postgres connection pool {k}.', v)
+
+
+def redis_metrics(app: web.Application) -> Iterable[MetricFamily]:
+    redis = app.get('redis')
+    # aioredis exposes the ConnectionsPool as "connection"
+    pool = getattr(redis, 'connection', None)
+    if pool is not None and hasattr(pool, 'freesize'):
+        yield gauge('atoolbox_redis_pool_size', 'Redis connection pool size.', pool.size)
+        yield gauge('atoolbox_redis_pool_free', 'Redis free connections.', pool.freesize)
+
+
+def http_client_metrics(app: web.Application) -> Iterable[MetricFamily]:
+    http_client = app.get('http_client')
+    connector = getattr(http_client, 'connector', None)
+    if connector is not None:
+        acquired = len(getattr(connector, '_acquired', ()))
+        idle = sum(len(c) for c in getattr(connector, '_conns', {}).values())
+        name = 'atoolbox_http_client_connections'
+        samples = [(name, {'state': 'acquired'}, acquired), (name, {'state': 'idle'}, idle)]
+        yield MetricFamily(name, 'gauge', 'Outbound http client connections.', samples)
+
+
+def route_name(request) -> str:
+    match_info = request.match_info
+    if isinstance(match_info, MatchInfoError):
+        # all unmatched requests share one entry to avoid unbounded memory use
+        return 'unmatched'
+    route = match_info.route
+    return route.name or route.resource and route.resource.canonical or 'unknown'
+
+
+def metrics_response(request) -> web.Response:
+    text = request.app['metrics'].render(request.app)
+    return web.Response(text=text, headers={'Content-Type': PROMETHEUS_CONTENT_TYPE})
+
+
+@middleware
+async def metrics_middleware(request, handler):
+    """
+    Record request metrics and serve them at settings.metrics_path, this should be the outermost middleware
+    so metric requests bypass CSRF checks and don't acquire a database connection.
+    """
+    if request.path == request.app['settings'].metrics_path:
+        return metrics_response(request)
+
+    route = request.app['metrics'].route(route_name(request))
+    route.in_flight += 1
+    status = 500
+    start = time()
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except HTTPException as e:
+        status = e.status
+        raise
+    except asyncio.CancelledError:
+        # client disconnected
+        status = 499
+        raise
+    finally:
+        route.in_flight -= 1
+        route.observe(status, time() - start)
@@ -1,10 +1,14 @@
+import asyncio
 import contextlib
 import logging
+import math
+from hashlib import blake2b
 from time import time
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 
+from aiohttp import ClientTimeout
 from aiohttp.abc import Request
-from aiohttp.hdrs import METH_GET, METH_OPTIONS, METH_POST
+from aiohttp.hdrs import METH_GET, METH_HEAD, METH_OPTIONS, METH_POST
 from aiohttp.web_exceptions import HTTPException, HTTPInternalServerError
 from aiohttp.web_middlewares import middleware
 from aiohttp.web_response import Response
@@ -15,10 +19,22 @@ from yarl import URL
 
 from .json_tools import lenient_json
 from .settings import BaseSettings
+from .timing import start_timings
 from .utils import JSON_CONTENT_TYPE, JsonErrors, get_ip, remove_port, request_root
 
+try:
+    from .db.instrument import InstrumentedConnection, log_repeated_queries
+except ImportError:  # pragma: no cover
+    # buildpg and asyncpg aren't installed so pg_middleware can't be used
+    InstrumentedConnection = log_repeated_queries = None
+
 logger = logging.getLogger('atoolbox.middleware')
 CROSS_ORIGIN_ANY = {'Access-Control-Allow-Origin': '*'}
+READ_METHODS = {METH_GET, METH_HEAD, METH_OPTIONS}
+# cookie set after a write so the client's reads go to the primary rather than a replica which might be behind
+PRIMARY_COOKIE = 'pg_primary'
+# headers copied from the full response to a 304 Not Modified response
+NOT_MODIFIED_HEADERS = 'Cache-Control', 'Content-Location', 'ETag', 'Expires', 'Vary'
 
 
 def exc_extra(exc):
@@ -103,7 +119,7 @@ async def log_warning(request: Request, response: Optional[Response]):
 
 
 def should_warn(r):
-    return r.status > 310 and r.status not in {401, 404, 470}
+    return r.status > 310 and r.status not in {401, 404, 429, 470}
 
 
 def get_request_start(request):
@@ -113,12 +129,74 @@ def get_request_start(request):
         return time()
 
 
+def deadline_remaining(request) -> Optional[float]:
+    """
+    Seconds remaining before the request's deadline, None if the request has no deadline.
+    """
+    deadline = request.get('deadline')
+    return None if deadline is None else deadline - time()
+
+
+async def after_commit(
+    request, callback: Callable[[], Awaitable[Any]], on_rollback: Callable[[], Awaitable[Any]] = None
+) -> None:
+    """
+    Await callback once the request's transaction (see atomic) commits, or now if the request isn't in a transaction.
+    If the transaction is rolled back, eg. before it's retried, on_rollback is awaited instead. Use this for side
+    effects outside postgres, eg. redis writes, so they aren't made by attempts which are rolled back.
+    """
+    hooks = request.get('pg_commit_hooks')
+    if hooks is None:
+        await callback()
+    else:
+        hooks.append((callback, on_rollback))
+
+
+async def run_commit_hooks(hooks: List[Tuple[Callable, Optional[Callable]]], *, committed: bool) -> None:
+    for callback, on_rollback in hooks:
+        func = callback if committed else on_rollback
+        if func is not None:
+            try:
+                await func()
+            except Exception:
+                logger.exception('error running %s hook %r', 'commit' if committed else 'rollback', func)
+
+
+def http_client_timeout(request) -> ClientTimeout:
+    """
+    Timeout for app['http_client'] calls made while processing a request, the smaller of
+    settings.http_client_timeout and the time remaining before the request's deadline.
+    """
+    total = getattr(request.app['settings'], 'http_client_timeout', 30)
+    remaining = deadline_remaining(request)
+    if remaining is not None:
+        # a total of 0 would mean no timeout
+        total = max(min(total, remaining), 0.001)
+    return ClientTimeout(total=total)
+
+
+def add_server_timing(request, response) -> None:
+    settings = request.app.get('settings')
+    timings = request.get('timings')
+    if timings and getattr(settings, 'server_timing', False):
+        response.headers['Server-Timing'] = timings.server_timing()
+
+
 @middleware
 async def error_middleware(request, handler):
     request['start_time'] = get_request_start(request)
+    request_timeout = getattr(request.app.get('settings'), 'request_timeout', None)
+    if request_timeout:
+        request['deadline'] = request['start_time'] + request_timeout
+    timings = start_timings(request)
+    if 'X-Request-Start' in request.headers:
+        # time spent between the router receiving the request and it reaching us
+        timings.add('queue', max(time() - request['start_time'], 0))
     try:
-        r = await handler(request)
+        with timings.measure('handler'):
+            r = await handler(request)
     except HTTPException as e:
+        add_server_timing(request, e)
         should_warn_ = request.app.get('middleware_should_warn') or should_warn
         if should_warn_(e):
             await log_warning(request, e)
@@ -133,9 +211,12 @@ async def error_middleware(request, handler):
         event.update(exc_data)
         event.update(level='error', message=message)
         capture_event(event, hint)
-        raise HTTPInternalServerError() from exc
+        http_exc = HTTPInternalServerError()
+        add_server_timing(request, http_exc)
+        raise http_exc from exc
     else:
         # TODO cope with case that r is not a response
+        add_server_timing(request, r)
         should_warn_ = request.app.get('middleware_should_warn') or should_warn
         if should_warn_(r):
             await log_warning(request, r)
@@ -147,10 +228,124 @@ async def pg_middleware(request, handler):
     check = request.app.get('pg_middleware_check')
     if check and not check(request):
         return await handler(request)
-    else:
-        async with request.app['pg'].acquire() as conn:
+    from .db.transactions import run_handler
+
+    settings: Optional[BaseSettings] = request.app['settings']
+    remaining = deadline_remaining(request)
+    if remaining is not None and remaining <= 0:
+        raise JsonErrors.HTTPServiceUnavailable('Request deadline exceeded')
+
+    acquire_kwargs = {} if remaining is None else {'timeout': remaining}
+    acquire_start = time()
+    try:
+        async with choose_pool(request).acquire(**acquire_kwargs) as conn:
+            timings = request.get('timings')
+            if timings:
+                timings.add('pg-acquire', time() - acquire_start)
+            if remaining is not None:
+                await set_statement_timeout(conn, deadline_remaining(request))
+            conn = InstrumentedConnection(
+                conn,
+                slow_threshold=getattr(settings, 'pg_slow_query_threshold', None),
+                log_params=getattr(settings, 'pg_log_query_params', False),
+            )
             request['conn'] = conn
-            return await handler(request)
+            try:
+                response = await run_handler(request, handler, conn, settings)
+            finally:
+                log_repeated_queries(request, conn, getattr(settings, 'pg_n_plus_one_threshold', None))
+    except asyncio.TimeoutError:
+        if remaining is not None and deadline_remaining(request) <= 0:
+            raise JsonErrors.HTTPServiceUnavailable('Request deadline exceeded')
+        raise
+    pin_primary(request, response, settings)
+    return response
+
+
+def choose_pool(request):
+    """
+    Pool for the request: a read replica for GET and HEAD requests to handlers marked with read_only, unless
+    the client has written recently or no replica is healthy, otherwise app['pg'].
+    """
+    replicas = request.app.get('pg_replicas')
+    if (
+        replicas is None
+        or request.method not in READ_METHODS
+        or not getattr(request.match_info.handler, 'read_only', False)
+        or PRIMARY_COOKIE in request.cookies
+    ):
+        return request.app['pg']
+    return replicas.choose() or request.app['pg']
+
+
+def pin_primary(request, response, settings: BaseSettings):
+    """
+    After a write, set a cookie so the client's reads use the primary until replicas have caught up.
+    """
+    if 'pg_replicas' in request.app and request.method not in READ_METHODS and response.status < 400:
+        max_age = math.ceil(settings.pg_replica_read_your_writes)
+        response.set_cookie(PRIMARY_COOKIE, '1', max_age=max_age, httponly=True)
+
+
+async def set_statement_timeout(conn, seconds: float):
+    """
+    Limit the duration of queries on conn to the remaining request budget.
+
+    This is set for the session rather than with "SET LOCAL" so it applies outside transactions, pool connections
+    are reset (with "RESET ALL") when they're released so the setting doesn't leak to other requests.
+    """
+    ms = max(int(seconds * 1000), 1)
+    await conn.execute("SELECT set_config('statement_timeout', $1, false)", str(ms))
+
+
+def response_etag(response, max_size: int) -> Optional[str]:
+    """
+    Weak ETag for a successful response with a bytes body up to max_size bytes, None for other responses,
+    eg. streaming and file responses or those which already have an ETag.
+    """
+    if (
+        not isinstance(response, Response)
+        or response.status != 200
+        or not isinstance(response.body, bytes)
+        or len(response.body) > max_size
+        or 'ETag' in response.headers
+    ):
+        return None
+    return f'W/"{blake2b(response.body, digest_size=16).hexdigest()}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # weak comparison, https://tools.ietf.org/html/rfc7232#section-3.2
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    strip_weak = etag[2:]
+    return any(tag.strip().replace('W/', '', 1) == strip_weak for tag in if_none_match.split(','))
+
+
+@middleware
+async def etag_middleware(request, handler):
+    """
+    Add a weak ETag to GET and HEAD responses and return 304 Not Modified if it matches the If-None-Match header,
+    this should come inside session middleware so cookies are still set on 304 responses.
+    """
+    response = await handler(request)
+    if request.method not in {METH_GET, METH_HEAD}:
+        return response
+    etag = response_etag(response, getattr(request.app.get('settings'), 'etag_max_size', 1024 ** 2))
+    if etag is None:
+        return response
+
+    response.headers['ETag'] = etag
+    if not etag_matches(request.headers.get('If-None-Match'), etag):
+        return response
+
+    headers = {h: response.headers[h] for h in NOT_MODIFIED_HEADERS if h in response.headers}
+    not_modified = Response(status=304, headers=headers)
+    for name, morsel in response.cookies.items():
+        not_modified.cookies[name] = morsel
+    return not_modified
 
 
 def _path_match(request, paths):
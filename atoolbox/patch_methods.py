@@ -1,8 +1,12 @@
 import asyncio
+import json
 import logging
+from collections import deque
 from dataclasses import dataclass
+from functools import partial
 from importlib import import_module
-from typing import Callable, Tuple
+from time import time
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
 
 from .settings import BaseSettings
 
@@ -14,6 +18,25 @@ patches = []
 class Patch:
     func: Callable
     direct: bool = False
+    batched: bool = False
+    # seconds to sleep between batches
+    batch_delay: float = 0.1
+    # sql returning the total number of rows to process, used to estimate time remaining
+    total_sql: Optional[str] = None
+    # size of the connection pool for direct patches which run queries in parallel, see partition_range
+    concurrency: Optional[int] = None
+
+
+@dataclass
+class Batch:
+    """
+    Returned by batched patches after processing each batch.
+    """
+
+    # key of the last row processed, passed to the next call as "after", must be json serialisable
+    last_key: Any
+    # number of rows processed
+    rows: int
 
 
 def run_patch(settings: BaseSettings, patch_name: str, live: bool, args: Tuple[str, ...]):
@@ -40,6 +63,8 @@ def run_patch(settings: BaseSettings, patch_name: str, live: bool, args: Tuple[s
             logger.error('direct patches must be called with "--live"')
             return 1
         logger.info(f'running patch {patch_name} direct')
+    elif patch.batched:
+        logger.info(f'running patch {patch_name} batched live {live}')
     else:
         logger.info(f'running patch {patch_name} live {live}')
     loop = asyncio.get_event_loop()
@@ -50,12 +75,32 @@ async def _run_patch(settings, patch: Patch, live: bool, args: Tuple[str, ...]):
     from .db.connection import lenient_conn
 
     conn = await lenient_conn(settings)
+    pool = None
+    try:
+        if patch.batched:
+            return await _run_batched_patch(conn, settings, patch, live, args)
+        if patch.concurrency:
+            from buildpg import asyncpg
+
+            pool = await asyncpg.create_pool_b(
+                dsn=settings.pg_dsn, min_size=patch.concurrency, max_size=patch.concurrency
+            )
+        return await _run_single_patch(conn, settings, patch, live, args, pool)
+    finally:
+        await conn.close()
+        if pool:
+            await pool.close()
+
+
+async def _run_single_patch(conn, settings, patch: Patch, live: bool, args: Tuple[str, ...], pool=None):
     tr = None
     if not patch.direct:
         tr = conn.transaction()
         await tr.start()
     logger.info('=' * 40)
     kwargs = dict(conn=conn, settings=settings, live=live, args=args, logger=logger)
+    if pool:
+        kwargs.update(pool=pool, partition=partial(partition_range, pool, concurrency=patch.concurrency))
     try:
         if asyncio.iscoroutinefunction(patch.func):
             result = await patch.func(**kwargs)
@@ -80,11 +125,138 @@ async def _run_patch(settings, patch: Patch, live: bool, args: Tuple[str, ...]):
             else:
                 logger.info('not live, rolling back')
                 await tr.rollback()
-    finally:
-        await conn.close()
 
 
-def patch(*args, direct=False):
+async def _run_batched_patch(conn, settings, patch: Patch, live: bool, args: Tuple[str, ...]):
+    """
+    Call the patch repeatedly, each call processes one batch in its own transaction and returns a Batch, or None
+    when there's nothing left to do. Progress is saved in the same transaction so rerunning the patch resumes
+    after the last committed batch. If not live only the first batch is run then rolled back.
+    """
+    from .db import CREATE_META_TABLE, META_TABLE, SET_META
+
+    name = patch.func.__name__
+    progress_key = f'patch:{name}'
+    await conn.execute(CREATE_META_TABLE)
+    progress = await conn.fetchval(f'select value from {META_TABLE} where key=$1', progress_key)
+    after, done = json.loads(progress) if progress else (None, 0)
+    if progress:
+        logger.info('resuming %s after %r, %d rows already processed', name, after, done)
+    total = patch.total_sql and await conn.fetchval(patch.total_sql)
+
+    start, rows = time(), 0
+    kwargs = dict(conn=conn, settings=settings, live=live, args=args, logger=logger)
+    while True:
+        try:
+            async with conn.transaction():
+                batch: Optional[Batch] = await patch.func(after=after, **kwargs)
+                if batch is None:
+                    await conn.execute(f'delete from {META_TABLE} where key=$1', progress_key)
+                else:
+                    after, done, rows = batch.last_key, done + batch.rows, rows + batch.rows
+                    await conn.execute(SET_META, progress_key, json.dumps([after, done]))
+                if not live:
+                    raise _RollbackBatch()
+        except _RollbackBatch:
+            logger.info('not live, rolled back first batch')
+            return
+        except Exception:
+            logger.exception('Error running %s patch, %d rows processed, last key %r', name, done, after)
+            return 1
+
+        if batch is None:
+            logger.info('patch %s complete, %d rows processed', name, done)
+            return
+        _log_progress(name, done, rows, time() - start, total)
+        await asyncio.sleep(patch.batch_delay)
+
+
+class _RollbackBatch(Exception):
+    pass
+
+
+def _log_progress(name: str, done: int, rows: int, duration: float, total: Optional[int]):
+    rate = rows / duration if duration else 0
+    msg = f'{name}: {done:,d} rows processed, {rate:0.0f} rows/s'
+    if total and rate:
+        remaining = max(total - done, 0)
+        msg += f', {done / total:0.1%} complete, ETA {remaining / rate:0.0f}s'
+    logger.info(msg)
+
+
+class PartitionError(RuntimeError):
+    def __init__(self, failures: List[Tuple[int, int, Exception]], chunks: int):
+        self.failures = failures
+        ranges = ', '.join(f'{start}-{stop}' for start, stop, _ in failures)
+        super().__init__(f'{len(failures)} of {chunks} partitions failed: {ranges}')
+
+
+async def partition_range(
+    pool,
+    func: Callable[[Any, int, int], Awaitable[Optional[int]]],
+    start: int,
+    stop: int,
+    *,
+    concurrency: int,
+    chunk_size: int = None,
+) -> int:
+    """
+    Split the key range [start, stop) into chunks and call "await func(conn, chunk_start, chunk_stop)" for each,
+    using up to concurrency connections from pool at once. Patches with concurrency set get this function as the
+    "partition" kwarg with pool and concurrency already supplied.
+
+    func should return the number of rows it processed (or None), progress is logged after each chunk. Failed chunks
+    are logged and the remaining chunks still run, then PartitionError is raised listing the failed ranges so they
+    can be rerun. Returns the total number of rows processed.
+
+    :param chunk_size: size of each chunk, defaults to splitting the range into four chunks per connection
+    """
+    chunk_size = chunk_size or max(-(-(stop - start) // (concurrency * 4)), 1)
+    chunks = deque((s, min(s + chunk_size, stop)) for s in range(start, stop, chunk_size))
+    total_chunks = len(chunks)
+    failures = []
+    progress = {'chunks': 0, 'rows': 0}
+    start_time = time()
+
+    async def worker():
+        async with pool.acquire() as conn:
+            while chunks:
+                chunk_start, chunk_stop = chunks.popleft()
+                try:
+                    rows = await func(conn, chunk_start, chunk_stop)
+                except Exception as e:
+                    logger.warning('partition %d-%d failed, %s: %s', chunk_start, chunk_stop, e.__class__.__name__, e)
+                    failures.append((chunk_start, chunk_stop, e))
+                    continue
+                progress['chunks'] += 1
+                progress['rows'] += rows or 0
+                duration = time() - start_time
+                logger.info(
+                    '%d/%d partitions complete, %d rows processed, %0.0f rows/s',
+                    progress['chunks'],
+                    total_chunks,
+                    progress['rows'],
+                    progress['rows'] / duration if duration else 0,
+                )
+
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, total_chunks))))
+    if failures:
+        raise PartitionError(sorted(failures, key=lambda f: f[0]), total_chunks)
+    return progress['rows']
+
+
+def patch(*args, direct=False, batched=False, batch_delay=0.1, total_sql=None, concurrency=None):
+    """
+    Register a patch to be run with the "patch" command.
+
+    :param direct: run the patch without a transaction, eg. for "CREATE INDEX CONCURRENTLY"
+    :param batched: the patch processes one batch per call, see _run_batched_patch and Batch
+    :param batch_delay: seconds to sleep between batches to limit load on the database
+    :param total_sql: sql returning the total number of rows a batched patch will process, used to estimate ETA
+    :param concurrency: number of connections for a direct patch to use in parallel, the patch gets "pool" and
+      "partition" kwargs, see partition_range
+    """
+    assert not concurrency or direct, 'concurrency can only be used with direct patches'
     if args:
         assert len(args) == 1, 'wrong arguments to patch'
         func = args[0]
@@ -93,7 +265,16 @@ def patch(*args, direct=False):
     else:
 
         def wrapper(func):
-            patches.append(Patch(func=func, direct=direct))
+            patches.append(
+                Patch(
+                    func=func,
+                    direct=direct,
+                    batched=batched,
+                    batch_delay=batch_delay,
+                    total_sql=total_sql,
+                    concurrency=concurrency,
+                )
+            )
             return func
 
         return wrapper
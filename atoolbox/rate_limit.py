@@ -0,0 +1,196 @@
+import hashlib
+import inspect
+import logging
+import math
+from collections import OrderedDict
+from dataclasses import dataclass
+from time import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Union
+
+from aiohttp.web_exceptions import HTTPException
+from aiohttp.web_middlewares import middleware
+
+from .exceptions import JsonErrors
+from .metrics import route_name
+from .utils import get_ip
+
+logger = logging.getLogger('atoolbox.rate_limit')
+
+# token bucket, KEYS[1]: bucket key, ARGV: capacity, tokens per millisecond, time now in milliseconds
+# returns [1 if allowed else 0, tokens remaining as a string since lua numbers are truncated to integers]
+TOKEN_BUCKET_LUA = """
+local capacity = tonumber(ARGV[1])
+local refill = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1])
+local ts = tonumber(bucket[2])
+if tokens == nil then
+  tokens = capacity
+  ts = now
+end
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * refill)
+local allowed = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / refill) + 1000)
+return {allowed, tostring(tokens)}
+"""
+TOKEN_BUCKET_SHA = hashlib.sha1(TOKEN_BUCKET_LUA.encode()).hexdigest()
+
+KeyFunc = Callable[[Any], Union[str, Awaitable[str]]]
+
+
+async def ip_key(request) -> str:
+    return 'ip:' + (get_ip(request) or '-')
+
+
+async def user_key(request) -> str:
+    """
+    Key on the session's "user_id" falling back to the client's IP address.
+    """
+    from aiohttp_session import get_session
+
+    session = await get_session(request)
+    user_id = session.get('user_id')
+    if user_id is None:
+        return await ip_key(request)
+    return f'user:{user_id}'
+
+
+@dataclass
+class RateLimit:
+    # number of requests allowed...
+    rate: int
+    # ...per this number of seconds
+    per: float = 60
+    # maximum number of requests in a burst, defaults to rate
+    burst: Optional[int] = None
+    key: KeyFunc = ip_key
+    # defaults to the route name
+    name: Optional[str] = None
+
+    @property
+    def capacity(self) -> int:
+        return self.burst or self.rate
+
+
+def rate_limit(rate: int, per: float = 60, *, burst: int = None, key: KeyFunc = ip_key, name: str = None):
+    """
+    Decorator to rate limit a handler, View.call or Bread method, requires redis and rate_limit_middleware.
+
+    :param rate: number of requests allowed per "per" seconds
+    :param per: period in seconds
+    :param burst: maximum number of requests in a burst, defaults to rate
+    :param key: function taking the request and returning a key to limit by, eg. ip_key, user_key or a custom function
+    :param name: name used in the redis key, defaults to the route name
+    """
+
+    def wrapper(func):
+        func.rate_limit = RateLimit(rate=rate, per=per, burst=burst, key=key, name=name)
+        return func
+
+    return wrapper
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter using an atomic lua script in redis.
+
+    Keys which are out of tokens are remembered locally until they have a token again, so hot keys
+    don't need a round trip to redis for every request.
+    """
+
+    def __init__(self, *, local_max_keys: int = 10_000, prefix: str = 'rate_limit'):
+        self.local_max_keys = local_max_keys
+        self.prefix = prefix
+        # key -> time when the key will have a token again, oldest first
+        self._blocked = OrderedDict()
+
+    async def check(self, redis, limit: RateLimit, key: str) -> Tuple[bool, Dict[str, str]]:
+        """
+        Take a token for key, returns whether the request is allowed and the headers to add to the response.
+        """
+        now = time()
+        refill = limit.rate / limit.per
+        blocked_until = self._blocked.get(key)
+        if blocked_until is not None:
+            if blocked_until > now:
+                return False, self._headers(limit, 0, blocked_until - now)
+            self._blocked.pop(key, None)
+
+        allowed, tokens = await self._take(redis, limit, key, now)
+        if allowed:
+            reset = (limit.capacity - tokens) / refill
+        else:
+            reset = (1 - tokens) / refill
+            self._block(key, now + reset)
+        return allowed, self._headers(limit, tokens, reset)
+
+    async def _take(self, redis, limit: RateLimit, key: str, now: float) -> Tuple[bool, float]:
+        from aioredis import ReplyError
+
+        args = [limit.capacity, limit.rate / limit.per / 1000, int(now * 1000)]
+        try:
+            allowed, tokens = await redis.evalsha(TOKEN_BUCKET_SHA, keys=[key], args=args)
+        except ReplyError as e:
+            if 'NOSCRIPT' not in str(e):
+                raise
+            allowed, tokens = await redis.eval(TOKEN_BUCKET_LUA, keys=[key], args=args)
+        return bool(allowed), float(tokens)
+
+    def _block(self, key: str, until: float):
+        self._blocked[key] = until
+        if len(self._blocked) > self.local_max_keys:
+            self._blocked.popitem(last=False)
+
+    @staticmethod
+    def _headers(limit: RateLimit, tokens: float, reset: float) -> Dict[str, str]:
+        return {
+            'RateLimit-Limit': str(limit.capacity),
+            'RateLimit-Remaining': str(int(tokens)),
+            'RateLimit-Reset': str(math.ceil(reset)),
+        }
+
+    async def key(self, request, limit: RateLimit) -> str:
+        k = limit.key(request)
+        if inspect.isawaitable(k):
+            k = await k
+        return f'{self.prefix}:{limit.name or route_name(request)}:{k}'
+
+
+@middleware
+async def rate_limit_middleware(request, handler):
+    """
+    Apply limits set by the rate_limit decorator, this should come before pg_middleware so limited requests
+    never acquire a database connection.
+    """
+    limit: Optional[RateLimit] = getattr(request.match_info.handler, 'rate_limit', None)
+    redis = request.app.get('redis')
+    if limit is None or redis is None:
+        return await handler(request)
+
+    limiter: RateLimiter = request.app['rate_limiter']
+    key = await limiter.key(request, limit)
+    try:
+        allowed, headers = await limiter.check(redis, limit, key)
+    except Exception:
+        # fail open, better to serve requests than to fail because redis is unavailable
+        logger.warning('error checking rate limit for %s', key, exc_info=True)
+        return await handler(request)
+
+    if not allowed:
+        headers['Retry-After'] = headers['RateLimit-Reset']
+        raise JsonErrors.HTTPTooManyRequests('Too many requests, please slow down', headers=headers)
+
+    try:
+        response = await handler(request)
+    except HTTPException as e:
+        e.headers.update(headers)
+        raise
+    else:
+        response.headers.update(headers)
+        return response
@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import List, Optional, Pattern
+from typing import Dict, List, Optional, Pattern
 from urllib.parse import urlparse
 
 from pydantic import BaseSettings as _BaseSettings, validator
@@ -49,6 +49,46 @@ class BaseSettings(_BaseSettings):
     pg_dsn: Optional[str] = pg_dsn_default
     # eg. the db already exists on heroku and never has to be created
     pg_db_exists = False
+    # prefix for a template database containing settings.sql, when set the database is created as a copy of
+    # the template which is much faster than running settings.sql for large schemas, eg. in tests
+    pg_template_db: Optional[str] = None
+    pg_pool_min_size = 2
+    pg_pool_max_size = 10
+    # seconds after which idle connections are closed
+    pg_pool_max_inactive_connection_lifetime = 300.0
+    # default timeout for queries in seconds
+    pg_command_timeout: Optional[float] = None
+    pg_statement_cache_size = 100
+    # vary the number of connections in use between pg_pool_min_size and pg_pool_max_size depending on demand
+    pg_pool_adaptive = False
+    # seconds, acquiring a connection slower than this grows the adaptive pool
+    pg_pool_acquire_target = 0.05
+    # fraction of postgres's max_connections the adaptive pool may use, eg. 0.2 with 5 processes
+    pg_pool_connection_share: Optional[float] = None
+    # seconds, queries slower than this are logged with their sql, None to disable
+    pg_slow_query_threshold: Optional[float] = 0.5
+    # include parameters in slow query logs, they may contain personal data
+    pg_log_query_params = False
+    # warn about requests which run the same statement more than this many times, None to disable
+    pg_n_plus_one_threshold: Optional[int] = 10
+    # run every POST, PUT, PATCH and DELETE request in a transaction, see also the atomic decorator
+    pg_atomic_requests = False
+    # "read_committed", "repeatable_read" or "serializable"
+    pg_atomic_isolation = 'read_committed'
+    # times to retry a request whose transaction fails with a serialization error or deadlock
+    pg_atomic_retries = 3
+    # seconds, delay before the first retry, it's doubled for each retry with random jitter
+    pg_atomic_retry_delay = 0.02
+    # dsns of read replicas used for GET requests to handlers marked with read_only
+    pg_replica_dsns: List[str] = []
+    # seconds after a client writes during which its reads use the primary
+    pg_replica_read_your_writes = 5.0
+    # seconds between replica health checks, unhealthy replicas aren't used
+    pg_replica_health_interval = 5.0
+    # directory of numbered sql migrations, eg. "migrations/0001_add_user_email.sql", see atoolbox.db.migrations
+    migrations_dir: Optional[Path] = None
+    # apply pending migrations on startup, otherwise they're applied with the "migrate" command
+    pg_migrate_on_startup = False
 
     redis_settings: Optional[RedisSettings] = redis_settings_default
     port: int = 8000
@@ -59,7 +99,19 @@ class BaseSettings(_BaseSettings):
     locale = 'en_US.utf8'
 
     http_client_timeout = 10
+    # seconds from the request reaching the router (X-Request-Start) after which the request is abandoned,
+    # the remaining budget is also applied to queries and http_client calls
+    request_timeout: Optional[float] = None
     create_http_client = True
+    # urls to make a HEAD request to on startup (with startup_warmup) so connections are ready for the first request
+    http_client_warmup_urls: List[str] = []
+
+    # seconds allowed for initialising each of "pg", "redis" and "http_client" on startup, startup_timeouts
+    # overrides this for individual services
+    startup_timeout = 30.0
+    startup_timeouts: Dict[str, float] = {}
+    # ping redis and connect to http_client_warmup_urls on startup
+    startup_warmup = False
 
     csrf_ignore_paths: List[Pattern] = []
     csrf_upload_paths: List[Pattern] = []
@@ -68,6 +120,84 @@ class BaseSettings(_BaseSettings):
 
     cookie_name = 'aiohttp-app'
 
+    # expose per-request phase durations in the "Server-Timing" response header
+    server_timing = False
+    # include per-request phase durations in the access log
+    access_log_timings = False
+
+    # path at which to serve prometheus metrics, None to disable metrics
+    metrics_path: Optional[str] = None
+    metrics_buckets: List[float] = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    # adaptive concurrency limit, requests over the limit wait in a queue then get a 503
+    load_shedding = False
+    load_shedding_initial_limit = 20
+    load_shedding_min_limit = 2
+    load_shedding_max_limit = 200
+    # seconds, requests slower than this reduce the limit
+    load_shedding_target_latency = 0.5
+    load_shedding_queue_size = 50
+    load_shedding_queue_timeout = 1.0
+    load_shedding_retry_after = 1
+    load_shedding_exempt_paths: List[Pattern] = []
+
+    # enforce limits on handlers decorated with rate_limit, requires redis
+    rate_limit = False
+
+    # coalesce identical concurrent GET requests to handlers decorated with single_flight
+    single_flight = False
+
+    # "pg" (LISTEN/NOTIFY) or "redis" (pubsub) to receive invalidation messages for in-process caches from all
+    # processes, see atoolbox.invalidation
+    invalidation_backend: Optional[str] = None
+    invalidation_channel = 'atoolbox_invalidate'
+
+    # add ETags to GET responses and return 304 Not Modified when they match If-None-Match
+    etag = False
+    # larger responses don't get an ETag
+    etag_max_size = 1024 ** 2
+
+    # compress responses with brotli (if installed) or gzip, see atoolbox.compression
+    compression = False
+    # smaller responses aren't compressed
+    compression_min_size = 1024
+    # larger responses are compressed in a thread
+    compression_executor_size = 64 * 1024
+    # maximum size of compressed bodies of cacheable responses kept in memory
+    compression_cache_bytes = 8 * 1024 ** 2
+    compression_gzip_level = 6
+    compression_brotli_quality = 5
+
+    # serve files in app['static_dir'] with spa_static_handler from an index built at startup, see atoolbox.static_index
+    static_index = False
+    # smaller files are kept in memory
+    static_index_memory_size = 16 * 1024
+    # maximum total size of files kept in memory
+    static_index_memory_max_bytes = 16 * 1024 ** 2
+    # seconds between checks for changed files, eg. in development, None to never check
+    static_index_watch_interval: Optional[float] = None
+    # file names which include a content hash so can be cached forever, defaults to static_index.HASHED_NAME
+    static_index_hashed_name: Optional[Pattern] = None
+
+    # two tier (in-process and redis) cache at app['cache'], see atoolbox.cache
+    cache = False
+    # maximum total size of serialised values in the in-process tier
+    cache_max_bytes = 32 * 1024 ** 2
+    cache_ttl = 300.0
+    # seconds to cache None values for
+    cache_negative_ttl = 30.0
+    # "json" or "pickle"
+    cache_serializer = 'json'
+    # higher values refresh values earlier before they expire, 0 to disable early refresh
+    cache_early_refresh_beta = 1.0
+
+    # seconds to keep responses to requests with an "Idempotency-Key" header
+    idempotency_ttl = 24 * 3600
+    # seconds a duplicate request waits for the original request to finish
+    idempotency_wait = 10.0
+    # seconds after which an unfinished request (eg. if the process died) no longer blocks duplicates
+    idempotency_lock_timeout = 60
+
     grecaptcha_url = 'https://www.google.com/recaptcha/api/siteverify'
     grecaptcha_secret = '6LeIxAcTAAAAAGG-vFI1TnRWxMZNFuojJ4WifJWe'
 
@@ -0,0 +1,107 @@
+import asyncio
+import inspect
+import logging
+from dataclasses import dataclass
+from time import time
+from typing import Dict, Iterable, Optional
+
+from aiohttp import web
+from aiohttp.hdrs import METH_GET
+from aiohttp.web_middlewares import middleware
+from multidict import CIMultiDict
+
+from .metrics import MetricFamily
+from .rate_limit import KeyFunc
+from .timing import record
+from .utils import UNSTORED_HEADERS
+
+logger = logging.getLogger('atoolbox.single_flight')
+
+
+@dataclass
+class SingleFlight:
+    # function returning a key to scope shared responses by, eg. user_key, None means responses are shared by all users
+    scope: Optional[KeyFunc] = None
+
+
+def single_flight(scope: KeyFunc = None):
+    """
+    Decorator to coalesce identical concurrent GET requests to a handler, View.call or Bread method:
+    while a request is in progress, requests with the same path and query string (and scope) wait for it and get
+    a copy of its response instead of running the handler again. Requires single_flight_middleware.
+
+    :param scope: function taking the request and returning a key to separate responses by, eg. user_key,
+      this must be set unless the response is the same for all users
+    """
+
+    def wrapper(func):
+        func.single_flight = SingleFlight(scope=scope)
+        return func
+
+    return wrapper
+
+
+class SingleFlightGroup:
+    """
+    In-flight requests by key, followers wait on the leader's future which resolves to
+    (status, headers, body) or None if the leader failed or its response can't be shared.
+    """
+
+    def __init__(self):
+        self.flights: Dict[str, asyncio.Future] = {}
+        self.coalesced = 0
+
+    async def key(self, request, sf: SingleFlight) -> str:
+        scope = ''
+        if sf.scope:
+            scope = sf.scope(request)
+            if inspect.isawaitable(scope):
+                scope = await scope
+        return f'{request.method}:{request.path_qs}:{scope}'
+
+    async def run(self, key: str, request, handler) -> web.StreamResponse:
+        fut = self.flights.get(key)
+        if fut is not None:
+            return await self._follow(fut, request, handler)
+
+        fut = self.flights[key] = asyncio.get_event_loop().create_future()
+        result = None
+        try:
+            response = await handler(request)
+            if isinstance(response, web.Response) and isinstance(response.body, bytes) and response.status < 500:
+                headers = [(k, v) for k, v in response.headers.items() if k not in UNSTORED_HEADERS]
+                result = response.status, headers, response.body
+            return response
+        finally:
+            del self.flights[key]
+            fut.set_result(result)
+
+    async def _follow(self, fut: asyncio.Future, request, handler) -> web.StreamResponse:
+        start = time()
+        # shield so a follower disconnecting doesn't cancel the future for everyone else
+        result = await asyncio.shield(fut)
+        if result is None:
+            return await handler(request)
+        self.coalesced += 1
+        record('single-flight', time() - start)
+        status, headers, body = result
+        return web.Response(status=status, headers=CIMultiDict(headers), body=body)
+
+    def metrics(self, app: web.Application) -> Iterable[MetricFamily]:
+        name = 'atoolbox_single_flight_coalesced_total'
+        help = 'Requests served with the response of another in-flight request.'
+        yield MetricFamily(name, 'counter', help, [(name, {}, self.coalesced)])
+
+
+@middleware
+async def single_flight_middleware(request, handler):
+    """
+    Coalesce requests to handlers decorated with single_flight, this should come before pg_middleware so
+    followers never acquire a database connection.
+    """
+    sf: Optional[SingleFlight] = getattr(request.match_info.handler, 'single_flight', None)
+    if sf is None or request.method != METH_GET:
+        return await handler(request)
+
+    group: SingleFlightGroup = request.app['single_flight']
+    return await group.run(await group.key(request, sf), request, handler)
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import mimetypes
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from time import time
+from typing import Dict, Optional, Pattern
+
+from aiohttp.web_exceptions import HTTPNotFound
+from aiohttp.web_fileresponse import FileResponse
+from aiohttp.web_response import Response, StreamResponse
+
+from .compression import accepted_encoding
+from .middleware import NOT_MODIFIED_HEADERS, etag_matches
+from .settings import BaseSettings
+
+logger = logging.getLogger('atoolbox.static_index')
+# precompressed versions of files, eg. from precompress_directory
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+# file names including a content hash, eg. "main.3b5c9e1a.js" or "chunk-3b5c9e1a.css", never change, the hash
+# must contain letters and digits so dates like "report-20231015.pdf" don't match
+HASHED_NAME = re.compile(r'.+[.-](?=[0-9a-f]*[a-f])(?=[0-9a-f]*[0-9])[0-9a-f]{8,}\.\w+')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def _inside(path: Path, root: Path) -> bool:
+    # like spa_static_handler, symlinks to files outside the directory aren't served
+    try:
+        path.resolve().relative_to(root)
+    except ValueError:
+        return False
+    else:
+        return True
+
+
+@dataclass
+class StaticVariant:
+    path: Path
+    size: int
+    # same format as FileResponse's ETag so conditional requests work whichever generated it
+    etag: str
+    # content of small files is kept in memory
+    body: Optional[bytes] = None
+
+
+@dataclass
+class StaticFile:
+    content_type: str
+    # hashed file names can be cached forever
+    immutable: bool
+    # "identity" and any precompressed "gzip" and "br" versions
+    variants: Dict[str, StaticVariant]
+
+
+class StaticIndex:
+    """
+    Index of the files in a static directory so serving a file is a dict lookup followed by sendfile or a write from
+    memory instead of resolving and checking the path on every request.
+
+    Files up to memory_size bytes are kept in memory until memory_max_bytes is used. Files with names matching
+    hashed_name are served with a Cache-Control header allowing clients to cache them forever. Changes to the
+    directory aren't seen unless the index is rebuilt, start() checks for changes every watch_interval seconds,
+    eg. in development.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        *,
+        memory_size: int = 16 * 1024,
+        memory_max_bytes: int = 16 * 1024 ** 2,
+        hashed_name: Pattern = HASHED_NAME,
+    ):
+        self.directory = Path(directory)
+        self.memory_size = memory_size
+        self.memory_max_bytes = memory_max_bytes
+        self.hashed_name = hashed_name
+        self.files: Dict[str, StaticFile] = {}
+        self.memory_bytes = 0
+        self._stats: Dict[Path, tuple] = {}
+        self._task = None
+
+    def build(self, stats: Dict[Path, os.stat_result] = None) -> None:
+        start = time()
+        stats = self._scan() if stats is None else stats
+        self.memory_bytes = 0
+        files = {}
+        for path, stat in stats.items():
+            if path.suffix in {'.br', '.gz'} and path.with_suffix('') in stats:
+                continue
+            variants = {'identity': self._variant(path, stat)}
+            for encoding, suffix in ENCODING_SUFFIXES.items():
+                compressed_path = path.with_name(path.name + suffix)
+                compressed_stat = stats.get(compressed_path)
+                # like precompress_directory, compressed files older than the original are out of date
+                if compressed_stat and compressed_stat.st_mtime >= stat.st_mtime:
+                    variants[encoding] = self._variant(compressed_path, compressed_stat)
+            content_type = mimetypes.guess_type(path.name)[0] or 'application/octet-stream'
+            key = path.relative_to(self.directory).as_posix()
+            files[key] = StaticFile(content_type, bool(self.hashed_name.fullmatch(path.name)), variants)
+
+        self.files = files
+        self._stats = self._signature(stats)
+        logger.info(
+            'static index built with %d files, %d bytes in memory, in %0.2fs',
+            len(files),
+            self.memory_bytes,
+            time() - start,
+        )
+
+    def _scan(self) -> Dict[Path, os.stat_result]:
+        root = self.directory.resolve()
+        return {p: p.stat() for p in self.directory.glob('**/*') if p.is_file() and _inside(p, root)}
+
+    @staticmethod
+    def _signature(stats: Dict[Path, os.stat_result]) -> Dict[Path, tuple]:
+        return {p: (s.st_mtime_ns, s.st_size) for p, s in stats.items()}
+
+    def _variant(self, path: Path, stat: os.stat_result) -> StaticVariant:
+        variant = StaticVariant(path, stat.st_size, f'W/"{stat.st_mtime_ns:x}-{stat.st_size:x}"')
+        if stat.st_size <= self.memory_size and self.memory_bytes + stat.st_size <= self.memory_max_bytes:
+            variant.body = path.read_bytes()
+            self.memory_bytes += stat.st_size
+        return variant
+
+    def response(self, request, path: str, headers: Dict[str, str] = None) -> StreamResponse:
+        """
+        Response for path relative to the directory, unknown paths get index.html.
+        """
+        static_file = self.files.get(path) or self.files.get('index.html')
+        if static_file is None:
+            raise HTTPNotFound()
+
+        encoding = accepted_encoding(request.headers.get('Accept-Encoding', ''), static_file.variants)
+        variant = static_file.variants[encoding or 'identity']
+        headers = {**(headers or {}), 'ETag': variant.etag}
+        if static_file.immutable:
+            headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        if len(static_file.variants) > 1:
+            headers['Vary'] = 'Accept-Encoding'
+
+        if etag_matches(request.headers.get('If-None-Match'), variant.etag):
+            return Response(status=304, headers={h: v for h, v in headers.items() if h in NOT_MODIFIED_HEADERS})
+
+        headers['Content-Type'] = static_file.content_type
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        if variant.body is not None:
+            return Response(body=variant.body, headers=headers)
+        else:
+            return FileResponse(variant.path, headers=headers)
+
+    async def start(self, watch_interval: float) -> None:
+        self._task = asyncio.ensure_future(self._watch(watch_interval))
+
+    async def _watch(self, interval: float):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                stats = await loop.run_in_executor(None, self._scan)
+                if self._signature(stats) != self._stats:
+                    await loop.run_in_executor(None, self.build, stats)
+            except Exception:
+                logger.exception('error rebuilding static index for %s', self.directory)
+
+    async def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+
+    @classmethod
+    def from_settings(cls, directory: Path, settings: BaseSettings) -> 'StaticIndex':
+        return cls(
+            directory,
+            memory_size=settings.static_index_memory_size,
+            memory_max_bytes=settings.static_index_memory_max_bytes,
+            hashed_name=settings.static_index_hashed_name or HASHED_NAME,
+        )
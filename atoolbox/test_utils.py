@@ -3,6 +3,7 @@ import os
 import sys
 from dataclasses import dataclass
 from typing import List
+from urllib.parse import urlparse
 
 import aiodns
 from aiohttp import web
@@ -110,3 +111,15 @@ class Offline:
             return True
         else:
             return False
+
+
+def xdist_pg_dsn(dsn: str) -> str:
+    """
+    Give each pytest-xdist worker its own database by appending the worker id to the database name,
+    eg. ".../app_test" becomes ".../app_test_gw0", combine with settings.pg_template_db for fast setup.
+    """
+    worker = os.getenv('PYTEST_XDIST_WORKER')
+    if not worker:
+        return dsn
+    parsed = urlparse(dsn)
+    return parsed._replace(path=f'{parsed.path}_{worker}').geturl()
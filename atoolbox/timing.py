@@ -0,0 +1,99 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import time
+from typing import Dict, List, Optional
+
+_current_timings: ContextVar[Optional['RequestTimings']] = ContextVar('atoolbox_timings', default=None)
+
+
+class RequestTimings:
+    """
+    Durations of the phases of a request, eg. "queue", "pg-acquire", "db", "json" and "handler".
+
+    Each phase may be recorded multiple times, the total duration and count are kept.
+    """
+
+    __slots__ = ('phases',)
+
+    def __init__(self):
+        # phase name -> [total duration in seconds, count]
+        self.phases: Dict[str, List[float]] = {}
+
+    def add(self, name: str, duration: float) -> None:
+        phase = self.phases.get(name)
+        if phase is None:
+            self.phases[name] = [duration, 1]
+        else:
+            phase[0] += duration
+            phase[1] += 1
+
+    @contextmanager
+    def measure(self, name: str):
+        start = time()
+        try:
+            yield
+        finally:
+            self.add(name, time() - start)
+
+    def server_timing(self) -> str:
+        """
+        Value for the "Server-Timing" header, see https://www.w3.org/TR/server-timing/.
+        """
+        parts = []
+        for name, (duration, count) in self.phases.items():
+            part = f'{name};dur={duration * 1000:0.2f}'
+            if count > 1:
+                part += f';desc="{count:0.0f}"'
+            parts.append(part)
+        return ', '.join(parts)
+
+    def summary(self) -> str:
+        """
+        Short summary suitable for the access log.
+        """
+        parts = []
+        for name, (duration, count) in self.phases.items():
+            part = f'{name}={duration * 1000:0.0f}ms'
+            if count > 1:
+                part += f'/{count:0.0f}'
+            parts.append(part)
+        return ' '.join(parts)
+
+    def __repr__(self) -> str:
+        return f'<RequestTimings {self.summary()}>'
+
+
+def start_timings(request) -> RequestTimings:
+    """
+    Create timings for a request, make them available via request['timings'] and get_timings().
+    """
+    timings = RequestTimings()
+    request['timings'] = timings
+    _current_timings.set(timings)
+    return timings
+
+
+def get_timings() -> Optional[RequestTimings]:
+    """
+    Get the timings of the request currently being processed, if any.
+    """
+    return _current_timings.get()
+
+
+def record(name: str, duration: float) -> None:
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.add(name, duration)
+
+
+@contextmanager
+def measure(name: str):
+    """
+    Measure the duration of a phase of the current request, does nothing outside a request.
+    """
+    timings = _current_timings.get()
+    if timings is None:
+        yield
+    else:
+        with timings.measure(name):
+            yield
@@ -3,11 +3,13 @@ import re
 from typing import Any, Type, TypeVar, Union
 
 from aiohttp.web import Response
+from multidict import CIMultiDict
 from pydantic import BaseModel, ValidationError, validate_model
 from pydantic.fields import SHAPE_SINGLETON
 
 from .exceptions import JsonErrors
 from .json_tools import JSON_CONTENT_TYPE
+from .timing import measure
 
 IP_HEADER = 'X-Forwarded-For'
 PROTO_HEADER = 'X-Forwarded-Proto'
@@ -43,9 +45,29 @@ def raw_json_response(json_str: Union[str, bytes, None], status_: int = 200):
     return Response(body=body + b'\n', status=status_, content_type=JSON_CONTENT_TYPE)
 
 
+# headers which shouldn't be included when storing a response to replay later
+UNSTORED_HEADERS = {'Content-Length', 'Date', 'Server', 'Set-Cookie', 'Transfer-Encoding'}
+
+
+def response_to_bytes(response: Response) -> bytes:
+    """
+    Serialise a response with a bytes body (eg. from json_response) so it can be stored and replayed.
+    """
+    headers = [(k, v) for k, v in response.headers.items() if k not in UNSTORED_HEADERS]
+    return json.dumps({'status': response.status, 'headers': headers}).encode() + b'\n' + response.body
+
+
+def response_from_bytes(data: bytes) -> Response:
+    meta, body = data.split(b'\n', 1)
+    meta = json.loads(meta)
+    return Response(body=body, status=meta['status'], headers=CIMultiDict(meta['headers']))
+
+
 def json_response(*, status_=200, list_=None, headers_=None, **data):
+    with measure('json'):
+        body = json.dumps(data if list_ is None else list_).encode()
     return Response(
-        body=json.dumps(data if list_ is None else list_).encode() + b'\n',
+        body=body + b'\n',
         status=status_,
         content_type=JSON_CONTENT_TYPE,
         headers=headers_,
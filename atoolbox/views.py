@@ -13,19 +13,24 @@ async def spa_static_handler(request):
 
     Use with web.get(r'/{path:.*}', spa_static_handler, name='static')
 
-    modified from aiohttp_web_urldispatcher.StaticResource_handle
+    modified from aiohttp_web_urldispatcher.StaticResource_handle, with settings.static_index files are served
+    from an index of app['static_dir'] built at startup.
     """
     request_path = request.match_info['path'].lstrip('/')
 
     directory = request.app['static_dir']
     csp_headers = request.app.get('static_headers') or {}
-    if request_path == '':
-        return FileResponse(directory / 'index.html', headers=csp_headers)
-
     # probably other paths to return 404 for?
     if request_path.startswith('.well-known/'):
         raise HTTPNotFound()
 
+    static_index = request.app.get('static_index')
+    if static_index:
+        return static_index.response(request, request_path or 'index.html', csp_headers)
+
+    if request_path == '':
+        return FileResponse(directory / 'index.html', headers=csp_headers)
+
     try:
         filename = Path(request_path)
         if filename.anchor:  # pragma: no cover
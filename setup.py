@@ -62,6 +62,7 @@ setup(
             'aiohttp-session>=2.7.0',
             'arq>=0.16',
             'asyncpg>=0.17.0',
+            'brotli>=1.0.7',
             'buildpg>=0.2.1',
             'cryptography>=2.4.1',
             'ipython>=7.7.0',
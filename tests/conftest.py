@@ -6,12 +6,13 @@ from pathlib import Path
 import pytest
 from aiohttp.test_utils import teardown_test_loop
 
-from atoolbox.test_utils import DummyServer, create_dummy_server
+from atoolbox.test_utils import DummyServer, create_dummy_server, xdist_pg_dsn
 from demo.main import create_app
 from demo.settings import Settings
 
 settings_args = dict(
-    pg_dsn='postgres://postgres@localhost:5432/atoolbox_test',
+    pg_dsn=xdist_pg_dsn('postgres://postgres@localhost:5432/atoolbox_test'),
+    pg_template_db='atoolbox_test_template',
     redis_settings='redis://localhost:6379/6',
     create_app='tests.demo.main.create_app',
     sql_path='tests/demo/models.sql',
@@ -90,7 +91,7 @@ async def _fix_cli(settings, db_conn, aiohttp_client, redis, loop):
     app.on_startup.insert(0, pre_startup_app)
     cli = await aiohttp_client(app)
 
-    async def post_json(url, data=None, *, origin=None):
+    async def post_json(url, data=None, *, origin=None, headers=None):
         if isinstance(data, (dict, list)):
             data = json.dumps(data)
 
@@ -101,6 +102,7 @@ async def _fix_cli(settings, db_conn, aiohttp_client, redis, loop):
                 'Content-Type': 'application/json',
                 'Referer': f'http://127.0.0.1:{cli.server.port}/foobar/',
                 'Origin': origin or f'http://127.0.0.1:{cli.server.port}',
+                **(headers or {}),
             },
         )
 
@@ -1,3 +1,4 @@
+import asyncio
 from enum import Enum
 from pathlib import Path
 
@@ -9,6 +10,8 @@ from atoolbox import create_default_app, parse_request_json
 from atoolbox.auth import check_grecaptcha
 from atoolbox.bread import Bread
 from atoolbox.class_views import ExecView
+from atoolbox.rate_limit import rate_limit
+from atoolbox.single_flight import single_flight
 from atoolbox.test_utils import return_any_status
 from atoolbox.utils import JsonErrors, decrypt_json, encrypt_json, json_response
 from atoolbox.views import spa_static_handler
@@ -20,6 +23,23 @@ async def handle_200(request):
     return web.Response(text='testing')
 
 
+async def handle_sleep(request):
+    await asyncio.sleep(float(request.query.get('t', '0.1')))
+    return json_response(status='ok')
+
+
+@rate_limit(2, per=60)
+async def rate_limited(request):
+    return json_response(status='ok')
+
+
+@single_flight()
+async def coalesced(request):
+    request.app['coalesced_calls'] = calls = request.app.get('coalesced_calls', 0) + 1
+    await asyncio.sleep(0.1)
+    return json_response(calls=calls, headers_={'X-Calls': str(calls)})
+
+
 async def handle_user(request):
     session = await new_session(request)
     session.update({'user_id': await request['conn'].fetchval('SELECT id FROM users')})
@@ -121,6 +141,9 @@ async def create_app(settings):
         web.get('/', handle_200, name='index'),
         web.route('*', r'/status/{status:\d+}/', return_any_status, name='any-status'),
         web.get('/user/', handle_user),
+        web.get('/sleep/', handle_sleep, name='sleep'),
+        web.get('/rate-limited/', rate_limited, name='rate-limited'),
+        web.get('/coalesced/', coalesced, name='coalesced'),
         web.get('/request-context/', request_context),
         web.get('/errors/{do}', handle_errors),
         web.route('*', '/exec/', TestExecView.view()),
@@ -1,6 +1,6 @@
 from typing import List, Pattern
 
-from atoolbox import BaseSettings, patch
+from atoolbox import BaseSettings, Batch, patch
 
 
 class Settings(BaseSettings):
@@ -8,6 +8,8 @@ class Settings(BaseSettings):
     csrf_cross_origin_paths: List[Pattern] = ['/exec/', '/exec-simple/']
     csrf_upload_paths: List[Pattern] = ['/upload-path/']
     patch_paths: List[str] = ['math']
+    single_flight = True
+    rate_limit = True
 
 
 @patch
@@ -32,3 +34,23 @@ def non_coro(*, conn, settings, args, **kwargs):
     this is not a coroutine.
     """
     return len(args)
+
+
+@patch(batched=True, batch_delay=0, total_sql='SELECT count(*) FROM organisations')
+async def lower_slugs(*, conn, after, **kwargs):
+    """
+    this is a "batched" patch
+    """
+    v = await conn.fetchrow(
+        """
+        WITH batch AS (
+          SELECT id FROM organisations WHERE id > $1 ORDER BY id LIMIT 100
+        ), updated AS (
+          UPDATE organisations o SET slug=lower(slug) FROM batch WHERE o.id = batch.id
+        )
+        SELECT max(id), count(*) FROM batch
+        """,
+        after or 0,
+    )
+    last_key, rows = v
+    return Batch(last_key=last_key, rows=rows) if rows else None
@@ -0,0 +1,198 @@
+import asyncio
+from datetime import datetime
+from time import time
+
+import pytest
+
+from atoolbox import create_default_app
+from atoolbox.cache import CACHE_TOPIC, LRU, Cache, PickleSerializer, _Entry
+from atoolbox.invalidation import InvalidationHub
+from atoolbox.settings import BaseSettings
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, *, pexpire):
+        self.data[key] = value
+
+    async def delete(self, key):
+        self.data.pop(key, None)
+
+
+class FakePubSubRedis(FakeRedis):
+    def __init__(self):
+        super().__init__()
+        self.hubs = []
+
+    async def publish(self, channel, payload):
+        for hub in self.hubs:
+            hub._on_message(payload)
+
+
+def test_lru_evictions():
+    lru = LRU(max_bytes=10)
+    expires = time() + 10
+    lru.set('a', _Entry('a', 4, expires, 0))
+    lru.set('b', _Entry('b', 4, expires, 0))
+    assert lru.get('a').value == 'a'
+    lru.set('c', _Entry('c', 4, expires, 0))
+    assert list(lru.data) == ['a', 'c']
+    assert lru.size == 8
+    assert lru.evictions == 1
+    lru.set('big', _Entry('big', 11, expires, 0))
+    assert 'big' not in lru.data
+    lru.set('old', _Entry('old', 1, time() - 1, 0))
+    assert lru.get('old') is None
+    assert lru.size == 8
+
+
+async def test_two_tiers():
+    redis = FakeRedis()
+    cache = Cache(redis)
+    await cache.set('foo', {'x': [1, 2]})
+    assert await cache.get('foo') == {'x': [1, 2]}
+    assert cache.hits == {'local': 1, 'redis': 0}
+
+    # another process
+    cache2 = Cache(redis)
+    assert await cache2.get('foo') == {'x': [1, 2]}
+    assert await cache2.get('foo') == {'x': [1, 2]}
+    assert cache2.hits == {'local': 1, 'redis': 1}
+    assert await cache2.get('missing', 'default') == 'default'
+    assert cache2.misses == 1
+
+    await cache.delete('foo')
+    assert redis.data == {}
+    assert await cache.get('foo') is None
+
+
+async def test_same_value_both_tiers():
+    redis = FakeRedis()
+    cache = Cache(redis)
+    now = datetime(2020, 1, 2, 3, 4, 5)
+    await cache.set('when', now)
+    assert await cache.get('when') == '2020-01-02T03:04:05'
+    assert await Cache(redis).get('when') == '2020-01-02T03:04:05'
+    assert await cache.get_or_set('other', lambda: asyncio.sleep(0, result=now)) == '2020-01-02T03:04:05'
+
+    cache = Cache(redis, serializer=PickleSerializer())
+    await cache.set('when', now)
+    assert await cache.get('when') == now
+    assert await Cache(redis, serializer=PickleSerializer()).get('when') == now
+
+
+async def test_get_or_set():
+    cache = Cache(ttl=10, negative_ttl=1, early_refresh_beta=0)
+    calls = 0
+
+    async def compute():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return 'value'
+
+    assert await asyncio.gather(*(cache.get_or_set('k', compute) for _ in range(5))) == ['value'] * 5
+    assert calls == 1
+    assert cache._locks == {}
+    assert await cache.get_or_set('k', compute) == 'value'
+    assert calls == 1
+
+
+async def test_negative_caching():
+    cache = Cache(ttl=100, negative_ttl=0.01)
+    calls = 0
+
+    async def compute():
+        nonlocal calls
+        calls += 1
+
+    assert await cache.get_or_set('k', compute) is None
+    assert await cache.get_or_set('k', compute) is None
+    assert calls == 1
+    await asyncio.sleep(0.02)
+    assert await cache.get_or_set('k', compute) is None
+    assert calls == 2
+
+
+async def test_early_refresh(mocker):
+    cache = Cache(serializer=PickleSerializer(), early_refresh_beta=1)
+    cache.local.set('k', _Entry({1, 2}, 10, time() + 5, 1))
+    mocker.patch('atoolbox.cache.random.random', return_value=0.1)
+    assert await cache.get_or_set('k', lambda: asyncio.sleep(0, result='new')) == {1, 2}
+
+    mocker.patch('atoolbox.cache.random.random', return_value=0.999)
+    assert await cache.get_or_set('k', lambda: asyncio.sleep(0, result='new')) == 'new'
+    assert cache.early_refreshes == 1
+
+
+async def test_invalidation():
+    hub = InvalidationHub('redis')
+    cache = Cache(invalidation=hub)
+    cache.local.set('a', _Entry(1, 1, time() + 10, 0))
+    cache.local.set('b', _Entry(2, 1, time() + 10, 0))
+    await hub.dispatch(CACHE_TOPIC, 'a')
+    assert list(cache.local.data) == ['b']
+    await hub.dispatch(CACHE_TOPIC, None)
+    assert cache.local.data == {}
+
+
+async def test_invalidation_other_processes():
+    redis = FakePubSubRedis()
+    hub1, hub2 = InvalidationHub('redis'), InvalidationHub('redis')
+    for hub in redis.hubs + [hub1, hub2]:
+        hub._app = {'redis': redis}
+        redis.hubs.append(hub)
+    cache1, cache2 = Cache(redis, invalidation=hub1), Cache(redis, invalidation=hub2)
+    await cache2.set('a', 1)
+    await asyncio.sleep(0)
+    assert list(cache2.local.data) == ['a']
+    await cache1.set('a', 2)
+    await asyncio.sleep(0)
+    # the process which set the value keeps it locally, others drop their old value
+    assert list(cache1.local.data) == ['a']
+    assert cache2.local.data == {}
+    assert await cache2.get('a') == 2
+
+
+async def test_invalidation_without_redis():
+    redis = FakePubSubRedis()
+    hub1, hub2 = InvalidationHub('redis'), InvalidationHub('redis')
+    for hub in (hub1, hub2):
+        hub._app = {'redis': redis}
+        redis.hubs.append(hub)
+    # the local tier only, eg. settings.cache with the pg invalidation backend
+    cache1, cache2 = Cache(invalidation=hub1), Cache(invalidation=hub2)
+    await cache2.set('a', 1)
+    await asyncio.sleep(0)
+    await cache1.set('a', 2)
+    await asyncio.sleep(0)
+    assert await cache1.get('a') == 2
+    assert await cache2.get('a') is None
+
+
+async def test_metrics():
+    cache = Cache()
+    await cache.set('foo', 'bar')
+    await cache.get('foo')
+    await cache.get('x')
+    families = {f.name: f.samples for f in cache.metrics(None)}
+    assert families['atoolbox_cache_hits_total'] == [
+        ('atoolbox_cache_hits_total', {'tier': 'local'}, 1),
+        ('atoolbox_cache_hits_total', {'tier': 'redis'}, 0),
+    ]
+    assert families['atoolbox_cache_misses_total'] == [('atoolbox_cache_misses_total', {}, 1)]
+    assert families['atoolbox_cache_local_bytes'] == [('atoolbox_cache_local_bytes', {}, 5)]
+
+
+@pytest.mark.parametrize('cache_setting,exists', [(True, True), (False, False)])
+async def test_app_cache(cache_setting, exists):
+    settings = BaseSettings(pg_dsn=None, redis_settings=None, create_http_client=False, cache=cache_setting)
+    app = await create_default_app(settings=settings)
+    for func in app.on_startup:
+        await func(app)
+    assert ('cache' in app) is exists
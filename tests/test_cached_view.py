@@ -0,0 +1,128 @@
+import asyncio
+
+from aiohttp import web
+
+from atoolbox import View, create_default_app
+from atoolbox.cached_view import cached_view
+from atoolbox.settings import BaseSettings
+from atoolbox.utils import json_response
+
+
+@cached_view(ttl=10, vary=['Accept-Language'])
+async def counted(request):
+    request.app['calls'] += 1
+    return json_response(calls=request.app['calls'], pk=request.match_info['pk'])
+
+
+@cached_view(ttl=0.05, stale_ttl=10)
+async def stale(request):
+    request.app['calls'] += 1
+    calls = request.app['calls']
+    await asyncio.sleep(0.02)
+    return json_response(calls=calls)
+
+
+@cached_view(ttl=10)
+async def error(request):
+    request.app['calls'] += 1
+    return json_response(calls=request.app['calls'], status_=404)
+
+
+@cached_view(ttl=10)
+class ClassView(View):
+    async def call(self):
+        self.app['calls'] += 1
+        return json_response(calls=self.app['calls'])
+
+
+async def create_app(aiohttp_client, **settings):
+    settings.setdefault('cache', True)
+    settings = BaseSettings(pg_dsn=None, redis_settings=None, create_http_client=False, **settings)
+    routes = [
+        web.get(r'/counted/{pk:\d+}/', counted, name='counted'),
+        web.get('/stale/', stale, name='stale'),
+        web.get('/error/', error, name='error'),
+        web.get('/class/', ClassView.view(), name='class_view'),
+    ]
+    app = await create_default_app(settings=settings, routes=routes)
+    app['calls'] = 0
+    app['pg_middleware_check'] = lambda r: False
+    return await aiohttp_client(app)
+
+
+async def test_cached(aiohttp_client):
+    cli = await create_app(aiohttp_client)
+    r = await cli.get('/counted/1/?b=2&a=1')
+    assert r.headers['X-Cache'] == 'miss'
+    assert await r.json() == {'calls': 1, 'pk': '1'}
+
+    r = await cli.get('/counted/1/?a=1&b=2')
+    assert r.headers['X-Cache'] == 'hit'
+    assert r.headers['Content-Type'] == 'application/json'
+    assert await r.json() == {'calls': 1, 'pk': '1'}
+
+    r = await cli.get('/counted/2/?a=1&b=2')
+    assert await r.json() == {'calls': 2, 'pk': '2'}
+    r = await cli.get('/counted/1/?a=1&b=2', headers={'Accept-Language': 'fr'})
+    assert await r.json() == {'calls': 3, 'pk': '1'}
+    r = await cli.get('/counted/1/?a=1&b=2', headers={'Accept-Language': 'fr'})
+    assert await r.json() == {'calls': 3, 'pk': '1'}
+
+
+async def test_class_view(aiohttp_client):
+    cli = await create_app(aiohttp_client)
+    assert await (await cli.get('/class/')).json() == {'calls': 1}
+    r = await cli.get('/class/')
+    assert r.headers['X-Cache'] == 'hit'
+    assert await r.json() == {'calls': 1}
+
+
+async def test_error_not_cached(aiohttp_client):
+    cli = await create_app(aiohttp_client)
+    assert await (await cli.get('/error/')).json() == {'calls': 1}
+    r = await cli.get('/error/')
+    assert r.status == 404
+    assert r.headers['X-Cache'] == 'miss'
+    assert await r.json() == {'calls': 2}
+
+
+async def test_stale_while_revalidate(aiohttp_client):
+    cli = await create_app(aiohttp_client)
+    assert await (await cli.get('/stale/')).json() == {'calls': 1}
+    await asyncio.sleep(0.1)
+
+    r1, r2 = await asyncio.gather(cli.get('/stale/'), cli.get('/stale/'))
+    # one request refreshes the response, the other gets the stale response meanwhile
+    assert sorted([r1.headers['X-Cache'], r2.headers['X-Cache']]) == ['miss', 'stale']
+    assert sorted([(await r1.json())['calls'], (await r2.json())['calls']]) == [1, 2]
+    assert cli.server.app['calls'] == 2
+    assert cli.server.app['cached_view_refreshing'] == set()
+
+    r = await cli.get('/stale/')
+    assert r.headers['X-Cache'] == 'hit'
+    assert await r.json() == {'calls': 2}
+
+
+async def test_publish_only_on_refresh(aiohttp_client):
+    cli = await create_app(aiohttp_client)
+    published = []
+
+    async def publish(key):
+        published.append(key)
+
+    cli.server.app['cache']._publish = publish
+    await cli.get('/stale/')
+    # a new key, no other process can have it
+    assert published == []
+    await asyncio.sleep(0.1)
+    r = await cli.get('/stale/')
+    assert r.headers['X-Cache'] == 'miss'
+    assert published == ['view:stale:::']
+
+
+async def test_cache_disabled(aiohttp_client):
+    cli = await create_app(aiohttp_client, cache=False)
+    await cli.get('/class/')
+    r = await cli.get('/class/')
+    assert 'X-Cache' not in r.headers
+    assert await r.json() == {'calls': 2}
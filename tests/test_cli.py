@@ -127,11 +127,17 @@ def test_patch_func_returns(caplog, env, db_conn):
     assert 'result: 3' in caplog.text
 
 
+def test_patch_batched(caplog, env, db_conn):
+    assert 0 == cli_main('patch', 'lower_slugs', '--live')
+    assert 'running patch lower_slugs batched live True' in caplog.text
+    assert 'patch lower_slugs complete, 0 rows processed' in caplog.text
+
+
 def test_patch_not_found(caplog, env, db_conn):
     assert 1 == cli_main('patch', 'xxx')
     assert (
-        'patch "xxx" not found in patches: [\'rerun_sql\', \'error_patch\', \'direct_path\', \'non_coro\']'
-        in caplog.text
+        'patch "xxx" not found in patches: '
+        "['rerun_sql', 'error_patch', 'direct_path', 'non_coro', 'lower_slugs']" in caplog.text
     )
 
 
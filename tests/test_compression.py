@@ -0,0 +1,102 @@
+import gzip
+import json
+import os
+
+import pytest
+from aiohttp import web
+
+from atoolbox import BaseSettings, create_default_app, json_response
+from atoolbox.compression import Compressor, accepted_encoding, brotli, precompress_directory
+
+
+async def compression_client(aiohttp_client):
+    async def big(request):
+        return json_response(list_=list(range(1000)))
+
+    async def small(request):
+        return json_response(x=1)
+
+    async def schema(request):
+        return json_response(list_=['schema'] * 500)
+
+    async def image(request):
+        return web.Response(body=b'x' * 5000, content_type='image/png')
+
+    settings = BaseSettings(
+        pg_dsn=None, redis_settings=None, create_http_client=False, compression=True, compression_executor_size=2000
+    )
+    routes = [
+        web.get('/big/', big),
+        web.get('/small/', small),
+        web.options('/schema/', schema),
+        web.get('/image/', image),
+    ]
+    app = await create_default_app(settings=settings, routes=routes)
+    app['pg_middleware_check'] = lambda r: False
+    return await aiohttp_client(app, auto_decompress=False)
+
+
+async def test_gzip(aiohttp_client):
+    cli = await compression_client(aiohttp_client)
+    r = await cli.get('/big/', headers={'Accept-Encoding': 'gzip'})
+    assert r.status == 200
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert r.headers['Vary'] == 'Accept-Encoding'
+    body = await r.read()
+    assert int(r.headers['Content-Length']) == len(body)
+    assert gzip.decompress(body) == json_response(list_=list(range(1000))).body
+
+
+async def test_not_compressed(aiohttp_client):
+    cli = await compression_client(aiohttp_client)
+    r = await cli.get('/big/', headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in r.headers
+    assert r.headers['Vary'] == 'Accept-Encoding'
+
+    r = await cli.get('/small/', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in r.headers
+    r = await cli.get('/image/', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in r.headers
+
+
+async def test_cached(aiohttp_client):
+    cli = await compression_client(aiohttp_client)
+    compressor: Compressor = cli.server.app['compressor']
+    for _ in range(2):
+        r = await cli.options('/schema/', headers={'Accept-Encoding': 'gzip;q=0.5, br;q=0'})
+        assert r.headers['Content-Encoding'] == 'gzip'
+        assert json.loads(gzip.decompress(await r.read())) == ['schema'] * 500
+    assert len(compressor.cache.data) == 1
+
+    await cli.get('/big/', headers={'Accept-Encoding': 'gzip'})
+    assert len(compressor.cache.data) == 1
+
+
+@pytest.mark.parametrize(
+    'header,encoding',
+    [
+        ('gzip, deflate', 'gzip'),
+        ('gzip;q=0', None),
+        ('deflate', None),
+        ('', None),
+        ('*', 'br' if brotli else 'gzip'),
+        ('br, gzip', 'br' if brotli else 'gzip'),
+    ],
+)
+def test_accepted_encoding(header, encoding):
+    assert accepted_encoding(header) == encoding
+
+
+def test_precompress_directory(tmp_path):
+    (tmp_path / 'app.js').write_text('console.log(1);\n' * 100)
+    (tmp_path / 'small.css').write_text('a {}')
+    (tmp_path / 'logo.png').write_bytes(b'x' * 2000)
+    count = precompress_directory(tmp_path)
+    assert count == (2 if brotli else 1)
+    assert gzip.decompress((tmp_path / 'app.js.gz').read_bytes()) == (tmp_path / 'app.js').read_bytes()
+    assert not (tmp_path / 'small.css.gz').exists()
+    assert not (tmp_path / 'logo.png.gz').exists()
+    assert precompress_directory(tmp_path) == 0
+
+    os.utime(tmp_path / 'app.js', (1e10, 1e10))
+    assert precompress_directory(tmp_path) == count
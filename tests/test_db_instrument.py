@@ -0,0 +1,104 @@
+import logging
+
+from aiohttp.test_utils import make_mocked_request
+from buildpg import Values
+
+from atoolbox.db.instrument import InstrumentedConnection, log_repeated_queries, query_shape
+from atoolbox.timing import get_timings, start_timings
+from conftest import pre_startup_app
+from demo.main import create_app
+
+
+class FakeConn:
+    def __init__(self):
+        self.calls = []
+
+    async def fetchval(self, query, *args, column=0, timeout=None):
+        self.calls.append(('fetchval', query, args))
+        return 42
+
+    async def execute(self, query, *args, timeout=None):
+        self.calls.append(('execute', query, args))
+        return 'INSERT 0 1'
+
+    def transaction(self):
+        return 'transaction'
+
+
+async def test_instrumented_queries():
+    request = make_mocked_request('GET', '/')
+    start_timings(request)
+    fake_conn = FakeConn()
+    conn = InstrumentedConnection(fake_conn)
+    assert await conn.fetchval('SELECT $1', 1) == 42
+    assert await conn.execute_b('INSERT INTO t (:values__names) VALUES :values', values=Values(a=1, b='x')) == (
+        'INSERT 0 1'
+    )
+    assert fake_conn.calls == [
+        ('fetchval', 'SELECT $1', (1,)),
+        ('execute', 'INSERT INTO t (a, b) VALUES ($1, $2)', (1, 'x')),
+    ]
+    assert conn.transaction() == 'transaction'
+    assert sum(conn.queries.values()) == 2
+    assert get_timings().phases['db'][1] == 2
+    assert repr(conn).endswith(' queries=2>')
+
+
+async def test_slow_query(caplog):
+    caplog.set_level(logging.WARNING, 'atoolbox.db')
+    conn = InstrumentedConnection(FakeConn(), slow_threshold=0)
+    await conn.fetchval('SELECT $1', 'secret')
+    assert len(caplog.records) == 1
+    assert caplog.records[0].getMessage() == 'slow query 0ms query:\nSELECT $1'
+
+
+async def test_slow_query_params(caplog):
+    caplog.set_level(logging.WARNING, 'atoolbox.db')
+    conn = InstrumentedConnection(FakeConn(), slow_threshold=0, log_params=True)
+    await conn.fetchval('SELECT $1', 'x' * 1000)
+    assert len(caplog.records) == 1
+    msg = caplog.records[0].getMessage()
+    assert msg == "slow query 0ms params: ('" + 'x' * 498 + "... query:\nSELECT $1"
+
+
+async def test_print_query():
+    printed = []
+    conn = InstrumentedConnection(FakeConn())
+    assert await conn.fetchval_b('SELECT :a', a=1, print_=printed.append) == 42
+    assert printed == ['params: [1] query:\nSELECT $1']
+
+
+def test_query_shape():
+    assert query_shape("SELECT * FROM t WHERE id = 1 AND name = 'it''s'") == 'SELECT * FROM t WHERE id = ? AND name = ?'
+    assert query_shape('SELECT *\n  FROM t WHERE id IN ($1, $2, $3)') == 'SELECT * FROM t WHERE id IN (?)'
+    assert query_shape('SELECT * FROM t2 WHERE id IN (1,2)') == 'SELECT * FROM t2 WHERE id IN (?)'
+
+
+async def test_repeated_queries(caplog):
+    caplog.set_level(logging.WARNING, 'atoolbox.db')
+    conn = InstrumentedConnection(FakeConn())
+    for i in range(4):
+        await conn.fetchval(f'SELECT name FROM users WHERE id = {i}')
+    await conn.fetchval('SELECT 1')
+    assert conn.repeated_queries(3) == {'SELECT name FROM users WHERE id = ?': 4}
+
+    request = make_mocked_request('GET', '/foo/')
+    log_repeated_queries(request, conn, None)
+    log_repeated_queries(request, conn, 4)
+    assert caplog.records == []
+    log_repeated_queries(request, conn, 3)
+    assert caplog.records[0].getMessage() == (
+        'GET /foo/ ran the same query 4 times, possible N+1 query:\nSELECT name FROM users WHERE id = ?'
+    )
+
+
+async def test_server_timing_db(settings, db_conn, aiohttp_client):
+    settings.server_timing = True
+    app = await create_app(settings=settings)
+    app['test_conn'] = db_conn
+    app.on_startup.insert(0, pre_startup_app)
+    cli = await aiohttp_client(app)
+
+    r = await cli.get('/orgs/')
+    assert r.status == 200, await r.text()
+    assert 'db;dur=' in r.headers['Server-Timing']
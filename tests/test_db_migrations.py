@@ -0,0 +1,152 @@
+import logging
+import os
+
+import pytest
+
+from atoolbox.cli import main as cli_main
+from atoolbox.db.migrations import (
+    LOCK_KEY,
+    MIGRATIONS_TABLE,
+    Migration,
+    apply_migrations,
+    load_migrations,
+    mark_migrations_applied,
+)
+from atoolbox.settings import BaseSettings
+
+
+@pytest.fixture(name='migrations_dir')
+def _fix_migrations_dir(tmp_path):
+    (tmp_path / '0001_add_table.sql').write_text('create table migrated (id serial primary key, name varchar(255));')
+    (tmp_path / '0002_add_index.sql').write_text(
+        '-- no-transaction\ncreate index concurrently if not exists migrated_name on migrated (name);\n'
+    )
+    (tmp_path / 'README.md').write_text('not a migration')
+    return tmp_path
+
+
+def test_load_migrations(migrations_dir):
+    migrations = load_migrations(migrations_dir)
+    assert [(m.id, m.name, m.transaction) for m in migrations] == [
+        (1, '0001_add_table.sql', True),
+        (2, '0002_add_index.sql', False),
+    ]
+    assert load_migrations(None) == []
+
+
+def test_load_migrations_duplicate(migrations_dir):
+    (migrations_dir / '02_other.sql').write_text('select 1')
+    with pytest.raises(RuntimeError, match='duplicate migration number 2'):
+        load_migrations(migrations_dir)
+
+
+def test_statements():
+    sql = """\
+-- no-transaction
+create index concurrently a on t (x);
+create function f() returns int as $$
+  select 1;
+$$ language sql;
+create function g(a int) returns int as $fn$
+  begin
+    select $$;$$;
+    return $1;
+  end;
+$fn$ language plpgsql;
+select 2
+-- trailing comment
+"""
+    assert Migration(id=1, name='x', sql=sql).statements() == [
+        '-- no-transaction\ncreate index concurrently a on t (x);',
+        'create function f() returns int as $$\n  select 1;\n$$ language sql;',
+        'create function g(a int) returns int as $fn$\n  begin\n    select $$;$$;\n    return $1;\n  end;\n'
+        '$fn$ language plpgsql;',
+        'select 2\n-- trailing comment',
+    ]
+
+
+class FakeConn:
+    def __init__(self, applied=()):
+        self.applied = list(applied)
+        self.log = []
+
+    async def execute(self, sql, *args):
+        if sql.startswith(f'insert into {MIGRATIONS_TABLE}'):
+            self.applied.append(args[0])
+        elif 'advisory' in sql:
+            self.log.append((sql.split('(')[0], args[0]))
+        elif not sql.lstrip().startswith('create table if not exists'):
+            self.log.append(sql)
+
+    async def fetch(self, sql):
+        return [(id_,) for id_ in self.applied]
+
+    def transaction(self):
+        conn = self
+
+        class Transaction:
+            async def __aenter__(self):
+                conn.log.append('begin')
+
+            async def __aexit__(self, *args):
+                conn.log.append('commit')
+
+        return Transaction()
+
+
+async def test_apply_migrations(migrations_dir, caplog):
+    caplog.set_level(logging.INFO, 'atoolbox.db')
+    settings = BaseSettings(migrations_dir=migrations_dir)
+    conn = FakeConn(applied=[1])
+    pending = await apply_migrations(conn, settings)
+    assert [m.id for m in pending] == [2]
+    assert conn.applied == [1, 2]
+    assert conn.log == [
+        ('select pg_advisory_lock', LOCK_KEY),
+        '-- no-transaction\ncreate index concurrently if not exists migrated_name on migrated (name);',
+        ('select pg_advisory_unlock', LOCK_KEY),
+    ]
+    assert 'migration 0002_add_index.sql applied in' in caplog.text
+
+    conn.log = []
+    assert await apply_migrations(conn, settings) == []
+    assert len(conn.log) == 2
+
+
+async def test_apply_migrations_not_live(migrations_dir, caplog):
+    caplog.set_level(logging.INFO, 'atoolbox.db')
+    conn = FakeConn()
+    pending = await apply_migrations(conn, BaseSettings(migrations_dir=migrations_dir), live=False)
+    assert [m.id for m in pending] == [1, 2]
+    assert conn.applied == []
+    assert '2 pending migrations, not live: 0001_add_table.sql, 0002_add_index.sql' in caplog.text
+
+
+async def test_apply_migrations_db(db_conn, migrations_dir):
+    (migrations_dir / '0002_add_index.sql').unlink()
+    settings = BaseSettings(migrations_dir=migrations_dir)
+    pending = await apply_migrations(db_conn, settings)
+    assert [m.id for m in pending] == [1]
+    assert await db_conn.fetchval('select count(*) from migrated') == 0
+    assert await db_conn.fetchval(f'select name from {MIGRATIONS_TABLE} where id=1') == '0001_add_table.sql'
+    assert await apply_migrations(db_conn, settings) == []
+
+
+async def test_mark_migrations_applied(db_conn, migrations_dir):
+    settings = BaseSettings(migrations_dir=migrations_dir)
+    await mark_migrations_applied(db_conn, settings)
+    assert await db_conn.fetchval(f'select count(*) from {MIGRATIONS_TABLE}') == 2
+    assert await apply_migrations(db_conn, settings) == []
+    assert await db_conn.fetchval("select to_regclass('migrated')") is None
+
+
+def test_migrate_cli(caplog, db_conn, tmp_path):
+    os.environ.pop('ATOOLBOX_ROOT_DIR', None)
+    os.environ['ATOOLBOX_SETTINGS'] = 'demo.settings.Settings'
+    os.environ['database_url'] = 'postgres://postgres@localhost:5432/atoolbox_test'
+    os.environ['migrations_dir'] = str(tmp_path)
+    try:
+        assert 0 == cli_main('migrate')
+    finally:
+        os.environ.pop('migrations_dir')
+    assert 'running migrate...' in caplog.text
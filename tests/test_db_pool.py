@@ -0,0 +1,114 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+from atoolbox.db.pool import AdaptivePool, connection_share, create_pg_pool
+from atoolbox.metrics import pg_pool_stats
+from atoolbox.settings import BaseSettings
+
+
+class FakePool:
+    def __init__(self):
+        self.acquired = 0
+        self.fetchval_results = {}
+
+    @asynccontextmanager
+    async def acquire(self, *, timeout=None):
+        self.acquired += 1
+        try:
+            yield 'conn'
+        finally:
+            self.acquired -= 1
+
+    def get_size(self):
+        return self.acquired
+
+    def get_idle_size(self):
+        return 0
+
+    async def fetchval(self, sql):
+        return self.fetchval_results[sql]
+
+
+async def hold(pool, t=0.1):
+    async with pool.acquire() as conn:
+        assert conn == 'conn'
+        await asyncio.sleep(t)
+
+
+async def test_adaptive_grow():
+    fake_pool = FakePool()
+    pool = AdaptivePool(fake_pool, min_size=1, max_size=3, acquire_target=0.01)
+    assert repr(pool) == '<AdaptivePool limit=1 in_use=0 waiting=0>'
+    await asyncio.gather(*[hold(pool) for _ in range(5)])
+    assert pool.limit == 3
+    assert pool.in_use == 0
+    assert pool.waiting == 0
+    assert fake_pool.acquired == 0
+
+
+async def test_adaptive_shrink():
+    pool = AdaptivePool(FakePool(), min_size=1, max_size=3, acquire_target=0.01, shrink_interval=0)
+    pool.limit = 3
+    await hold(pool, 0)
+    assert pool.limit == 2
+    await hold(pool, 0)
+    assert pool.limit == 1
+    await hold(pool, 0)
+    assert pool.limit == 1
+
+
+async def test_adaptive_timeout():
+    pool = AdaptivePool(FakePool(), min_size=1, max_size=1, acquire_target=0.01)
+    task = asyncio.ensure_future(hold(pool, 0.2))
+    await asyncio.sleep(0)
+    with pytest.raises(asyncio.TimeoutError):
+        async with pool.acquire(timeout=0.05):
+            pass
+    assert pool.waiting == 0
+    await task
+    assert pool.in_use == 0
+
+
+async def test_adaptive_cancelled():
+    pool = AdaptivePool(FakePool(), min_size=1, max_size=1)
+    task = asyncio.ensure_future(hold(pool, 0.1))
+    await asyncio.sleep(0)
+    waiter = asyncio.ensure_future(hold(pool))
+    await asyncio.sleep(0.01)
+    assert pool.waiting == 1
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert pool.waiting == 0
+    await task
+    assert pool.in_use == 0
+
+
+async def test_adaptive_stats():
+    pool = AdaptivePool(FakePool(), min_size=2, max_size=4)
+    async with pool.acquire():
+        assert pg_pool_stats(pool) == {'size': 1, 'idle': 0, 'limit': 2, 'in_use': 1, 'waiters': 0}
+
+
+async def test_connection_share():
+    pool = FakePool()
+    pool.fetchval_results = {'SHOW max_connections': '100', 'SHOW superuser_reserved_connections': '3'}
+    assert await connection_share(pool, 0.2) == 19
+    assert await connection_share(pool, 0.001) == 1
+
+
+async def test_create_pg_pool(settings: BaseSettings):
+    settings.pg_pool_adaptive = True
+    settings.pg_pool_max_size = 5
+    settings.pg_pool_connection_share = 0.5
+    pool = await create_pg_pool(settings)
+    try:
+        assert isinstance(pool, AdaptivePool)
+        assert pool.max_size == 5
+        assert 2 == await pool.fetchval('SELECT 1 + 1')
+        async with pool.acquire() as conn:
+            assert 4 == await conn.fetchval('SELECT 2 + 2')
+    finally:
+        await pool.close()
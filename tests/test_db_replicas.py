@@ -0,0 +1,94 @@
+import logging
+import re
+from contextlib import asynccontextmanager
+
+from aiohttp import web
+
+from atoolbox import BaseSettings, create_default_app, json_response
+from atoolbox.db.replicas import ReplicaPools, read_only
+
+
+class FakePool:
+    def __init__(self, name, in_use=0, healthy=True):
+        self.name = name
+        self.in_use = in_use
+        self.is_healthy = healthy
+
+    @asynccontextmanager
+    async def acquire(self, *, timeout=None):
+        yield self.name
+
+    def get_size(self):
+        return self.in_use + 1
+
+    def get_idle_size(self):
+        return 1
+
+    async def fetchval(self, sql, timeout=None):
+        if not self.is_healthy:
+            raise ConnectionRefusedError('connection refused')
+        return 1
+
+    async def close(self):
+        pass
+
+
+def test_choose_least_busy():
+    a, b, c = FakePool('a', 2), FakePool('b', 1), FakePool('c', 1)
+    replicas = ReplicaPools([a, b, c])
+    assert [replicas.choose().name for _ in range(4)] == ['b', 'b', 'c', 'b']
+
+
+async def test_health(caplog):
+    caplog.set_level(logging.INFO, 'atoolbox.db')
+    a, b = FakePool('a', healthy=False), FakePool('b', 5)
+    replicas = ReplicaPools([a, b])
+    assert replicas.choose() is a
+    await replicas.check_health()
+    assert replicas.healthy == [False, True]
+    assert 'replica 0 unhealthy, ConnectionRefusedError: connection refused' in caplog.text
+    assert replicas.choose() is b
+    assert replicas.choose() is b
+
+    b.is_healthy = False
+    await replicas.check_health()
+    assert replicas.choose() is None
+
+    a.is_healthy = True
+    await replicas.check_health()
+    assert replicas.healthy == [True, False]
+    assert 'replica 0 healthy again' in caplog.text
+
+
+@read_only
+async def read(request):
+    return json_response(conn=request['conn']._conn)
+
+
+async def write(request):
+    return json_response(conn=request['conn']._conn)
+
+
+async def test_routing(aiohttp_client):
+    settings = BaseSettings(pg_dsn=None, redis_settings=None, csrf_ignore_paths=[re.compile('/write/')])
+    routes = [web.get('/read/', read), web.get('/other/', write), web.post('/write/', write)]
+    app = await create_default_app(settings=settings, routes=routes)
+    app.update(pg=FakePool('primary'), pg_replicas=ReplicaPools([FakePool('replica')]))
+    cli = await aiohttp_client(app)
+
+    r = await cli.get('/read/')
+    assert await r.json() == {'conn': 'replica'}
+    r = await cli.get('/other/')
+    assert await r.json() == {'conn': 'primary'}
+
+    r = await cli.post('/write/')
+    assert await r.json() == {'conn': 'primary'}
+    assert r.cookies['pg_primary']['max-age'] == '5'
+
+    r = await cli.get('/read/')
+    assert await r.json() == {'conn': 'primary'}
+
+    cli.session.cookie_jar.clear()
+    app['pg_replicas'].healthy = [False]
+    r = await cli.get('/read/')
+    assert await r.json() == {'conn': 'primary'}
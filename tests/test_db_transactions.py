@@ -0,0 +1,185 @@
+import re
+from contextlib import asynccontextmanager
+from functools import partial
+from time import time
+
+import pytest
+from aiohttp import web
+from asyncpg import DeadlockDetectedError, SerializationError
+
+from atoolbox import BaseSettings, create_default_app, json_response
+from atoolbox.db.transactions import atomic
+from atoolbox.idempotency import idempotent
+from atoolbox.middleware import after_commit
+
+
+class FakeConn:
+    def __init__(self):
+        self.transactions = []
+        # number of transactions which fail on commit
+        self.fail_commits = 0
+
+    async def execute(self, sql, *args):
+        # set_statement_timeout
+        pass
+
+    @asynccontextmanager
+    async def transaction(self, *, isolation):
+        self.transactions.append([isolation, 'started'])
+        try:
+            yield
+        except BaseException as e:
+            self.transactions[-1][1] = f'rollback {e.__class__.__name__}'
+            raise
+        else:
+            if self.fail_commits:
+                self.fail_commits -= 1
+                self.transactions[-1][1] = 'rollback on commit'
+                raise SerializationError('could not serialize access')
+            self.transactions[-1][1] = 'commit'
+
+
+class FakeRedis:
+    SET_IF_NOT_EXIST = 'SET_IF_NOT_EXIST'
+    closed = True
+
+    def __init__(self):
+        self.data = {}
+
+    async def set(self, key, value, *, expire, exist=None):
+        if exist and key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def delete(self, key):
+        self.data.pop(key, None)
+
+
+class FakePool:
+    def __init__(self):
+        self.conn = FakeConn()
+
+    @asynccontextmanager
+    async def acquire(self, *, timeout=None):
+        yield self.conn
+
+    async def close(self):
+        pass
+
+
+@atomic('serializable')
+async def flaky(request):
+    request.app['calls'] += 1
+    if request.app['calls'] < 3:
+        raise SerializationError('could not serialize access')
+    return json_response(calls=request.app['calls'])
+
+
+async def deadlock(request):
+    request.app['calls'] += 1
+    raise DeadlockDetectedError('deadlock detected')
+
+
+@atomic()
+async def idempotent_add(request):
+    async def run():
+        request.app['calls'] += 1
+        calls = request.app['calls']
+        await after_commit(request, partial(request.app['published'].append, calls))
+        return json_response(calls=calls, status_=201)
+
+    return await idempotent(request, run)
+
+
+async def plain(request):
+    return json_response(status='ok')
+
+
+@pytest.fixture(name='atomic_cli')
+async def _fix_atomic_cli(aiohttp_client):
+    async def create(**kwargs):
+        kwargs.setdefault('pg_atomic_retry_delay', 0.001)
+        settings = BaseSettings(pg_dsn=None, redis_settings=None, csrf_ignore_paths=[re.compile('.*')], **kwargs)
+        routes = [
+            web.post('/flaky/', flaky),
+            web.post('/deadlock/', deadlock),
+            web.post('/add/', idempotent_add),
+            web.route('*', '/plain/', plain),
+        ]
+        app = await create_default_app(settings=settings, routes=routes)
+        app.update(pg=FakePool(), calls=0, redis=FakeRedis(), published=[])
+        return await aiohttp_client(app)
+
+    return create
+
+
+async def test_retry(atomic_cli):
+    cli = await atomic_cli()
+    r = await cli.post('/flaky/')
+    assert r.status == 200, await r.text()
+    assert await r.json() == {'calls': 3}
+    assert cli.server.app['pg'].conn.transactions == [
+        ['serializable', 'rollback SerializationError'],
+        ['serializable', 'rollback SerializationError'],
+        ['serializable', 'commit'],
+    ]
+
+
+async def test_retries_exhausted(atomic_cli):
+    cli = await atomic_cli(pg_atomic_retries=1)
+    r = await cli.post('/flaky/')
+    assert r.status == 500, await r.text()
+    assert cli.server.app['calls'] == 2
+
+
+async def test_no_retry_past_deadline(atomic_cli):
+    cli = await atomic_cli(request_timeout=10, pg_atomic_retry_delay=20)
+    r = await cli.post('/flaky/', headers={'X-Request-Start': str(int(time() * 1000))})
+    assert r.status == 500, await r.text()
+    assert cli.server.app['calls'] == 1
+
+
+async def test_atomic_requests(atomic_cli):
+    cli = await atomic_cli(pg_atomic_requests=True)
+    r = await cli.post('/plain/')
+    assert r.status == 200, await r.text()
+    r = await cli.get('/plain/')
+    assert r.status == 200, await r.text()
+    r = await cli.post('/deadlock/')
+    assert r.status == 500, await r.text()
+    assert cli.server.app['calls'] == 4
+    transactions = cli.server.app['pg'].conn.transactions
+    assert transactions[0] == ['read_committed', 'commit']
+    assert transactions[1:] == [['read_committed', 'rollback DeadlockDetectedError']] * 4
+
+
+async def test_not_atomic(atomic_cli):
+    cli = await atomic_cli()
+    r = await cli.post('/plain/')
+    assert r.status == 200, await r.text()
+    assert cli.server.app['pg'].conn.transactions == []
+
+
+async def test_retry_commit_idempotent(atomic_cli):
+    cli = await atomic_cli()
+    cli.server.app['pg'].conn.fail_commits = 1
+    r = await cli.post('/add/', headers={'Idempotency-Key': 'k'})
+    assert r.status == 201, await r.text()
+    # the first attempt's response wasn't stored and its side effects weren't made
+    assert await r.json() == {'calls': 2}
+    assert 'Idempotent-Replayed' not in r.headers
+    assert cli.server.app['published'] == [2]
+    assert cli.server.app['pg'].conn.transactions == [
+        ['read_committed', 'rollback on commit'],
+        ['read_committed', 'commit'],
+    ]
+
+    r = await cli.post('/add/', headers={'Idempotency-Key': 'k'})
+    assert r.status == 201, await r.text()
+    assert await r.json() == {'calls': 2}
+    assert r.headers['Idempotent-Replayed'] == 'true'
+    assert cli.server.app['calls'] == 2
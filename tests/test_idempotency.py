@@ -0,0 +1,185 @@
+import asyncio
+
+import pytest
+from aiohttp.web import Response
+
+from atoolbox.exceptions import JsonErrors
+from atoolbox.idempotency import idempotent
+from atoolbox.settings import BaseSettings
+from atoolbox.utils import json_response, response_from_bytes, response_to_bytes
+
+
+async def test_add_idempotent(cli, db_conn, redis):
+    data = dict(name='Test Org', slug='whatever')
+    r1 = await cli.post_json('/orgs/add/', data, headers={'Idempotency-Key': 'abc'})
+    assert r1.status == 201, await r1.text()
+    assert 'Idempotent-Replayed' not in r1.headers
+
+    r2 = await cli.post_json('/orgs/add/', data, headers={'Idempotency-Key': 'abc'})
+    assert r2.status == 201, await r2.text()
+    assert r2.headers['Idempotent-Replayed'] == 'true'
+    assert r2.headers['Content-Type'] == 'application/json'
+    assert await r2.json() == await r1.json()
+    assert 1 == await db_conn.fetchval('SELECT COUNT(*) FROM organisations')
+    assert await redis.keys('idempotency:*') == [b'idempotency:ip:127.0.0.1:POST:/orgs/add/:abc']
+
+
+async def test_add_idempotent_different_body(cli, db_conn):
+    r = await cli.post_json('/orgs/add/', dict(name='Test Org', slug='whatever'), headers={'Idempotency-Key': 'abc'})
+    assert r.status == 201, await r.text()
+    r = await cli.post_json('/orgs/add/', dict(name='Other', slug='other'), headers={'Idempotency-Key': 'abc'})
+    assert r.status == 422, await r.text()
+    assert await r.json() == {'message': 'Idempotency-Key has already been used with a different request body'}
+    assert 1 == await db_conn.fetchval('SELECT COUNT(*) FROM organisations')
+
+
+async def test_add_no_key(cli, db_conn):
+    r = await cli.post_json('/orgs/add/', dict(name='Test Org', slug='whatever'))
+    assert r.status == 201, await r.text()
+    r = await cli.post_json('/orgs/add/', dict(name='Test Org', slug='whatever'))
+    assert r.status == 409, await r.text()
+
+
+async def test_exec_view_error_not_stored(cli, redis):
+    r = await cli.post_json('/exec/', {'pow': 0}, headers={'Idempotency-Key': 'x'})
+    assert r.status == 470, await r.text()
+    assert await redis.keys('idempotency:*') == []
+
+    r = await cli.post_json('/exec/', {'pow': 3}, headers={'Idempotency-Key': 'y'})
+    assert r.status == 200, await r.text()
+    r = await cli.post_json('/exec/', {'pow': 3}, headers={'Idempotency-Key': 'y'})
+    assert r.status == 200, await r.text()
+    assert await r.json() == {'ans': 8}
+    assert r.headers['Idempotent-Replayed'] == 'true'
+    assert r.headers['Foobar'] == 'testing'
+
+
+def test_response_bytes():
+    r = json_response(foo='bar', status_=201, headers_={'X-Foo': 'a'})
+    r.headers.add('X-Foo', 'b')
+    r2 = response_from_bytes(response_to_bytes(r))
+    assert r2.status == 201
+    assert r2.body == b'{"foo": "bar"}\n'
+    assert r2.content_type == 'application/json'
+    assert r2.headers.getall('X-Foo') == ['a', 'b']
+
+
+class FakeRedis:
+    SET_IF_NOT_EXIST = 'SET_IF_NOT_EXIST'
+
+    def __init__(self):
+        self.data = {}
+
+    async def set(self, key, value, *, expire, exist=None):
+        if exist and key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def delete(self, key):
+        self.data.pop(key, None)
+
+
+class FakeRequest(dict):
+    method = 'POST'
+    path = '/foo/'
+
+    def __init__(self, redis, body=b'{}', remote='127.0.0.1'):
+        super().__init__()
+        settings = BaseSettings(idempotency_wait=0.2)
+        self.app = {'redis': redis, 'settings': settings}
+        self.headers = {'Idempotency-Key': 'k'}
+        self.body = body
+        self.remote = remote
+
+    async def read(self):
+        return self.body
+
+
+async def test_concurrent_duplicate():
+    redis = FakeRedis()
+    calls = 0
+
+    async def func():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.1)
+        return json_response(calls=calls)
+
+    r1, r2 = await asyncio.gather(idempotent(FakeRequest(redis), func), idempotent(FakeRequest(redis), func))
+    assert calls == 1
+    assert r1.body == r2.body == b'{"calls": 1}\n'
+    assert 'Idempotent-Replayed' not in r1.headers
+    assert r2.headers['Idempotent-Replayed'] == 'true'
+
+
+async def test_concurrent_duplicate_timeout():
+    redis = FakeRedis()
+
+    async def func():
+        await asyncio.sleep(0.5)
+        return json_response()
+
+    task = asyncio.ensure_future(idempotent(FakeRequest(redis), func))
+    await asyncio.sleep(0.01)
+    with pytest.raises(JsonErrors.HTTPConflict):
+        await idempotent(FakeRequest(redis), func)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert list(redis.data) == ['idempotency:ip:127.0.0.1:POST:/foo/:k']
+
+
+async def test_cancelled_finishes():
+    redis = FakeRedis()
+    calls = 0
+
+    async def func():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return json_response(calls=calls)
+
+    task = asyncio.ensure_future(idempotent(FakeRequest(redis), func))
+    await asyncio.sleep(0.01)
+    task.cancel()
+    # the retry waits for the cancelled request's work to finish rather than repeating it
+    r = await idempotent(FakeRequest(redis), func)
+    assert calls == 1
+    assert r.body == b'{"calls": 1}\n'
+    assert r.headers['Idempotent-Replayed'] == 'true'
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+async def test_scoped_to_caller():
+    redis = FakeRedis()
+
+    async def func(body):
+        return json_response(body=body)
+
+    r1 = await idempotent(FakeRequest(redis, remote='1.1.1.1'), lambda: func(1))
+    r2 = await idempotent(FakeRequest(redis, b'{"x": 1}', remote='2.2.2.2'), lambda: func(2))
+    assert r2.status == 200
+    assert 'Idempotent-Replayed' not in r2.headers
+    assert r1.body != r2.body
+
+
+async def test_failed_request_retried():
+    redis = FakeRedis()
+
+    async def fail():
+        return Response(status=503)
+
+    async def succeed():
+        return json_response(status='ok')
+
+    r = await idempotent(FakeRequest(redis), fail)
+    assert r.status == 503
+    assert redis.data == {}
+    r = await idempotent(FakeRequest(redis), succeed)
+    assert r.status == 200
+    assert 'Idempotent-Replayed' not in r.headers
@@ -0,0 +1,142 @@
+import asyncio
+import json
+
+from buildpg import asyncpg
+
+from atoolbox.invalidation import ALL_TOPICS, InvalidationHub, invalidate, publish_invalidation
+
+
+async def test_dispatch(caplog):
+    hub = InvalidationHub('pg')
+    calls = []
+
+    async def async_callback(topic, key):
+        calls.append(('async', topic, key))
+
+    def broken(topic, key):
+        raise RuntimeError('broken')
+
+    hub.subscribe('users', async_callback)
+    hub.subscribe('users', broken)
+    hub.subscribe(ALL_TOPICS, lambda topic, key: calls.append(('all', topic, key)))
+
+    await hub.dispatch('users', '123')
+    await hub.dispatch('organisations', None)
+    assert calls == [('async', 'users', '123'), ('all', 'users', '123'), ('all', 'organisations', None)]
+    assert hub.received == 2
+    assert "error invalidating topic='users' key='123'" in caplog.text
+
+
+async def test_invalidate_all():
+    hub = InvalidationHub('redis')
+    calls = []
+    hub.subscribe('users', lambda topic, key: calls.append((topic, key)))
+    hub.subscribe('orgs', lambda topic, key: calls.append((topic, key)))
+    await hub.invalidate_all()
+    assert calls == [('users', None), ('orgs', None)]
+
+
+async def test_on_message(caplog):
+    hub = InvalidationHub('pg')
+    calls = []
+    hub.subscribe('users', lambda topic, key: calls.append((topic, key)))
+    hub._on_message('{"topic": "users", "key": "1"}')
+    hub._on_message('not json')
+    await asyncio.sleep(0)
+    assert calls == [('users', '1')]
+    assert "invalid invalidation message 'not json'" in caplog.text
+
+
+class FakeChannel:
+    def __init__(self, messages=(), error=None):
+        self.messages = list(messages)
+        self.error = error
+
+    async def wait_message(self):
+        if self.error:
+            raise self.error
+        if not self.messages:
+            await asyncio.Event().wait()
+        return True
+
+    async def get(self, *, encoding):
+        return self.messages.pop(0)
+
+
+class FakeRedis:
+    closed = False
+
+    def __init__(self, *channels):
+        self.channels = list(channels)
+
+    async def subscribe(self, channel):
+        return [self.channels.pop(0)]
+
+    async def unsubscribe(self, channel):
+        pass
+
+
+async def test_listener_error_resubscribes(caplog):
+    redis = FakeRedis(FakeChannel(error=ConnectionResetError('reset')), FakeChannel(['{"topic": "users", "key": "1"}']))
+    hub = InvalidationHub('redis', reconnect_interval=0.01)
+    received = asyncio.Queue()
+    hub.subscribe('users', lambda topic, key: received.put_nowait(key))
+    await hub.start({'redis': redis})
+    try:
+        # everything is invalidated after reconnecting, then messages are received again
+        assert await asyncio.wait_for(received.get(), 2) is None
+        assert await asyncio.wait_for(received.get(), 2) == '1'
+        assert 'error in invalidation redis listener, reconnecting' in caplog.text
+        await asyncio.sleep(0)
+        assert hub._dispatching == set()
+    finally:
+        await hub.close()
+
+
+async def test_publish_conn():
+    executed = []
+
+    class FakeConn:
+        async def execute(self, sql, *args):
+            executed.append((sql, args))
+
+    await publish_invalidation('users', 42, conn=FakeConn())
+    assert executed == [('SELECT pg_notify($1, $2)', ('atoolbox_invalidate', '{"topic": "users", "key": "42"}'))]
+
+
+async def test_invalidate_no_hub():
+    await invalidate({}, 'users', 1)
+
+
+async def test_pg_listen(settings, clean_db):
+    pool = await asyncpg.create_pool_b(dsn=settings.pg_dsn)
+    hub = InvalidationHub('pg', reconnect_interval=0.01)
+    received = asyncio.Queue()
+    hub.subscribe('users', lambda topic, key: received.put_nowait(key))
+    await hub.start({'settings': settings, 'pg': pool})
+    try:
+        await invalidate({'invalidation': hub}, 'users', 123)
+        assert await asyncio.wait_for(received.get(), 2) == '123'
+
+        # reconnecting invalidates everything
+        await hub._conn.close()
+        assert await asyncio.wait_for(received.get(), 2) is None
+        await hub.publish('users', 'x')
+        assert await asyncio.wait_for(received.get(), 2) == 'x'
+    finally:
+        await hub.close()
+        await pool.close()
+
+
+async def test_redis_listen(redis):
+    hub = InvalidationHub('redis')
+    received = asyncio.Queue()
+    hub.subscribe(ALL_TOPICS, lambda topic, key: received.put_nowait((topic, key)))
+    await hub.start({'redis': redis})
+    try:
+        await hub.publish('orgs')
+        assert await asyncio.wait_for(received.get(), 2) == ('orgs', None)
+        await redis.publish('atoolbox_invalidate', json.dumps({'topic': 'users', 'key': '1'}))
+        assert await asyncio.wait_for(received.get(), 2) == ('users', '1')
+    finally:
+        await hub.close()
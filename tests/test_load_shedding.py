@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+from atoolbox.load_shedding import AdaptiveLimiter
+from conftest import pre_startup_app
+from demo.main import create_app
+
+
+async def test_limiter_acquire_release():
+    limiter = AdaptiveLimiter(initial_limit=2, queue_size=0)
+    assert await limiter.acquire() is True
+    assert await limiter.acquire() is True
+    assert limiter.in_flight == 2
+    assert await limiter.acquire() is False
+    assert limiter.shed == 1
+    limiter.release(0.01)
+    assert limiter.in_flight == 1
+    assert limiter.limit == 2.5
+    assert repr(limiter) == '<AdaptiveLimiter limit=2.5 in_flight=1 queued=0>'
+
+
+async def test_limiter_decrease():
+    limiter = AdaptiveLimiter(initial_limit=10, min_limit=9, target_latency=0.1)
+    for _ in range(3):
+        assert await limiter.acquire()
+    limiter.release(1)
+    assert limiter.limit == 9
+    # only one decrease per target_latency
+    limiter.release(1)
+    assert limiter.limit == 9
+    limiter.release(0.01, failed=True)
+    assert limiter.limit == 9
+    assert limiter.in_flight == 0
+
+
+async def test_limiter_queue():
+    limiter = AdaptiveLimiter(initial_limit=1, queue_size=2, queue_timeout=1)
+    assert await limiter.acquire()
+    waiter = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    assert limiter.queued == 1
+    limiter.release(0.01)
+    assert await waiter is True
+    assert limiter.in_flight == 1
+    assert limiter.queued == 0
+
+
+async def test_limiter_queue_timeout():
+    limiter = AdaptiveLimiter(initial_limit=1, queue_size=2, queue_timeout=0.01)
+    assert await limiter.acquire()
+    assert await limiter.acquire() is False
+    assert limiter.queued == 0
+    assert limiter.shed == 1
+
+
+async def test_limiter_queue_cancelled():
+    limiter = AdaptiveLimiter(initial_limit=1, queue_size=2, queue_timeout=1)
+    assert await limiter.acquire()
+    waiter = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert limiter.queued == 0
+    limiter.release(0.01)
+    assert limiter.in_flight == 0
+
+
+async def test_load_shedding(settings, db_conn, aiohttp_client):
+    settings.load_shedding = True
+    settings.load_shedding_initial_limit = 1
+    settings.load_shedding_min_limit = 1
+    settings.load_shedding_queue_size = 0
+    settings.load_shedding_exempt_paths = ['/status/.*']
+    settings.metrics_path = '/metrics/'
+    app = await create_app(settings=settings)
+    app['test_conn'] = db_conn
+    app.on_startup.insert(0, pre_startup_app)
+    cli = await aiohttp_client(app)
+
+    slow = asyncio.ensure_future(cli.get('/sleep/?t=0.2'))
+    await asyncio.sleep(0.05)
+    r = await cli.get('/sleep/?t=0')
+    assert r.status == 503, await r.text()
+    assert r.headers['Retry-After'] == '1'
+    assert await r.json() == {'message': 'Server overloaded, please try again later'}
+
+    r = await cli.get('/status/200/')
+    assert r.status == 200, await r.text()
+
+    r = await slow
+    assert r.status == 200, await r.text()
+
+    r = await cli.get('/metrics/')
+    assert r.status == 200, await r.text()
+    text = await r.text()
+    assert 'atoolbox_load_shed_total 1\n' in text
+    assert 'atoolbox_requests_total{route="sleep",status="503"} 1\n' in text
@@ -56,6 +56,20 @@ async def test_log_msg_exception(cli_access_logger, caplog, mocker):
     assert '\x1b[38;5;26mTraceback' in caplog.text
 
 
+async def test_log_msg_timings(settings, db_conn, aiohttp_server, aiohttp_client, caplog):
+    caplog.set_level(logging.INFO)
+    settings.access_log_timings = True
+    app = await create_app(settings=settings)
+    app['test_conn'] = db_conn
+    app.on_startup.insert(0, pre_startup_app)
+    server = await aiohttp_server(app, access_log_class=ColouredAccessLogger)
+    cli = await aiohttp_client(server)
+    r = await cli.get('/exec/')
+    assert r.status == 200, await r.text()
+    assert 'pg-acquire=' in caplog.text
+    assert 'handler=' in caplog.text
+
+
 @pytest.mark.parametrize('size,output', [(10_000_000, '9.5MB'), (1024 ** 2, '1.0MB'), (10000, '9.8KB'), (10, '10B')])
 def test_format_size(size, output):
     assert ColouredAccessLogger.format_size(size) == output
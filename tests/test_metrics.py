@@ -0,0 +1,92 @@
+from atoolbox.metrics import Metrics, gauge
+from conftest import pre_startup_app
+from demo.main import create_app
+
+
+async def test_metrics_endpoint(settings, db_conn, aiohttp_client):
+    settings.metrics_path = '/metrics/'
+    app = await create_app(settings=settings)
+    app['test_conn'] = db_conn
+    app.on_startup.insert(0, pre_startup_app)
+    cli = await aiohttp_client(app)
+
+    r = await cli.get('/orgs/')
+    assert r.status == 200, await r.text()
+    r = await cli.get('/status/503/')
+    assert r.status == 503, await r.text()
+    r = await cli.get('/errors/value_error')
+    assert r.status == 500, await r.text()
+    r = await cli.get('/does-not-exist/')
+    assert r.status == 404, await r.text()
+
+    r = await cli.get('/metrics/')
+    assert r.status == 200, await r.text()
+    assert r.headers['Content-Type'] == 'text/plain; version=0.0.4'
+    text = await r.text()
+    assert 'atoolbox_requests_total{route="organisation-browse",status="200"} 1\n' in text
+    assert 'atoolbox_requests_total{route="any-status",status="503"} 1\n' in text
+    assert 'atoolbox_requests_total{route="/errors/{do}",status="500"} 1\n' in text
+    assert 'atoolbox_requests_total{route="unmatched",status="404"} 1\n' in text
+    assert 'atoolbox_request_duration_seconds_count{route="organisation-browse"} 1\n' in text
+    assert 'atoolbox_request_duration_seconds_bucket{route="organisation-browse",le="+Inf"} 1\n' in text
+    assert 'atoolbox_requests_in_flight{route="organisation-browse"} 0\n' in text
+    assert 'atoolbox_http_client_connections{state="acquired"} 0\n' in text
+    assert 'metrics' not in text
+
+
+async def test_metrics_post_no_csrf(settings, db_conn, aiohttp_client):
+    settings.metrics_path = '/metrics/'
+    app = await create_app(settings=settings)
+    app['test_conn'] = db_conn
+    app.on_startup.insert(0, pre_startup_app)
+    cli = await aiohttp_client(app)
+
+    r = await cli.post('/metrics/')
+    assert r.status == 200, await r.text()
+
+
+def test_render(caplog):
+    metrics = Metrics(buckets=[1, 0.1])
+    metrics.route('foobar').observe(200, 0.05)
+    metrics.route('foobar').observe(200, 0.5)
+    metrics.route('foobar').observe(404, 5)
+    metrics.add_collector(lambda app: [gauge('custom', 'Custom "gauge".', 4.5, {'x': 'a"b'})])
+    # no pg, redis or http_client so the default collectors add nothing
+    assert metrics.render({}) == (
+        '# HELP atoolbox_requests_total Requests by route and status.\n'
+        '# TYPE atoolbox_requests_total counter\n'
+        'atoolbox_requests_total{route="foobar",status="200"} 2\n'
+        'atoolbox_requests_total{route="foobar",status="404"} 1\n'
+        '# HELP atoolbox_requests_in_flight Requests currently in progress.\n'
+        '# TYPE atoolbox_requests_in_flight gauge\n'
+        'atoolbox_requests_in_flight{route="foobar"} 0\n'
+        '# HELP atoolbox_request_duration_seconds Request latency.\n'
+        '# TYPE atoolbox_request_duration_seconds histogram\n'
+        'atoolbox_request_duration_seconds_bucket{route="foobar",le="0.1"} 1\n'
+        'atoolbox_request_duration_seconds_bucket{route="foobar",le="1"} 2\n'
+        'atoolbox_request_duration_seconds_bucket{route="foobar",le="+Inf"} 3\n'
+        'atoolbox_request_duration_seconds_sum{route="foobar"} 5.55\n'
+        'atoolbox_request_duration_seconds_count{route="foobar"} 3\n'
+        '# HELP custom Custom "gauge".\n'
+        '# TYPE custom gauge\n'
+        'custom{x="a\\"b"} 4.5\n'
+    )
+    assert caplog.records == []
+
+
+def test_collector_error(caplog):
+    def broken(app):
+        raise RuntimeError('broken')
+
+    metrics = Metrics()
+    metrics.collectors = [broken, lambda app: [gauge('custom', 'Custom gauge.', 1)]]
+    families = list(metrics.families({}))
+    assert [f.name for f in families] == [
+        'atoolbox_requests_total',
+        'atoolbox_requests_in_flight',
+        'atoolbox_request_duration_seconds',
+        'custom',
+    ]
+    assert len(caplog.records) == 1
+    assert caplog.records[0].getMessage().startswith('error running metrics collector <function')
+    assert caplog.records[0].exc_info[0] is RuntimeError
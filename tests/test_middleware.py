@@ -1,6 +1,12 @@
-from aiohttp import ClientSession, FormData
+import re
+from time import time
 
-from atoolbox.middleware import exc_extra
+from aiohttp import ClientSession, FormData, web
+from aiohttp.test_utils import make_mocked_request
+
+from atoolbox import BaseSettings, create_default_app, json_response
+from atoolbox.middleware import etag_matches, exc_extra, http_client_timeout
+from atoolbox.timing import RequestTimings
 from conftest import pre_startup_app
 from demo.main import create_app
 
@@ -265,3 +271,138 @@ async def test_no_pg_conn(settings, db_conn, aiohttp_client):
     r = await cli.get('/request-context/')
     assert r.status == 200, await r.text()
     assert 'conn' not in await r.json()
+
+
+async def test_server_timing(settings, db_conn, aiohttp_client):
+    settings.server_timing = True
+    app = await create_app(settings=settings)
+    app['test_conn'] = db_conn
+    app.on_startup.insert(0, pre_startup_app)
+    cli = await aiohttp_client(app)
+
+    r = await cli.get('/exec/', headers={'X-Request-Start': '1500000000000'})
+    assert r.status == 200, await r.text()
+    server_timing = r.headers['Server-Timing']
+    assert server_timing.startswith('queue;dur=')
+    assert 'pg-acquire;dur=' in server_timing
+    assert 'json;dur=' in server_timing
+    assert 'handler;dur=' in server_timing
+
+    r = await cli.get('/status/404/')
+    assert r.status == 404, await r.text()
+    assert 'handler;dur=' in r.headers['Server-Timing']
+
+
+async def test_no_server_timing(cli):
+    r = await cli.get('/exec/')
+    assert r.status == 200, await r.text()
+    assert 'Server-Timing' not in r.headers
+
+
+def test_request_timings():
+    timings = RequestTimings()
+    timings.add('db', 0.002)
+    timings.add('db', 0.003)
+    timings.add('json', 0.0001)
+    assert timings.server_timing() == 'db;dur=5.00;desc="2", json;dur=0.10'
+    assert timings.summary() == 'db=5ms/2 json=0ms'
+    assert repr(timings) == '<RequestTimings db=5ms/2 json=0ms>'
+
+
+async def test_deadline_exceeded(settings, db_conn, aiohttp_client, caplog):
+    settings.request_timeout = 1
+    app = await create_app(settings=settings)
+    app['test_conn'] = db_conn
+    app.on_startup.insert(0, pre_startup_app)
+    cli = await aiohttp_client(app)
+
+    r = await cli.get('/orgs/', headers={'X-Request-Start': str(int((time() - 5) * 1000))})
+    assert r.status == 503, await r.text()
+    assert await r.json() == {'message': 'Request deadline exceeded'}
+
+
+async def test_deadline_statement_timeout(settings, db_conn, aiohttp_client):
+    settings.request_timeout = 20
+    app = await create_app(settings=settings)
+    app['test_conn'] = db_conn
+    app.on_startup.insert(0, pre_startup_app)
+    cli = await aiohttp_client(app)
+
+    assert await db_conn.fetchval('SHOW statement_timeout') == '0'
+    r = await cli.get('/request-context/', headers={'X-Request-Start': str(int((time() - 5) * 1000))})
+    assert r.status == 200, await r.text()
+    assert 'deadline' in await r.json()
+    statement_timeout = await db_conn.fetchval("SELECT current_setting('statement_timeout')::interval")
+    assert 14 < statement_timeout.total_seconds() <= 15
+
+
+async def test_no_deadline(cli):
+    r = await cli.get('/request-context/')
+    assert r.status == 200, await r.text()
+    assert 'deadline' not in await r.json()
+
+
+def test_http_client_timeout(settings):
+    request = make_mocked_request('GET', '/', app={'settings': settings})
+    assert http_client_timeout(request).total == 10
+
+    request['deadline'] = time() + 2
+    assert 1.9 < http_client_timeout(request).total <= 2
+
+    request['deadline'] = time() - 2
+    assert http_client_timeout(request).total == 0.001
+
+
+async def etag_client(aiohttp_client, **settings):
+    async def handler(request):
+        return json_response(v=request.query.get('v', 'x'))
+
+    async def created(request):
+        return web.Response(body=b'x' * 100, status=201)
+
+    settings = BaseSettings(pg_dsn=None, redis_settings=None, create_http_client=False, etag=True, **settings)
+    routes = [web.get('/etag/', handler), web.get('/etag/created/', created)]
+    app = await create_default_app(settings=settings, routes=routes)
+    app['pg_middleware_check'] = lambda r: False
+    return await aiohttp_client(app)
+
+
+async def test_etag(aiohttp_client):
+    cli = await etag_client(aiohttp_client)
+    r = await cli.get('/etag/')
+    assert r.status == 200
+    etag = r.headers['ETag']
+    assert re.fullmatch(r'W/"[0-9a-f]{32}"', etag)
+
+    r = await cli.get('/etag/', headers={'If-None-Match': etag})
+    assert r.status == 304
+    assert r.headers['ETag'] == etag
+    assert await r.read() == b''
+
+    r = await cli.get('/etag/', headers={'If-None-Match': f'"other", {etag[2:]}'})
+    assert r.status == 304
+    r = await cli.get('/etag/', headers={'If-None-Match': '*'})
+    assert r.status == 304
+
+    r = await cli.get('/etag/?v=y', headers={'If-None-Match': etag})
+    assert r.status == 200
+    assert r.headers['ETag'] != etag
+
+    r = await cli.get('/etag/created/')
+    assert r.status == 201
+    assert 'ETag' not in r.headers
+
+
+async def test_etag_max_size(aiohttp_client):
+    cli = await etag_client(aiohttp_client, etag_max_size=5)
+    r = await cli.get('/etag/')
+    assert r.status == 200
+    assert 'ETag' not in r.headers
+
+
+def test_etag_matches():
+    assert etag_matches('W/"abc"', 'W/"abc"')
+    assert etag_matches('"abc"', 'W/"abc"')
+    assert etag_matches('"x", W/"abc"', 'W/"abc"')
+    assert not etag_matches('"ab"', 'W/"abc"')
+    assert not etag_matches(None, 'W/"abc"')
@@ -0,0 +1,158 @@
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
+
+import pytest
+
+from atoolbox import Batch, patch
+from atoolbox.patch_methods import PartitionError, Patch, _run_batched_patch, partition_range
+
+ROWS = list(range(1, 8))
+
+
+class FakeConn:
+    """
+    Stores atoolbox_meta in a dict and rows processed in a list, both are reverted if a transaction is rolled back.
+    """
+
+    def __init__(self):
+        self.meta = {}
+        self.processed = []
+        self.transactions = []
+
+    async def execute(self, sql, *args):
+        if sql.startswith('delete'):
+            self.meta.pop(args[0], None)
+        elif args:
+            self.meta[args[0]] = args[1]
+
+    async def fetchval(self, sql, *args):
+        if args:
+            return self.meta.get(args[0])
+        return len(ROWS)
+
+    @asynccontextmanager
+    async def transaction(self):
+        meta, processed = dict(self.meta), list(self.processed)
+        try:
+            yield
+        except BaseException:
+            self.meta, self.processed = meta, processed
+            self.transactions.append('rollback')
+            raise
+        else:
+            self.transactions.append('commit')
+
+
+def batched_patch(fail_after=None):
+    async def process(*, conn, after, **kwargs):
+        batch = [r for r in ROWS if r > (after or 0)][:3]
+        if not batch:
+            return
+        if fail_after and batch[-1] > fail_after:
+            raise RuntimeError('boom')
+        conn.processed += batch
+        return Batch(last_key=batch[-1], rows=len(batch))
+
+    return Patch(func=process, batched=True, batch_delay=0, total_sql='SELECT count(*) FROM x')
+
+
+async def test_batched_live(caplog):
+    caplog.set_level(logging.INFO, 'atoolbox.patch')
+    conn = FakeConn()
+    assert await _run_batched_patch(conn, None, batched_patch(), True, ()) is None
+    assert conn.processed == ROWS
+    assert conn.transactions == ['commit'] * 4
+    assert conn.meta == {}
+    assert 'process: 6 rows processed' in caplog.text
+    assert '85.7% complete, ETA' in caplog.text
+    assert 'patch process complete, 7 rows processed' in caplog.text
+
+
+async def test_batched_not_live(caplog):
+    caplog.set_level(logging.INFO, 'atoolbox.patch')
+    conn = FakeConn()
+    assert await _run_batched_patch(conn, None, batched_patch(), False, ()) is None
+    assert conn.processed == []
+    assert conn.transactions == ['rollback']
+    assert conn.meta == {}
+    assert 'not live, rolled back first batch' in caplog.text
+
+
+async def test_batched_resume(caplog):
+    caplog.set_level(logging.INFO, 'atoolbox.patch')
+    conn = FakeConn()
+    assert await _run_batched_patch(conn, None, batched_patch(fail_after=5), True, ()) == 1
+    assert conn.processed == [1, 2, 3]
+    assert json.loads(conn.meta['patch:process']) == [3, 3]
+    assert 'Error running process patch, 3 rows processed, last key 3' in caplog.text
+
+    assert await _run_batched_patch(conn, None, batched_patch(), True, ()) is None
+    assert conn.processed == ROWS
+    assert conn.meta == {}
+    assert 'resuming process after 3, 3 rows already processed' in caplog.text
+    assert 'patch process complete, 7 rows processed' in caplog.text
+
+
+class FakePool:
+    def __init__(self):
+        self.active = 0
+        self.max_active = 0
+
+    @asynccontextmanager
+    async def acquire(self):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            yield f'conn-{self.max_active}'
+        finally:
+            self.active -= 1
+
+
+async def test_partition_range(caplog):
+    caplog.set_level(logging.INFO, 'atoolbox.patch')
+    pool = FakePool()
+    chunks = []
+
+    async def process(conn, start, stop):
+        chunks.append((start, stop))
+        await asyncio.sleep(0.001)
+        return stop - start
+
+    assert await partition_range(pool, process, 0, 100, concurrency=3) == 100
+    assert pool.max_active == 3
+    assert sorted(chunks) == [(i, min(i + 9, 100)) for i in range(0, 100, 9)]
+    assert '12/12 partitions complete, 100 rows processed' in caplog.text
+
+
+async def test_partition_range_errors(caplog):
+    pool = FakePool()
+    chunks = []
+
+    async def process(conn, start, stop):
+        if start in (20, 60):
+            raise ValueError('broken')
+        chunks.append(start)
+
+    with pytest.raises(PartitionError) as exc_info:
+        await partition_range(pool, process, 0, 100, concurrency=2, chunk_size=20)
+    assert str(exc_info.value) == '2 of 5 partitions failed: 20-40, 60-80'
+    assert sorted(chunks) == [0, 40, 80]
+    assert 'partition 20-40 failed, ValueError: broken' in caplog.text
+
+
+def test_concurrency_not_direct():
+    with pytest.raises(AssertionError):
+        patch(concurrency=4)
+
+
+async def test_partition_range_instant(mocker, caplog):
+    caplog.set_level(logging.INFO, 'atoolbox.patch')
+    mocker.patch('atoolbox.patch_methods.time', return_value=123.0)
+
+    async def process(conn, start, stop):
+        return stop - start
+
+    assert await partition_range(FakePool(), process, 0, 10, concurrency=1, chunk_size=10) == 10
+    assert '1/1 partitions complete, 10 rows processed, 0 rows/s' in caplog.text
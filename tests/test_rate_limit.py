@@ -0,0 +1,92 @@
+import pytest
+from aioredis import ReplyError
+
+from atoolbox.rate_limit import TOKEN_BUCKET_SHA, RateLimit, RateLimiter
+
+
+async def test_rate_limit(cli, redis):
+    r = await cli.get('/rate-limited/')
+    assert r.status == 200, await r.text()
+    assert r.headers['RateLimit-Limit'] == '2'
+    assert r.headers['RateLimit-Remaining'] == '1'
+    assert r.headers['RateLimit-Reset'] == '30'
+
+    r = await cli.get('/rate-limited/')
+    assert r.status == 200, await r.text()
+    assert r.headers['RateLimit-Remaining'] == '0'
+
+    r = await cli.get('/rate-limited/')
+    assert r.status == 429, await r.text()
+    assert await r.json() == {'message': 'Too many requests, please slow down'}
+    assert r.headers['RateLimit-Remaining'] == '0'
+    assert r.headers['Retry-After'] == '30'
+
+    assert await redis.keys('rate_limit:*') == [b'rate_limit:rate-limited:ip:127.0.0.1']
+
+
+async def test_rate_limit_other_routes(cli):
+    for _ in range(3):
+        r = await cli.get('/status/200/')
+        assert r.status == 200, await r.text()
+        assert 'RateLimit-Limit' not in r.headers
+
+
+async def test_rate_limit_custom_key(cli, redis):
+    limiter: RateLimiter = cli.server.app['rate_limiter']
+    limit = RateLimit(rate=1, per=10, key=lambda request: 'custom', name='foobar')
+    assert await limiter.key(None, limit) == 'rate_limit:foobar:custom'
+
+
+class FakeRedis:
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = []
+
+    async def evalsha(self, sha, *, keys, args):
+        self.calls.append(('evalsha', keys))
+        assert sha == TOKEN_BUCKET_SHA
+        raise ReplyError('NOSCRIPT No matching script. Please use EVAL.')
+
+    async def eval(self, script, *, keys, args):
+        self.calls.append(('eval', keys))
+        return self.results.pop(0)
+
+
+async def test_local_block():
+    limiter = RateLimiter()
+    limit = RateLimit(rate=1, per=10)
+    redis = FakeRedis([1, b'0'], [0, b'0.5'])
+    assert await limiter.check(redis, limit, 'x') == (
+        True,
+        {'RateLimit-Limit': '1', 'RateLimit-Remaining': '0', 'RateLimit-Reset': '10'},
+    )
+    assert await limiter.check(redis, limit, 'x') == (
+        False,
+        {'RateLimit-Limit': '1', 'RateLimit-Remaining': '0', 'RateLimit-Reset': '5'},
+    )
+    assert len(redis.calls) == 4
+    allowed, headers = await limiter.check(redis, limit, 'x')
+    assert allowed is False
+    assert headers['RateLimit-Reset'] == '5'
+    # blocked locally, redis not called
+    assert len(redis.calls) == 4
+
+
+async def test_local_block_max_keys():
+    limiter = RateLimiter(local_max_keys=2)
+    limit = RateLimit(rate=1, per=10)
+    redis = FakeRedis([0, b'0'], [0, b'0'], [0, b'0'])
+    for key in 'abc':
+        allowed, _ = await limiter.check(redis, limit, key)
+        assert allowed is False
+    assert list(limiter._blocked) == ['b', 'c']
+
+
+async def test_redis_error():
+    class BrokenRedis(FakeRedis):
+        async def evalsha(self, sha, *, keys, args):
+            raise ReplyError('ERR broken')
+
+    limiter = RateLimiter()
+    with pytest.raises(ReplyError):
+        await limiter.check(BrokenRedis(), RateLimit(rate=1), 'x')
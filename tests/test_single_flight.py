@@ -0,0 +1,68 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+from atoolbox.single_flight import SingleFlight, SingleFlightGroup
+from atoolbox.utils import json_response
+
+
+async def test_coalesced(cli):
+    rs = await asyncio.gather(*[cli.get('/coalesced/') for _ in range(3)], cli.get('/coalesced/?x=1'))
+    assert [r.status for r in rs] == [200, 200, 200, 200]
+    assert [await r.json() for r in rs] == [{'calls': 1}, {'calls': 1}, {'calls': 1}, {'calls': 2}]
+    assert rs[1].headers['X-Calls'] == '1'
+    assert cli.server.app['single_flight'].coalesced == 2
+    assert cli.server.app['single_flight'].flights == {}
+
+    r = await cli.get('/coalesced/')
+    assert await r.json() == {'calls': 3}
+
+
+async def test_scope():
+    group = SingleFlightGroup()
+    request = make_mocked_request('GET', '/foo/?a=1')
+    assert await group.key(request, SingleFlight()) == 'GET:/foo/?a=1:'
+
+    async def scope(request):
+        return 'user:123'
+
+    assert await group.key(request, SingleFlight(scope=scope)) == 'GET:/foo/?a=1:user:123'
+
+
+async def test_leader_fails():
+    group = SingleFlightGroup()
+    calls = 0
+
+    async def handler(request):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        if calls == 1:
+            raise web.HTTPBadRequest()
+        return json_response(calls=calls)
+
+    request = make_mocked_request('GET', '/foo/')
+    results = await asyncio.gather(*[group.run('k', request, handler) for _ in range(3)], return_exceptions=True)
+    leader, *followers = results
+    assert isinstance(leader, web.HTTPBadRequest)
+    # followers run the handler themselves
+    assert calls == 3
+    assert [f.status for f in followers] == [200, 200]
+    assert group.coalesced == 0
+
+
+async def test_stream_response_not_shared():
+    group = SingleFlightGroup()
+    calls = 0
+
+    async def handler(request):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return web.Response(text='x') if calls > 1 else web.StreamResponse()
+
+    request = make_mocked_request('GET', '/foo/')
+    r1, r2 = await asyncio.gather(group.run('k', request, handler), group.run('k', request, handler))
+    assert calls == 2
+    assert r2.text == 'x'
@@ -0,0 +1,149 @@
+import asyncio
+import gzip
+import os
+import re
+
+import pytest
+from aiohttp import web
+
+from atoolbox import create_default_app
+from atoolbox.settings import BaseSettings
+from atoolbox.static_index import HASHED_NAME, IMMUTABLE_CACHE_CONTROL, StaticIndex
+from atoolbox.views import spa_static_handler
+
+
+def create_static(path):
+    (path / 'index.html').write_text('<h1>index</h1>')
+    (path / 'assets').mkdir()
+    (path / 'assets' / 'main.3b5c9e1a.js').write_text('console.log(1)')
+    (path / 'assets' / 'main.3b5c9e1a.js.gz').write_bytes(gzip.compress(b'console.log(1)'))
+    (path / 'big.txt').write_text('x' * 100)
+
+
+async def create_app(aiohttp_client, static_dir, **settings):
+    settings = BaseSettings(pg_dsn=None, redis_settings=None, create_http_client=False, static_index=True, **settings)
+    app = await create_default_app(settings=settings, routes=[web.get(r'/{path:.*}', spa_static_handler)])
+    app.update(static_dir=static_dir, pg_middleware_check=lambda r: False)
+    return await aiohttp_client(app, auto_decompress=False)
+
+
+async def test_build(tmp_path):
+    create_static(tmp_path)
+    index = StaticIndex(tmp_path, memory_size=50)
+    index.build()
+    assert set(index.files) == {'index.html', 'assets/main.3b5c9e1a.js', 'big.txt'}
+    js = index.files['assets/main.3b5c9e1a.js']
+    assert js.content_type.endswith('/javascript')
+    assert js.immutable is True
+    assert set(js.variants) == {'identity', 'gzip'}
+    assert js.variants['identity'].body == b'console.log(1)'
+    big = index.files['big.txt']
+    assert big.immutable is False
+    assert big.variants['identity'].body is None
+    assert index.memory_bytes == 14 + len(js.variants['gzip'].body) + 14
+
+
+@pytest.mark.parametrize(
+    'name,hashed',
+    [
+        ('main.3b5c9e1a.js', True),
+        ('chunk-0123abcd4567.css', True),
+        ('report-20231015.pdf', False),
+        ('photo.deadbeef.jpg', False),
+        ('main.js', False),
+    ],
+)
+def test_hashed_name(name, hashed):
+    assert bool(HASHED_NAME.fullmatch(name)) is hashed
+
+
+async def test_hashed_name_setting(tmp_path):
+    (tmp_path / 'report-20231015.pdf').write_bytes(b'x')
+    settings = BaseSettings(static_index_hashed_name=re.compile(r'report-\d+\.pdf'))
+    index = StaticIndex.from_settings(tmp_path, settings)
+    index.build()
+    assert index.files['report-20231015.pdf'].immutable is True
+
+
+async def test_symlink_outside(tmp_path):
+    static = tmp_path / 'static'
+    static.mkdir()
+    create_static(static)
+    (tmp_path / 'secret.txt').write_text('secret')
+    (static / 'secret.txt').symlink_to(tmp_path / 'secret.txt')
+    (static / 'link.html').symlink_to(static / 'index.html')
+    index = StaticIndex(static)
+    index.build()
+    assert 'secret.txt' not in index.files
+    assert index.files['link.html'].variants['identity'].body == b'<h1>index</h1>'
+
+
+async def test_stale_variant_ignored(tmp_path):
+    create_static(tmp_path)
+    gz = tmp_path / 'assets' / 'main.3b5c9e1a.js.gz'
+    os.utime(gz, (0, 0))
+    index = StaticIndex(tmp_path)
+    index.build()
+    assert set(index.files['assets/main.3b5c9e1a.js'].variants) == {'identity'}
+
+
+async def test_serve(aiohttp_client, tmp_path):
+    create_static(tmp_path)
+    cli = await create_app(aiohttp_client, tmp_path, static_index_memory_size=50)
+
+    r = await cli.get('/assets/main.3b5c9e1a.js', headers={'Accept-Encoding': 'gzip'})
+    assert r.status == 200, await r.text()
+    assert r.headers['Content-Type'].endswith('/javascript')
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert r.headers['Cache-Control'] == IMMUTABLE_CACHE_CONTROL
+    assert r.headers['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(await r.read()) == b'console.log(1)'
+
+    r = await cli.get('/assets/main.3b5c9e1a.js', headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in r.headers
+    assert await r.read() == b'console.log(1)'
+
+    # served from disk
+    r = await cli.get('/big.txt')
+    assert r.status == 200
+    assert r.headers['Content-Type'].startswith('text/plain')
+    assert 'Cache-Control' not in r.headers
+    assert await r.text() == 'x' * 100
+
+
+async def test_fallback(aiohttp_client, tmp_path):
+    create_static(tmp_path)
+    cli = await create_app(aiohttp_client, tmp_path)
+    for path in ('/', '/missing/', '/assets/'):
+        r = await cli.get(path)
+        assert r.status == 200, path
+        assert await r.text() == '<h1>index</h1>'
+    r = await cli.get('/.well-known/foobar')
+    assert r.status == 404
+
+
+async def test_not_modified(aiohttp_client, tmp_path):
+    create_static(tmp_path)
+    cli = await create_app(aiohttp_client, tmp_path)
+    r = await cli.get('/assets/main.3b5c9e1a.js', headers={'Accept-Encoding': 'identity'})
+    etag = r.headers['ETag']
+    r = await cli.get('/assets/main.3b5c9e1a.js', headers={'If-None-Match': etag, 'Accept-Encoding': 'identity'})
+    assert r.status == 304
+    assert r.headers['ETag'] == etag
+    assert r.headers['Cache-Control'] == IMMUTABLE_CACHE_CONTROL
+    # the gzip version has a different ETag
+    r = await cli.get('/assets/main.3b5c9e1a.js', headers={'If-None-Match': etag, 'Accept-Encoding': 'gzip'})
+    assert r.status == 200
+
+
+async def test_watch(aiohttp_client, tmp_path):
+    create_static(tmp_path)
+    cli = await create_app(aiohttp_client, tmp_path, static_index_watch_interval=0.01)
+    r = await cli.get('/new.css')
+    assert r.headers['Content-Type'] == 'text/html'
+
+    (tmp_path / 'new.css').write_text('body {}')
+    await asyncio.sleep(0.1)
+    r = await cli.get('/new.css')
+    assert r.headers['Content-Type'] == 'text/css'
+    assert await r.text() == 'body {}'
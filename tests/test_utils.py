@@ -1,17 +1,24 @@
 import asyncio
 import json
+import logging
 import os
+from contextlib import asynccontextmanager
+from enum import Enum
 from typing import List
 
 import pytest
 from aiohttp import web
 from aiohttp.test_utils import make_mocked_request
+from buildpg import asyncpg
 from pydantic import BaseModel, BaseSettings as PydanticBaseSettings
 
-from atoolbox.create_app import cleanup, create_default_app, startup
-from atoolbox.db.helpers import DummyPgPool, TimedLock, run_sql_section
+from atoolbox.create_app import _run_services, cleanup, create_default_app, startup
+from atoolbox.db import CREATE_META_TABLE, prepare_database, prepare_pool, schema_fingerprint
+from atoolbox.db.helpers import DummyPgPool, TimedLock, TruncatingPgPool, run_sql_section, sql_sections, update_enums
 from atoolbox.middleware import error_middleware
-from atoolbox.test_utils import Offline, create_dummy_server, return_any_status
+from atoolbox.rate_limit import rate_limit_middleware
+from atoolbox.settings import BaseSettings
+from atoolbox.test_utils import Offline, create_dummy_server, return_any_status, xdist_pg_dsn
 from atoolbox.utils import JsonErrors, get_ip, parse_request_query, raw_json_response, slugify
 
 
@@ -64,6 +71,44 @@ async def test_run_sql_section_error():
         await run_sql_section('foobar', 'xx', None)
 
 
+def test_sql_sections():
+    sql = (
+        'xxx\n'
+        '-- { outer\n'
+        'create table a ();\n'
+        '-- {{ inner\n'
+        'create table b ();\n'
+        '-- }} inner\n'
+        '-- } outer\n'
+        '-- { no_end\n'
+    )
+    assert sql_sections(sql) == {
+        'outer': 'create table a ();\n-- {{ inner\ncreate table b ();\n-- }} inner',
+        'inner': 'create table b ();',
+    }
+    assert sql_sections(sql) is sql_sections(sql)
+
+
+async def test_update_enums():
+    class UserRole(str, Enum):
+        guest = 'guest'
+        host = 'host'
+        admin = "admin's"
+
+    executed = []
+
+    async def fetch(sql, names):
+        assert names == ['user_role']
+        return [('user_role', 'guest'), ('user_role', 'host')]
+
+    async def execute(sql):
+        executed.append(sql)
+
+    conn = type('Connection', (), {'fetch': fetch, 'execute': execute})
+    assert await update_enums({'user_role': UserRole}, conn) == {'user_role': ["admin's"]}
+    assert executed == ["ALTER TYPE user_role ADD VALUE IF NOT EXISTS 'admin''s'"]
+
+
 async def test_simple_pool(db_conn):
     pool = DummyPgPool(db_conn)
     assert 625 == await pool.fetchval('SELECT 25 * 25')
@@ -78,6 +123,34 @@ async def test_simple_pool(db_conn):
     assert not hasattr(pool, 'transaction')
 
 
+async def test_simple_pool_lock_timeout(db_conn):
+    pool = DummyPgPool(db_conn, lock_timeout=0.05)
+    with pytest.raises(asyncio.TimeoutError, match='DummyPg query lock timed out'):
+        await asyncio.gather(pool.execute('SELECT pg_sleep(0.1)'), pool.execute('SELECT 1'))
+
+
+async def test_truncating_pool(settings, clean_db):
+    pool = await TruncatingPgPool.create(settings.pg_dsn, max_size=3)
+    await pool.execute("INSERT INTO organisations (name, slug) VALUES ('Test Org', 'test-org')")
+    await pool.execute(CREATE_META_TABLE)
+    await pool.execute("INSERT INTO atoolbox_meta (key, value) VALUES ('truncate_test', 'x') ON CONFLICT DO NOTHING")
+
+    async def sleep():
+        async with pool.acquire() as conn:
+            await conn.execute('SELECT pg_sleep(0.1)')
+
+    await asyncio.wait_for(asyncio.gather(*[sleep() for _ in range(3)]), timeout=0.25)
+    assert 1 == await pool.fetchval('SELECT COUNT(*) FROM organisations')
+    await pool.close()
+
+    conn = await asyncpg.connect(settings.pg_dsn)
+    try:
+        assert 0 == await conn.fetchval('SELECT COUNT(*) FROM organisations')
+        assert 'x' == await conn.fetchval("DELETE FROM atoolbox_meta WHERE key='truncate_test' RETURNING value")
+    finally:
+        await conn.close()
+
+
 @pytest.mark.parametrize(
     'input,output', [('{"foo": 42}', b'{"foo": 42}\n'), (b'{"foo": 42}', b'{"foo": 42}\n'), (None, b'null\n')]
 )
@@ -149,13 +222,38 @@ async def test_create_app_no_settings(mocker):
     assert not f.called
 
 
+@pytest.mark.parametrize('rate_limit,enabled', [(False, False), (True, True)])
+async def test_create_app_rate_limit(rate_limit, enabled):
+    # redis_settings is set by default
+    app = await create_default_app(settings=BaseSettings(rate_limit=rate_limit))
+    assert (rate_limit_middleware in app.middlewares) is enabled
+    assert ('rate_limiter' in app) is enabled
+
+
 async def test_create_app_custom_middleware():
     app = await create_default_app(middleware=(error_middleware,))
     assert len(app.middlewares) == 1
 
 
+class FakePool:
+    closed = False
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield 'conn'
+
+    async def close(self):
+        self.closed = True
+
+
 async def test_create_app_pg(mocker):
-    f = mocker.patch('atoolbox.db.prepare_database', return_value=awaitable())
+    pool = FakePool()
+
+    async def prepare_pool(settings):
+        return pool
+
+    # prepare_pool would connect to and write to the database
+    f = mocker.patch('atoolbox.db.prepare_pool', side_effect=prepare_pool)
 
     class Settings(PydanticBaseSettings):
         pg_dsn: str = 'postgres://postgres@localhost:5432/atoolbox_test'
@@ -166,11 +264,88 @@ async def test_create_app_pg(mocker):
     assert 'http_client' not in app
 
     await startup(app)
+    assert app['pg'] is pool
     await cleanup(app)
     assert f.called
+    assert pool.closed
     assert 'http_client' in app
 
 
+async def test_startup_report(dummy_server, caplog):
+    caplog.set_level(logging.INFO, 'atoolbox.web')
+    settings = BaseSettings(
+        pg_dsn=None,
+        redis_settings=None,
+        startup_warmup=True,
+        http_client_warmup_urls=[dummy_server.server_name + '/status/200/', 'http://localhost:1/'],
+    )
+    app = await create_default_app(settings=settings)
+    await startup(app)
+    try:
+        assert list(app['startup_report']) == ['http_client']
+        assert len(dummy_server.log) == 1
+        assert 'error warming up connection to http://localhost:1/, ClientConnectorError' in caplog.text
+        assert 'startup complete in ' in caplog.text
+    finally:
+        await cleanup(app)
+
+
+async def test_startup_timeout():
+    async def slow():
+        await asyncio.sleep(1)
+
+    async def fast():
+        pass
+
+    app = web.Application()
+    pool = app['pg'] = FakePool()
+    settings = BaseSettings(startup_timeouts={'slow': 0.01})
+    with pytest.raises(asyncio.TimeoutError, match='slow startup timed out after 0.01s'):
+        await _run_services(app, {'fast': fast(), 'slow': slow()}, settings)
+    assert 'startup_report' not in app
+    assert not pool.closed
+
+
+async def test_startup_failure_closes_services():
+    pool = FakePool()
+
+    async def pg():
+        app['pg'] = pool
+
+    async def broken():
+        await asyncio.sleep(0.01)
+        raise RuntimeError('broken')
+
+    app = web.Application()
+    with pytest.raises(RuntimeError, match='broken'):
+        await _run_services(app, {'pg': pg(), 'broken': broken()}, BaseSettings())
+    assert pool.closed
+
+
+async def test_migrate_on_startup_no_timeout(mocker):
+    pool = FakePool()
+
+    async def prepare_pool(settings):
+        return pool
+
+    migrated = []
+
+    async def apply_migrations(conn, settings):
+        await asyncio.sleep(0.05)
+        migrated.append(conn)
+
+    mocker.patch('atoolbox.db.prepare_pool', side_effect=prepare_pool)
+    mocker.patch('atoolbox.db.migrations.apply_migrations', side_effect=apply_migrations)
+    settings = BaseSettings(
+        redis_settings=None, pg_migrate_on_startup=True, startup_timeouts={'pg': 0.01}, create_http_client=False
+    )
+    app = await create_default_app(settings=settings)
+    # migrations run after the pg service so aren't limited by its startup timeout
+    await startup(app)
+    assert migrated == ['conn']
+    await cleanup(app)
+
+
 async def test_redis_settings_module():
     from atoolbox.settings import BaseSettings, RedisSettings
 
@@ -226,6 +401,44 @@ def test_is_online(mocker):
             os.environ['CI'] = ci_value
 
 
+def test_xdist_pg_dsn(monkeypatch):
+    monkeypatch.delenv('PYTEST_XDIST_WORKER', raising=False)
+    assert xdist_pg_dsn('postgres://localhost/app') == 'postgres://localhost/app'
+    monkeypatch.setenv('PYTEST_XDIST_WORKER', 'gw3')
+    assert xdist_pg_dsn('postgres://localhost/app') == 'postgres://localhost/app_gw3'
+    assert xdist_pg_dsn('postgres://u:p@localhost:5432/app?sslmode=require') == (
+        'postgres://u:p@localhost:5432/app_gw3?sslmode=require'
+    )
+
+
+async def test_prepare_database_template(settings, clean_db):
+    settings.pg_dsn = settings.pg_dsn + '_tmpl_test'
+    assert await prepare_database(settings, True) is True
+    assert await prepare_database(settings, False) is False
+
+    conn = await asyncpg.connect(settings.pg_dsn.rsplit('/', 1)[0] + '/postgres')
+    try:
+        sql = 'select datname from pg_database where datname like $1'
+        templates = await conn.fetch(sql, settings.pg_template_db.replace('_', r'\_') + r'\_%')
+        assert len(templates) == 1
+        await conn.execute(f'drop database {settings.pg_name}')
+    finally:
+        await conn.close()
+
+
+async def test_prepare_pool(settings, clean_db, mocker):
+    pool = await prepare_pool(settings)
+    await pool.close()
+
+    f = mocker.patch('atoolbox.db.prepare_database')
+    pool = await prepare_pool(settings)
+    try:
+        assert not f.called
+        assert schema_fingerprint(settings) == await pool.fetchval('select value from atoolbox_meta')
+    finally:
+        await pool.close()
+
+
 async def test_create_dummy_server(aiohttp_server):
     routes = [web.get('/extra-route/', return_any_status, name='extra-route')]  # just so we have something
     server = await create_dummy_server(aiohttp_server, extra_routes=routes, extra_context={'x': 42})